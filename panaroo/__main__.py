@@ -9,13 +9,15 @@ import ast
 
 from .isvalid import *
 from .set_default_args import set_default_args
-from .prokka import process_prokka_input
+from .prokka import process_prokka_input, annotation_name, validate_inputs
 from .cdhit import check_cdhit_version
-from .cdhit import run_cdhit
+from .cdhit import run_cdhit, run_cdhit_sharded
+from .cdhit import write_unique_sequences, expand_duplicates
 from .generate_network import generate_network
 from .generate_output import *
 from .clean_network import *
 from .find_missing import find_missing
+from .gene_store import open_gene_data
 from .generate_alignments import check_aligner_install
 from intbitset import intbitset
 
@@ -61,6 +63,56 @@ def get_options(args):
                          help="location of an output directory",
                          type=str)
 
+    io_opts.add_argument(
+        "--preprocess-cache",
+        dest="preprocess_cache",
+        help=("directory in which to cache pre-processed GFF3 files. Files " +
+              "with unchanged contents are loaded from the cache in " +
+              "subsequent runs instead of being parsed again"),
+        type=str,
+        default=None)
+
+    io_opts.add_argument(
+        "--pairwise-cache",
+        dest="pairwise_cache",
+        help=("directory in which to cache pairwise identities between " +
+              "centroid sequences and the cd-hit clusters used to find them. " +
+              "Pairs already compared in previous runs are not aligned " +
+              "again. The cd-hit clusters are only reused through this " +
+              "cache and are recomputed in every run without it"),
+        type=str,
+        default=None)
+
+    io_opts.add_argument(
+        "--input-format",
+        dest="input_format",
+        help=("format of the input GFF3 files. 'auto' detects the format " +
+              "of each file from its header. Prodigal and RefSeq annotations " +
+              "without a ##FASTA section are read together with a genome " +
+              "FASTA (.fna, .fasta, .fa, .fas or .fsa) of the same name. " +
+              "Unlike scripts/convert_refseq_to_prokka_gff.py, incomplete " +
+              "CDS and those with premature stop codons are only removed " +
+              "with --remove-invalid-genes (default=auto)"),
+        choices=['auto', 'prokka', 'bakta', 'prodigal', 'refseq'],
+        default='auto')
+
+    io_opts.add_argument(
+        "--translation-table",
+        dest="table",
+        help=("NCBI translation table used to translate the annotated " +
+              "and refound genes (default=11)"),
+        type=int,
+        default=11)
+
+    io_opts.add_argument(
+        "--validate-only",
+        dest="validate_only",
+        help=("check the input files for problems and exit without " +
+              "running the pipeline. The same checks are always run " +
+              "before pre-processing"),
+        action='store_true',
+        default=False)
+
     mode_opts = parser.add_argument_group('Mode')
 
     mode_opts.add_argument(
@@ -114,6 +166,25 @@ Does not delete any genes and only performes merge and refinding\
                           dest="len_dif_percent",
                           help="length difference cutoff (default=0.98)",
                           type=float)
+    matching.add_argument(
+        "--prefilter",
+        dest="prefilter",
+        help=("method used to find candidate pairs of centroids before " +
+              "aligning them. 'cdhit' clusters the centroids with cd-hit " +
+              "at decreasing thresholds while 'kmer' compares shared " +
+              "k-mers without calling cd-hit (default=cdhit)"),
+        choices=['cdhit', 'kmer'],
+        default='cdhit')
+    matching.add_argument(
+        "--shard-size",
+        dest="shard_size",
+        help=("cluster the genes of this many genomes at a time with " +
+              "cd-hit, then cluster the representatives of each shard " +
+              "together. Limits the memory used by cd-hit for very large " +
+              "collections at the cost of slightly different clusters " +
+              "(default: cluster all genes in one run)"),
+        type=int,
+        default=None)
     matching.add_argument("--merge_paralogs",
                           dest="merge_paralogs",
                           help="don't split paralogs",
@@ -252,6 +323,30 @@ Does not delete any genes and only performes merge and refinding\
 
 def main():
     args = get_options(sys.argv[1:])
+
+    # check if input is a file containing filenames
+    if len(args.input_files) == 1:
+        files = []
+        with open(args.input_files[0], 'r') as infile:
+            for line in infile:
+                files.append(line.strip())
+        args.input_files = files
+
+    # check all inputs before starting so that every problem is reported
+    if args.verbose:
+        print("checking input files...")
+    valid = validate_inputs(args.input_files,
+                            filter_seqs=args.filter_invalid,
+                            input_format=args.input_format,
+                            n_cpu=args.n_cpu,
+                            quiet=(not args.verbose) and
+                            (not args.validate_only))
+    if not valid:
+        sys.stderr.write("Invalid input files, see errors above\n")
+        sys.exit(1)
+    if args.validate_only:
+        return
+
     # Check cd-hit is installed
     check_cdhit_version()
     #Make sure aligner is installed if alignment requested
@@ -266,29 +361,43 @@ def main():
     # Create temporary directory
     temp_dir = os.path.join(tempfile.mkdtemp(dir=args.output_dir), "")
 
-    # check if input is a file containing filenames
-    if len(args.input_files) == 1:
-        files = []
-        with open(args.input_files[0], 'r') as infile:
-            for line in infile:
-                files.append(line.strip())
-        args.input_files = files
-
     if args.verbose:
         print("pre-processing gff3 files...")
 
     # convert input GFF3 files into summary files
-    process_prokka_input(args.input_files, args.output_dir, args.filter_invalid,
-                         (not args.verbose), args.n_cpu)
+    process_prokka_input(args.input_files,
+                         args.output_dir,
+                         args.filter_invalid, (not args.verbose),
+                         args.n_cpu,
+                         cache_dir=args.preprocess_cache,
+                         input_format=args.input_format,
+                         table=args.table)
 
     # Cluster protein sequences using cdhit
+    # identical proteins are clustered once and added back afterwards
     cd_hit_out = args.output_dir + "combined_protein_cdhit_out.txt"
-    run_cdhit(input_file=args.output_dir + "combined_protein_CDS.fasta",
-              output_file=cd_hit_out,
-              id=args.id,
-              s=args.len_dif_percent,
-              quiet=(not args.verbose),
-              n_cpu=args.n_cpu)
+    duplicates = write_unique_sequences(
+        args.output_dir + "combined_protein_CDS.fasta",
+        temp_dir + "unique_protein_CDS.fasta")
+    if (args.shard_size is not None) and (args.shard_size < len(
+            args.input_files)):
+        run_cdhit_sharded(input_file=temp_dir + "unique_protein_CDS.fasta",
+                          output_file=cd_hit_out,
+                          outdir=temp_dir,
+                          shard_size=args.shard_size,
+                          id=args.id,
+                          s=args.len_dif_percent,
+                          quiet=(not args.verbose),
+                          n_cpu=args.n_cpu)
+    else:
+        run_cdhit(input_file=temp_dir + "unique_protein_CDS.fasta",
+                  output_file=cd_hit_out,
+                  id=args.id,
+                  s=args.len_dif_percent,
+                  quiet=(not args.verbose),
+                  n_cpu=args.n_cpu)
+    expand_duplicates(cd_hit_out + ".clstr", duplicates)
+    del duplicates
 
     if args.verbose:
         print("generating initial network...")
@@ -297,7 +406,6 @@ def main():
     G, centroid_contexts, seqid_to_centroid = generate_network(
         cluster_file=cd_hit_out + ".clstr",
         data_file=args.output_dir + "gene_data.csv",
-        prot_seq_file=args.output_dir + "combined_protein_CDS.fasta",
         all_dna=args.all_seq_in_graph)
 
     # merge paralogs
@@ -331,7 +439,9 @@ def main():
                           length_outlier_support_proportion=args.
                           length_outlier_support_proportion,
                           n_cpu=args.n_cpu,
-                          quiet=(not args.verbose))[0]
+                          quiet=(not args.verbose),
+                          pairwise_cache=args.pairwise_cache,
+                          prefilter=args.prefilter)[0]
 
     if args.verbose:
         print("collapse gene families...")
@@ -346,7 +456,9 @@ def main():
         length_outlier_support_proportion=args.
         length_outlier_support_proportion,
         n_cpu=args.n_cpu,
-        quiet=(not args.verbose))
+        quiet=(not args.verbose),
+        pairwise_cache=args.pairwise_cache,
+        prefilter=args.prefilter)
 
     if args.verbose:
         print("trimming contig ends...")
@@ -372,6 +484,8 @@ def main():
                      pairwise_id_thresh=args.id,
                      merge_id_thresh=max(0.8, args.family_threshold),
                      n_cpu=args.n_cpu,
+                     input_format=args.input_format,
+                     table=args.table,
                      verbose=args.verbose)
 
     # remove edges that are likely due to misassemblies (by consensus)
@@ -388,6 +502,8 @@ def main():
                           length_outlier_support_proportion,
                           n_cpu=args.n_cpu,
                           quiet=(not args.verbose),
+                          pairwise_cache=args.pairwise_cache,
+                          prefilter=args.prefilter,
                           distances_bwtn_centroids=distances_bwtn_centroids,
                           centroid_to_index=centroid_to_index)[0]
 
@@ -399,9 +515,7 @@ def main():
     if args.merge_paralogs:
         G = merge_paralogs(G)
 
-    isolate_names = [
-        os.path.splitext(os.path.basename(x))[0] for x in args.input_files
-    ]
+    isolate_names = [annotation_name(x) for x in args.input_files]
     G.graph['isolateNames'] = isolate_names
     mems_to_isolates = {}
     for i, iso in enumerate(isolate_names):
@@ -413,14 +527,14 @@ def main():
     # write out roary like gene_presence_absence.csv
     # get original annotaiton IDs, lengts and whether or
     # not an internal stop codon is present
-    orig_ids = {}
-    ids_len_stop = {}
-    with open(args.output_dir + "gene_data.csv", 'r') as infile:
-        next(infile)
-        for line in infile:
-            line = line.split(",")
-            orig_ids[line[2]] = line[3]
-            ids_len_stop[line[2]] = (len(line[4]), "*" in line[4][1:-3])
+    gene_data = open_gene_data(args.output_dir + "gene_data.csv")
+    clustering_ids = list(gene_data.column("clustering_id"))
+    orig_ids = dict(zip(clustering_ids, gene_data.column("annotation_id")))
+    ids_len_stop = dict(
+        zip(
+            clustering_ids,
+            zip(gene_data.lengths("prot_sequence").tolist(),
+                gene_data.internal_stops().tolist())))
 
     G = generate_roary_gene_presence_absence(G,
                                              mems_to_isolates=mems_to_isolates,
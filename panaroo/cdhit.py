@@ -13,8 +13,35 @@ from scipy.sparse import csr_matrix
 from scipy.sparse.csgraph import connected_components
 from joblib import Parallel, delayed
 import math
+import glob
+import shutil
+import uuid
+import hashlib
+import time
+from array import array
 from tqdm import tqdm
 
+# bump if run_pw changes to invalidate cached pairwise identities
+PAIRWISE_CACHE_VERSION = b"1"
+
+# maps characters to k-mer digits, ambiguous characters map to -1
+dna_kmer_alphabet = np.full(256, -1, dtype=np.int64)
+for i, c in enumerate("ACGT"):
+    dna_kmer_alphabet[ord(c)] = i
+protein_kmer_alphabet = np.full(256, -1, dtype=np.int64)
+for i, c in enumerate("ACDEFGHIKLMNPQRSTVWY"):
+    protein_kmer_alphabet[ord(c)] = i
+
+# characters treated as matching when aligning with edlib
+dna_equalities = [('A', 'N'), ('C', 'N'), ('G', 'N'), ('T', 'N')]
+protein_equalities = [('*', 'X'), ('A', 'X'), ('C', 'X'), ('B', 'X'),
+                      ('E', 'X'), ('D', 'X'), ('G', 'X'), ('F', 'X'),
+                      ('I', 'X'), ('H', 'X'), ('K', 'X'), ('M', 'X'),
+                      ('L', 'X'), ('N', 'X'), ('Q', 'X'), ('P', 'X'),
+                      ('S', 'X'), ('R', 'X'), ('T', 'X'), ('W', 'X'),
+                      ('V', 'X'), ('Y', 'X'), ('X', 'X'), ('Z', 'X'),
+                      ('D', 'B'), ('N', 'B'), ('E', 'Z'), ('Q', 'Z')]
+
 
 def check_cdhit_version(cdhit_exec='cd-hit'):
     """Checks that cd-hit can be run, and returns version.
@@ -29,8 +56,10 @@ def check_cdhit_version(cdhit_exec='cd-hit'):
         version (int)
             Major version of cd-hit
     """
-    p = str(
-        subprocess.run(cdhit_exec + ' -h', stdout=subprocess.PIPE, shell=True))
+    try:
+        p = str(subprocess.run([cdhit_exec, '-h'], stdout=subprocess.PIPE))
+    except OSError:
+        p = ""
     version = False
     find_ver = re.search(r'CD-HIT version \d+\.\d+', p)
     if find_ver:
@@ -43,6 +72,55 @@ def check_cdhit_version(cdhit_exec='cd-hit'):
     return (version)
 
 
+def child_peak_memory(pid):
+    """Peak resident memory (VmHWM) of a running process in kB, or None where
+    it is not available from /proc"""
+    try:
+        with open("/proc/%d/status" % pid, 'r') as infile:
+            for line in infile:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def run_clustering_cmd(cmd, quiet=False):
+    """Runs a cd-hit command given as a list of arguments. Unless quiet, the
+    command is printed followed by its run time and memory use."""
+    if quiet:
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, check=True)
+        return
+
+    print("running cmd: " + " ".join(cmd))
+    start = time.perf_counter()
+    process = subprocess.Popen(cmd)
+    # the high water mark of the child is polled from /proc, as the maxrss
+    # reported on exit includes the memory inherited from this process
+    peak_kb = None
+    while True:
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid != 0:
+            break
+        hwm = child_peak_memory(process.pid)
+        if hwm is not None:
+            peak_kb = hwm if peak_kb is None else max(peak_kb, hwm)
+        time.sleep(0.05)
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+    message = "finished in %.1fs (cpu time %.1fs" % (
+        time.perf_counter() - start, usage.ru_utime + usage.ru_stime)
+    if peak_kb is not None:
+        message += ", peak memory %.1f MB" % (peak_kb / 1024.0)
+    print(message + ")")
+
+    return
+
+
 def run_cdhit(
     input_file,
     output_file,
@@ -59,36 +137,31 @@ def run_cdhit(
     min_length=None,
     quiet=False):
 
-    cmd = "cd-hit"
-    cmd += " -T " + str(n_cpu)
-    cmd += " -i " + input_file
-    cmd += " -o " + output_file
-    cmd += " -c " + str(id)
-    cmd += " -s " + str(s)
-    cmd += " -aL " + str(aL)
-    cmd += " -AL " + str(AL)
-    cmd += " -aS " + str(aS)
-    cmd += " -AS " + str(AS)
-    cmd += " -M 0 -d 999"
+    cmd = ["cd-hit"]
+    cmd += ["-T", str(n_cpu)]
+    cmd += ["-i", input_file]
+    cmd += ["-o", output_file]
+    cmd += ["-c", str(id)]
+    cmd += ["-s", str(s)]
+    cmd += ["-aL", str(aL)]
+    cmd += ["-AL", str(AL)]
+    cmd += ["-aS", str(aS)]
+    cmd += ["-AS", str(AS)]
+    cmd += ["-M", "0", "-d", "999"]
 
     if use_local:
-        cmd += " -G 0"
+        cmd += ["-G", "0"]
 
     if accurate:
-        cmd += " -g 1 -n 2"
+        cmd += ["-g", "1", "-n", "2"]
 
     if (word_length is not None) and (not accurate):
-        cmd += " -n " + str(word_length)
+        cmd += ["-n", str(word_length)]
 
     if min_length is not None:
-        cmd += " -l " + str(min_length)
+        cmd += ["-l", str(min_length)]
 
-    if not quiet:
-        print("running cmd: " + cmd)
-    else:
-        cmd += " > /dev/null"
-
-    subprocess.run(cmd, shell=True, check=True)
+    run_clustering_cmd(cmd, quiet=quiet)
 
     return
 
@@ -111,40 +184,220 @@ def run_cdhit_est(
     mask=True,
     quiet=False):
 
-    cmd = "cd-hit-est"
-    cmd += " -T " + str(n_cpu)
-    cmd += " -i " + input_file
-    cmd += " -o " + output_file
-    cmd += " -c " + str(id)
-    cmd += " -s " + str(s)
-    cmd += " -aL " + str(aL)
-    cmd += " -AL " + str(AL)
-    cmd += " -aS " + str(aS)
-    cmd += " -AS " + str(AS)
-    cmd += " -r " + str(strand)
-    cmd += " -M 0 -d 999"
+    cmd = ["cd-hit-est"]
+    cmd += ["-T", str(n_cpu)]
+    cmd += ["-i", input_file]
+    cmd += ["-o", output_file]
+    cmd += ["-c", str(id)]
+    cmd += ["-s", str(s)]
+    cmd += ["-aL", str(aL)]
+    cmd += ["-AL", str(AL)]
+    cmd += ["-aS", str(aS)]
+    cmd += ["-AS", str(AS)]
+    cmd += ["-r", str(strand)]
+    cmd += ["-M", "0", "-d", "999"]
 
     if mask:
-        cmd += " -mask NX"
+        cmd += ["-mask", "NX"]
 
     if use_local:
-        cmd += " -G 0"
+        cmd += ["-G", "0"]
 
     if accurate:
-        cmd += " -g 1 -n 6"
+        cmd += ["-g", "1", "-n", "6"]
 
     if (word_length is not None) and (not accurate):
-        cmd += " -n " + str(word_length)
+        cmd += ["-n", str(word_length)]
 
     if print_aln:
-        cmd += " -p 1"
+        cmd += ["-p", "1"]
 
-    if not quiet:
-        print("running cmd: " + cmd)
-    else:
-        cmd += " > /dev/null"
+    run_clustering_cmd(cmd, quiet=quiet)
+
+    return
+
+
+def run_cdhit_2d(
+    db_file,
+    input_file,
+    output_file,
+    id=0.95,
+    n_cpu=1,
+    s=0.0,  # length difference cutoff (%), default 0.0
+    s2=1.0,  # minimum length of db sequences relative to the input
+    accurate=True,  # use the slower but more accurate options
+    min_length=None,
+    quiet=False):
+    """Compares the sequences in input_file to those in db_file. Matched
+    sequences are added to the cluster of their db sequence in the .clstr
+    file while unmatched sequences are written to output_file."""
+
+    cmd = ["cd-hit-2d"]
+    cmd += ["-T", str(n_cpu)]
+    cmd += ["-i", db_file]
+    cmd += ["-i2", input_file]
+    cmd += ["-o", output_file]
+    cmd += ["-c", str(id)]
+    cmd += ["-s", str(s)]
+    cmd += ["-s2", str(s2)]
+    cmd += ["-M", "0", "-d", "999"]
 
-    subprocess.run(cmd, shell=True, check=True)
+    if accurate:
+        cmd += ["-g", "1", "-n", "2"]
+
+    if min_length is not None:
+        cmd += ["-l", str(min_length)]
+
+    run_clustering_cmd(cmd, quiet=quiet)
+
+    return
+
+
+def write_unique_sequences(input_file, output_file):
+    """Writes the first copy of each distinct sequence in a FASTA file.
+
+    Returns:
+        duplicates (dict)
+            Ids of the later copies of each sequence written, keyed by the
+            id of its first copy
+    """
+    first_copy = {}
+    duplicates = defaultdict(list)
+    with open(input_file, 'r') as infile, open(output_file, 'w') as outfile:
+        record = []
+        for line in itertools.chain(infile, [">"]):
+            if line[0] == ">" and len(record) > 0:
+                sid = record[0][1:].split()[0]
+                key = hashlib.blake2b("".join(
+                    l.strip() for l in record[1:]).encode(),
+                                      digest_size=16).digest()
+                if key in first_copy:
+                    duplicates[first_copy[key]].append(sid)
+                else:
+                    first_copy[key] = sid
+                    outfile.writelines(record)
+                record = []
+            record.append(line)
+    return duplicates
+
+
+def expand_duplicates(clstr_file, duplicates):
+    """Adds the copies removed by write_unique_sequences to the clusters of
+    their first copy in a cd-hit .clstr file."""
+    temp_file = tempfile.NamedTemporaryFile('w',
+                                            delete=False,
+                                            dir=os.path.dirname(clstr_file))
+    with open(clstr_file, 'r') as infile, temp_file:
+        i = 0
+        for line in infile:
+            if line[0] == ">":
+                temp_file.write(line)
+                i = 0
+                continue
+            sid = line.split(">")[1].split("...")[0]
+            temp_file.write(str(i) + "\t" + line.split("\t", 1)[1])
+            i += 1
+            length = line.split("\t", 1)[1].split(",")[0]
+            for dup in duplicates.get(sid, []):
+                temp_file.write(
+                    str(i) + "\t" + length + ", >" + dup + "... at 100.00%\n")
+                i += 1
+    os.replace(temp_file.name, clstr_file)
+    return
+
+
+def run_cdhit_sharded(input_file,
+                      output_file,
+                      outdir,
+                      shard_size,
+                      id=0.95,
+                      n_cpu=1,
+                      s=0.0,
+                      quiet=False):
+    """Clusters proteins with cd-hit in shards of shard_size genomes, then
+    clusters the representatives of all shards together.
+
+    Each sequence is assigned to the final cluster of its shard
+    representative. The representatives are written to output_file and the
+    clusters to output_file + ".clstr" as they would be by run_cdhit, so
+    that cd-hit only ever holds one shard or the representatives in memory.
+    """
+
+    if shard_size < 1:
+        raise ValueError("shard_size must be at least 1")
+
+    # split the input by genome, which is the first field of each id
+    shard_files = []
+    shard_handles = {}
+    with open(input_file, 'r') as infile:
+        handle = None
+        for line in infile:
+            if line[0] == ">":
+                shard = int(line[1:].split("_")[0]) // shard_size
+                if shard not in shard_handles:
+                    shard_file = tempfile.NamedTemporaryFile(delete=False,
+                                                             dir=outdir)
+                    shard_handles[shard] = open(shard_file.name, 'w')
+                    shard_file.close()
+                    shard_files.append(shard_file.name)
+                handle = shard_handles[shard]
+            handle.write(line)
+    for handle in shard_handles.values():
+        handle.close()
+
+    # cluster the shards in parallel. cd-hit runs as a separate process so
+    # threads are sufficient
+    n_jobs = max(1, min(n_cpu, len(shard_files)))
+    Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(run_cdhit)(input_file=shard_file,
+                           output_file=shard_file + ".out",
+                           id=id,
+                           s=s,
+                           quiet=True,
+                           n_cpu=max(1, n_cpu // n_jobs))
+        for shard_file in shard_files)
+
+    # cluster the representatives of every shard
+    reps_file = tempfile.NamedTemporaryFile(delete=False, dir=outdir)
+    with reps_file:
+        for shard_file in shard_files:
+            with open(shard_file + ".out", 'rb') as infile:
+                shutil.copyfileobj(infile, reps_file)
+    run_cdhit(input_file=reps_file.name,
+              output_file=output_file,
+              id=id,
+              s=s,
+              quiet=quiet,
+              n_cpu=n_cpu)
+    rep_ids, rep_labels, rep_is_rep = read_cdhit_clusters(output_file +
+                                                          ".clstr")
+    rep_cluster = dict(zip(rep_ids, rep_labels.tolist()))
+    centroids = set(itertools.compress(rep_ids, rep_is_rep))
+
+    # collect the members of each final cluster from the shard clusters
+    members = [[] for i in range(rep_labels.max() + 1 if len(rep_ids) else 0)]
+    for shard_file in shard_files:
+        for cluster in read_cdhit_cluster_lines(shard_file + ".out.clstr"):
+            # the shard representative decides the final cluster
+            shard_rep = [sid for sid, line in cluster if line.endswith("*")]
+            if shard_rep[0] not in rep_cluster: continue  #dropped by cd-hit
+            final = members[rep_cluster[shard_rep[0]]]
+            for sid, line in cluster:
+                final.append((sid in centroids, line.split("...")[0]))
+        os.remove(shard_file)
+        os.remove(shard_file + ".out")
+        os.remove(shard_file + ".out.clstr")
+    os.remove(reps_file.name)
+
+    # overwrite the representative clusters with the full clusters
+    with open(output_file + ".clstr", 'w') as outfile:
+        for c, cluster in enumerate(members):
+            outfile.write(">Cluster " + str(c) + "\n")
+            cluster.sort(key=lambda x: not x[0])
+            for i, (is_centroid, line) in enumerate(cluster):
+                outfile.write(
+                    str(i) + "\t" + line.split("\t", 1)[1] +
+                    ("... *\n" if is_centroid else "...\n"))
 
     return
 
@@ -210,17 +463,8 @@ def cluster_nodes_cdhit(
                   n_cpu=n_cpu)
 
     # process the output
-    clusters = []
-    with open(temp_output_file.name + ".clstr", 'r') as infile:
-        c = []
-        for line in infile:
-            if line[0] == ">":
-                clusters.append(c)
-                c = []
-            else:
-                c.append(int(line.split(">")[1].split("...")[0]))
-        clusters.append(c)
-    clusters = clusters[1:]
+    clusters = [[int(n) for n in c] for c in read_cdhit_cluster_lists(
+        temp_output_file.name + ".clstr")]
 
     # optionally split clusters to ensure we don't collapse paralogs
     if prevent_para:
@@ -364,8 +608,75 @@ def align_dna_cdhit(
     return found_seq
 
 
-def iterative_cdhit(
-    G,
+def read_cdhit_clusters(clstr_file):
+    """Reads a cd-hit .clstr file.
+
+    Returns:
+        ids (list)
+            Sequence ids in the order they appear in the file
+        labels (numpy.ndarray)
+            Cluster index of each sequence
+        is_rep (numpy.ndarray)
+            Whether each sequence is the representative of its cluster
+    """
+    ids = []
+    labels = array('q')
+    is_rep = array('b')
+    c = -1
+    with open(clstr_file, 'r') as infile:
+        for line in infile:
+            if line[0] == ">":
+                c = int(line.split()[-1])
+            else:
+                ids.append(line.split(">")[1].split("...")[0])
+                labels.append(c)
+                is_rep.append(line.rstrip().endswith("*"))
+    return ids, np.array(labels, dtype=np.int64), np.array(is_rep, dtype=bool)
+
+
+def read_cdhit_cluster_lines(clstr_file):
+    """Yields the (id, line) pairs of the members of each cluster in a
+    cd-hit .clstr file."""
+    cluster = []
+    with open(clstr_file, 'r') as infile:
+        for line in infile:
+            if line[0] == ">":
+                if len(cluster) > 0:
+                    yield cluster
+                cluster = []
+            else:
+                line = line.rstrip()
+                cluster.append((line.split(">")[1].split("...")[0], line))
+    if len(cluster) > 0:
+        yield cluster
+
+
+def read_cdhit_cluster_lists(clstr_file):
+    """Reads the sequence ids in each cluster of a cd-hit .clstr file, in
+    the order they appear in the file."""
+    ids, labels, _ = read_cdhit_clusters(clstr_file)
+    if len(ids) == 0:
+        return []
+    breaks = np.flatnonzero(labels[1:] != labels[:-1]) + 1
+    starts = np.concatenate([[0], breaks])
+    ends = np.concatenate([breaks, [len(ids)]])
+    return [ids[start:end] for start, end in zip(starts, ends)]
+
+
+def write_cdhit_clusters(clusters, lengths, clstr_file):
+    """Writes clusters in the .clstr format of cd-hit with the first member
+    of each cluster as its representative."""
+    with open(clstr_file, 'w') as outfile:
+        for c, cluster in enumerate(clusters):
+            outfile.write(">Cluster " + str(c) + "\n")
+            for i, sid in enumerate(cluster):
+                outfile.write(str(i) + "\t" + str(lengths[sid]) + "aa, >" +
+                              sid + ("... *\n" if i == 0 else "...\n"))
+    return
+
+
+def cdhit_hierarchy(
+    sequences,
     outdir,
     dna=False,
     s=0.0,  # length difference cutoff (%), default 0.0
@@ -379,7 +690,39 @@ def iterative_cdhit(
     quiet=False,
     word_length=None,
     thresholds=[0.99, 0.95, 0.90, 0.85, 0.8, 0.75, 0.7],
-    n_cpu=1):
+    n_cpu=1,
+    cache_dir=None):
+    """Clusters sequences with cd-hit at each of a decreasing set of
+    thresholds, each round clustering the representatives of the last.
+
+    If cache_dir is given the tree is saved there, keyed by the sequences and
+    options, and loaded instead of running cd-hit when they are unchanged.
+    Without it the tree is computed again on every call.
+
+    Returns:
+        labels (numpy.ndarray)
+            Array of shape (len(thresholds), len(sequences)) giving the
+            cluster of each sequence at each threshold. Sequences dropped by
+            cd-hit are given the label -1.
+    """
+    ids = list(sequences.keys())
+    index = {sid: i for i, sid in enumerate(ids)}
+
+    # the clusters only depend on the input and the options used
+    if cache_dir is not None:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(repr((dna, s, aL, AL, aS, AS, accurate, use_local, strand,
+                       word_length, list(thresholds))).encode())
+        for sid in ids:
+            h.update(b">" + str(sid).encode() + b"\n")
+            h.update(sequences[sid].encode() + b"\n")
+        tree_file = os.path.join(cache_dir,
+                                 "cdhit_tree_" + h.hexdigest() + ".npy")
+        if os.path.isfile(tree_file):
+            try:
+                return np.load(tree_file)
+            except (OSError, ValueError, EOFError):
+                pass
 
     # create the files we will need
     temp_input_file = tempfile.NamedTemporaryFile(delete=False, dir=outdir)
@@ -387,25 +730,14 @@ def iterative_cdhit(
     temp_output_file = tempfile.NamedTemporaryFile(delete=False, dir=outdir)
     temp_output_file.close()
 
-    centroid_to_seq = {}
-    for node in G.nodes():
-        if dna:
-            for sid, seq in zip(G.nodes[node]["centroid"],
-                                G.nodes[node]["dna"]):
-                centroid_to_seq[sid] = seq
-        else:
-            for sid, seq in zip(G.nodes[node]["centroid"],
-                                G.nodes[node]["protein"]):
-                centroid_to_seq[sid] = seq
-
-    clusters = []
     with open(temp_input_file.name, 'w') as outfile:
-        for centroid in centroid_to_seq:
-            clusters.append([centroid])
-            outfile.write(">" + str(centroid) + "\n")
-            outfile.write(centroid_to_seq[centroid] + "\n")
+        for sid in ids:
+            outfile.write(">" + str(sid) + "\n")
+            outfile.write(sequences[sid] + "\n")
 
-    for cid in thresholds:
+    labels = np.zeros((len(thresholds), len(ids)), dtype=np.int64)
+    prev_labels = np.arange(len(ids), dtype=np.int64)
+    for level, cid in enumerate(thresholds):
         # run cd-hit
         if dna:
             run_cdhit_est(input_file=temp_input_file.name,
@@ -435,44 +767,118 @@ def iterative_cdhit(
                       quiet=quiet,
                       n_cpu=n_cpu)
 
-        # process the output
-        temp_clusters = []
-        with open(temp_output_file.name + ".clstr", 'r') as infile:
-            c = []
-            for line in infile:
-                if line[0] == ">":
-                    temp_clusters.append(c)
-                    c = []
-                else:
-                    c.append(line.split(">")[1].split("...")[0])
-            temp_clusters.append(c)
-        temp_clusters = temp_clusters[1:]
-
-        # collapse previously clustered
-        temp_clust_dict = {}
-        for c, clust in enumerate(temp_clusters):
-            for n in clust:
-                temp_clust_dict[n] = c
-        clust_dict = defaultdict(list)
-        for clust in clusters:
-            c = -1
-            for n in clust:
-                if n in temp_clust_dict:
-                    c = temp_clust_dict[n]
-            for n in clust:
-                clust_dict[c].append(n)
-        clusters = clust_dict.values()
+        # each input sequence represents one cluster of the previous round
+        clstr_ids, clstr_labels, _ = read_cdhit_clusters(
+            temp_output_file.name + ".clstr")
+        members = np.array([index[sid] for sid in clstr_ids], dtype=np.int64)
+        new_labels = np.full(len(ids) + 1, -1, dtype=np.int64)
+        new_labels[prev_labels[members]] = clstr_labels
+        # clusters dropped in an earlier round keep the label -1
+        prev_labels = new_labels[prev_labels]
+        labels[level] = prev_labels
 
         # cleanup and rename for next round
         os.remove(temp_input_file.name)
         os.remove(temp_output_file.name + ".clstr")
         temp_input_file.name = temp_output_file.name
         temp_output_file.name = temp_output_file.name + "t" + str(cid)
+    os.remove(temp_input_file.name)
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_file = tempfile.NamedTemporaryFile(delete=False,
+                                                dir=cache_dir,
+                                                suffix=".tmp")
+        with temp_file:
+            np.save(temp_file, labels)
+        os.replace(temp_file.name, tree_file)
 
-    return (clusters)
+    return labels
 
 
-def pwdist_edlib(G, cdhit_clusters, threshold, dna=False, n_cpu=1):
+def hierarchy_clusters(ids, labels, level=-1):
+    """Lists the clusters at one level of the tree found by cdhit_hierarchy.
+
+    Clusters and their members are ordered as they would be by merging the
+    clusters of each round in turn, starting from the input order. Sequences
+    that were dropped by cd-hit are grouped together.
+    """
+    if len(ids) == 0:
+        return []
+    order = np.arange(len(ids))
+    for level_labels in labels[:level % len(labels) + 1]:
+        # clusters are placed in order of their first member
+        _, first, inverse = np.unique(level_labels[order],
+                                      return_index=True,
+                                      return_inverse=True)
+        order = order[np.argsort(first[inverse], kind='stable')]
+    lab = labels[level][order]
+    breaks = np.flatnonzero(lab[1:] != lab[:-1]) + 1
+    return [[ids[i] for i in c] for c in np.split(order, breaks)]
+
+
+def iterative_cdhit(
+    G,
+    outdir,
+    dna=False,
+    s=0.0,  # length difference cutoff (%), default 0.0
+    aL=0.0,  # alignment coverage for the longer sequence
+    AL=99999999,  # alignment coverage control for the longer sequence
+    aS=0.0,  # alignment coverage for the shorter sequence
+    AS=99999999,  # alignment coverage control for the shorter sequence
+    accurate=True,  # use the slower but more accurate options
+    use_local=False,  #whether to use local or global sequence alignment
+    strand=1,  # default do both +/+ & +/- alignments if set to 0, only +/+
+    quiet=False,
+    word_length=None,
+    thresholds=[0.99, 0.95, 0.90, 0.85, 0.8, 0.75, 0.7],
+    n_cpu=1,
+    cache_dir=None):
+
+    centroid_to_seq = {}
+    for node in G.nodes():
+        if dna:
+            for sid, seq in zip(G.nodes[node]["centroid"],
+                                G.nodes[node]["dna"]):
+                centroid_to_seq[sid] = seq
+        else:
+            for sid, seq in zip(G.nodes[node]["centroid"],
+                                G.nodes[node]["protein"]):
+                centroid_to_seq[sid] = seq
+
+    labels = cdhit_hierarchy(centroid_to_seq,
+                             outdir,
+                             dna=dna,
+                             s=s,
+                             aL=aL,
+                             AL=AL,
+                             aS=aS,
+                             AS=AS,
+                             accurate=accurate,
+                             use_local=use_local,
+                             strand=strand,
+                             quiet=quiet,
+                             word_length=word_length,
+                             thresholds=thresholds,
+                             n_cpu=n_cpu,
+                             cache_dir=cache_dir)
+
+    return hierarchy_clusters(list(centroid_to_seq.keys()), labels)
+
+
+def pwdist_edlib(G,
+                 cdhit_clusters,
+                 threshold,
+                 dna=False,
+                 n_cpu=1,
+                 cache_dir=None,
+                 prefilter="cdhit"):
+    """Finds pairs of centroids with at least the threshold identity.
+
+    Candidate pairs are either all pairs within the cdhit_clusters found by
+    iterative_cdhit or, if prefilter='kmer', those sharing enough k-mers
+    (see kmer_candidate_pairs) in which case cdhit_clusters is not used.
+    """
 
     # Prepare sequences
     centroid_to_seq = {}
@@ -492,30 +898,388 @@ def pwdist_edlib(G, cdhit_clusters, threshold, dna=False, n_cpu=1):
     centroid_to_index = {}
     for i, centroid in enumerate(centroid_to_seq):
         centroid_to_index[centroid] = i
+    sequences = list(centroid_to_seq.values())
 
-    # get pairwise id between sequences in the same cdhit clusters
-    all_distances = []
-    for cluster in cdhit_clusters:
-        all_distances += Parallel(n_jobs=n_cpu)(
-            delayed(run_pw)(centroid_to_seq[c1], centroid_to_seq[c2],
-                            centroid_to_index[c1], centroid_to_index[c2], dna)
-            for c1, c2 in itertools.combinations(cluster, 2))
-
-    data = []
-    row_ind = []
-    col_ind = []
-    for d in all_distances:
-        if d[2] >= threshold:
-            data.append(1)
-            row_ind.append(d[0])
-            col_ind.append(d[1])
-
-    distances_bwtn_centroids = csr_matrix((data, (row_ind, col_ind)),
-                                          shape=(ncentroids, ncentroids))
+    if prefilter == "kmer":
+        rows, cols = kmer_candidate_pairs(sequences, threshold, dna=dna)
+    else:
+        # get pairwise id between sequences in the same cdhit clusters
+        rows = []
+        cols = []
+        for cluster in cdhit_clusters:
+            index = [centroid_to_index[c] for c in cluster]
+            for i1, i2 in itertools.combinations(index, 2):
+                rows.append(i1)
+                cols.append(i2)
+        rows = np.array(rows, dtype=np.int64)
+        cols = np.array(cols, dtype=np.int64)
+
+    pwids = pairwise_identities(sequences,
+                                rows,
+                                cols,
+                                dna=dna,
+                                n_cpu=n_cpu,
+                                cache_dir=cache_dir,
+                                threshold=threshold)
+
+    keep = pwids >= threshold
+    distances_bwtn_centroids = csr_matrix(
+        (np.ones(np.sum(keep), dtype=np.int64), (rows[keep], cols[keep])),
+        shape=(ncentroids, ncentroids))
 
     return distances_bwtn_centroids, centroid_to_index
 
 
+def kmer_codes(sequence, k, dna=False):
+    """Integer codes of the distinct k-mers in a sequence. K-mers containing
+    ambiguous characters are skipped and DNA k-mers are canonical, as the
+    alignment considers both strands."""
+    if len(sequence) < k:
+        return np.zeros(0, dtype=np.int64)
+    if dna:
+        alphabet = dna_kmer_alphabet
+        base = 4
+    else:
+        alphabet = protein_kmer_alphabet
+        base = 20
+    values = alphabet[np.frombuffer(sequence.upper().encode('ascii'),
+                                    dtype=np.uint8)]
+    windows = np.lib.stride_tricks.sliding_window_view(values, k)
+    windows = windows[np.all(windows >= 0, axis=1)]
+    powers = base**np.arange(k - 1, -1, -1, dtype=np.int64)
+    codes = windows @ powers
+    if dna:
+        codes = np.minimum(codes, (3 - windows[:, ::-1]) @ powers)
+    return np.unique(codes)
+
+
+def kmer_candidate_pairs(sequences,
+                         threshold,
+                         dna=False,
+                         k=None,
+                         min_shared=2,
+                         block_size=2000):
+    """Finds pairs of sequences that may have at least the threshold
+    identity by counting shared k-mers, as a faster alternative to running
+    iterative_cdhit.
+
+    Two sequences at identity t are expected to share about t^k of the
+    k-mers of the shorter sequence. Pairs sharing at least a quarter as many
+    (and at least min_shared) are returned.
+
+    Args:
+        sequences (list)
+            Sequences to compare
+        threshold (float)
+            Identity threshold that will be applied to the candidates
+        dna (bool)
+            Whether the sequences are DNA
+        k (int)
+            k-mer length (default 11 for DNA and 5 for protein)
+
+    Returns:
+        rows (numpy.ndarray)
+            Index of the first sequence of each candidate pair
+        cols (numpy.ndarray)
+            Index of the second sequence, always greater than the first
+    """
+    if k is None:
+        k = 11 if dna else 5
+
+    codes = [kmer_codes(seq, k, dna) for seq in sequences]
+    nkmers = np.array([len(c) for c in codes], dtype=np.int64)
+    indptr = np.zeros(len(sequences) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(nkmers)
+    if len(sequences) == 0 or indptr[-1] == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    # renumber k-mers to keep the matrix small
+    kmer_ids = np.unique(np.concatenate(codes), return_inverse=True)[1]
+    kmer_matrix = csr_matrix(
+        (np.ones(indptr[-1], dtype=np.int32), kmer_ids, indptr),
+        shape=(len(sequences), kmer_ids.max() + 1))
+    kmer_matrix_t = kmer_matrix.T.tocsr()
+
+    expected_fraction = 0.25 * threshold**k
+    rows = []
+    cols = []
+    # count shared k-mers a block of sequences at a time to limit memory
+    for start in range(0, len(sequences), block_size):
+        shared = (kmer_matrix[start:(start + block_size)] @ kmer_matrix_t).tocoo()
+        r = shared.row.astype(np.int64) + start
+        c = shared.col.astype(np.int64)
+        needed = np.maximum(
+            min_shared,
+            np.floor(expected_fraction * np.minimum(nkmers[r], nkmers[c])))
+        keep = (c > r) & (shared.data >= needed)
+        rows.append(r[keep])
+        cols.append(c[keep])
+
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    order = np.lexsort((cols, rows))
+
+    return rows[order], cols[order]
+
+
+def pairwise_identities(sequences,
+                        rows,
+                        cols,
+                        dna=False,
+                        n_cpu=1,
+                        cache_dir=None,
+                        threshold=None,
+                        batches_per_cpu=4):
+    """Calculates the identity of many pairs of sequences in one parallel
+    call.
+
+    Pairs are split into batches of roughly equal alignment cost so that a
+    few long sequences do not leave the other workers idle, and each batch is
+    sent with only the sequences it needs.
+
+    Args:
+        sequences (list)
+            Sequences to compare
+        rows (numpy.ndarray)
+            Index of the first sequence of each pair
+        cols (numpy.ndarray)
+            Index of the second sequence of each pair
+        dna (bool)
+            Whether the sequences are DNA (both strands are compared)
+        n_cpu (int)
+            Number of worker processes
+        cache_dir (str)
+            Optional directory of previously calculated identities. Only
+            pairs that are not found there are aligned, and these are then
+            added to it. Pairs found to be below a threshold are cached as
+            such and are not aligned again for the same or a higher
+            threshold.
+        threshold (float)
+            Optional identity threshold. Alignments are stopped early once
+            it can no longer be reached and these pairs are given an
+            identity of 0.
+
+    Returns:
+        pwids (numpy.ndarray)
+            Identity of each pair as calculated by run_pw
+    """
+    if cache_dir is not None:
+        keys = pairwise_cache_keys(sequences, rows, cols, dna)
+        cache_keys, cache_pwids, cache_exact = load_pairwise_cache(cache_dir)
+        pwids, found = lookup_pairwise_cache(cache_keys, cache_pwids,
+                                             cache_exact, keys, threshold)
+        missing = np.flatnonzero(~found)
+        pwids[missing] = pairwise_identities(sequences,
+                                             rows[missing],
+                                             cols[missing],
+                                             dna=dna,
+                                             n_cpu=n_cpu,
+                                             threshold=threshold,
+                                             batches_per_cpu=batches_per_cpu)
+        exact = np.ones(len(missing), dtype=bool)
+        saved = pwids[missing]
+        if threshold is not None:
+            # identities below the threshold are not exact, so the threshold
+            # is kept as an upper bound instead
+            exact = saved >= threshold
+            saved[~exact] = threshold
+        save_pairwise_cache(cache_dir, keys[missing], saved, exact)
+        return pwids
+
+    npairs = len(rows)
+    pwids = np.zeros(npairs, dtype=float)
+    if npairs == 0:
+        return pwids
+
+    # edlib is roughly linear in the band size times the sequence length
+    lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+    cost = np.cumsum(
+        np.minimum(lengths[rows], lengths[cols]) *
+        np.maximum(lengths[rows], lengths[cols]) + 1)
+    nbatches = min(npairs, max(1, n_cpu * batches_per_cpu))
+    bounds = np.searchsorted(cost, cost[-1] * np.arange(1, nbatches) /
+                             float(nbatches))
+    bounds = np.unique(np.concatenate([[0], bounds, [npairs]]))
+
+    batches = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        index, inverse = np.unique(np.concatenate(
+            [rows[start:end], cols[start:end]]),
+                                   return_inverse=True)
+        batches.append(([sequences[i] for i in index],
+                        inverse[:(end - start)], inverse[(end - start):]))
+
+    results = Parallel(n_jobs=n_cpu)(
+        delayed(run_pw_batch)(batch_seqs, batch_rows, batch_cols, dna,
+                              threshold)
+        for batch_seqs, batch_rows, batch_cols in batches)
+
+    for start, end, batch_pwids in zip(bounds[:-1], bounds[1:], results):
+        pwids[start:end] = batch_pwids
+
+    return pwids
+
+
+def pairwise_cache_keys(sequences, rows, cols, dna):
+    """64 bit keys identifying the contents of each pair of sequences and the
+    type of comparison"""
+    prefix = PAIRWISE_CACHE_VERSION + (b"dna" if dna else b"protein")
+    digests = {}
+    for i in np.unique(np.concatenate([rows, cols])):
+        digests[i] = hashlib.blake2b(sequences[i].encode(),
+                                     digest_size=16).digest()
+    return np.fromiter(
+        (int.from_bytes(
+            hashlib.blake2b(prefix + digests[r] + digests[c],
+                            digest_size=8).digest(), 'little')
+         for r, c in zip(rows, cols)),
+        dtype=np.uint64,
+        count=len(rows))
+
+
+def load_pairwise_cache(cache_dir, max_shards=32):
+    """Loads the cached identities written by previous runs, merging them into
+    a single file if many runs have added to the cache.
+
+    Returns:
+        keys (numpy.ndarray)
+            Sorted pair keys (see pairwise_cache_keys)
+        pwids (numpy.ndarray)
+            Identity of each pair, or an upper bound on it if not exact
+        exact (numpy.ndarray)
+            Whether each identity is exact
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    shards = sorted(glob.glob(os.path.join(cache_dir, "pairwise_*.npz")))
+    all_keys = [np.zeros(0, dtype=np.uint64)]
+    all_pwids = [np.zeros(0, dtype=float)]
+    all_exact = [np.zeros(0, dtype=bool)]
+    loaded = []
+    for shard in shards:
+        try:
+            with np.load(shard) as data:
+                keys = data['keys']
+                pwids = data['pwids']
+                if 'exact' in data.files:
+                    exact = data['exact']
+                else:
+                    # older caches only hold exact identities
+                    exact = np.ones(len(keys), dtype=bool)
+            all_keys.append(keys)
+            all_pwids.append(pwids)
+            all_exact.append(exact)
+            loaded.append(shard)
+        except (OSError, ValueError, KeyError, EOFError):
+            # ignore files that are incomplete or were removed by another run
+            continue
+    keys = np.concatenate(all_keys)
+    pwids = np.concatenate(all_pwids)
+    exact = np.concatenate(all_exact)
+
+    # keep one entry per pair, preferring exact identities and then the
+    # lowest upper bound
+    order = np.lexsort((pwids, ~exact, keys))
+    keys, index = np.unique(keys[order], return_index=True)
+    pwids = pwids[order][index]
+    exact = exact[order][index]
+
+    if len(loaded) > max_shards:
+        save_pairwise_cache(cache_dir, keys, pwids, exact)
+        for shard in loaded:
+            try:
+                os.remove(shard)
+            except FileNotFoundError:
+                pass
+
+    return keys, pwids, exact
+
+
+def lookup_pairwise_cache(cache_keys,
+                          cache_pwids,
+                          cache_exact,
+                          keys,
+                          threshold=None):
+    """Finds the identities of pairs in the cache. Pairs only known to be
+    below an upper bound are found if the threshold is at least as high, and
+    are given an identity of 0 as for alignments stopped early."""
+    pwids = np.zeros(len(keys), dtype=float)
+    if len(cache_keys) == 0:
+        return pwids, np.zeros(len(keys), dtype=bool)
+    pos = np.minimum(np.searchsorted(cache_keys, keys), len(cache_keys) - 1)
+    found = cache_keys[pos] == keys
+    exact = found & cache_exact[pos]
+    pwids[exact] = cache_pwids[pos[exact]]
+    if threshold is None:
+        return pwids, exact
+    return pwids, exact | (found & (cache_pwids[pos] <= threshold))
+
+
+def save_pairwise_cache(cache_dir, keys, pwids, exact):
+    if len(keys) == 0:
+        return
+    # write to a temporary file first so that concurrent runs never see a
+    # partially written shard
+    temp_file = tempfile.NamedTemporaryFile(delete=False,
+                                            dir=cache_dir,
+                                            suffix=".tmp")
+    with temp_file:
+        np.savez(temp_file, keys=keys, pwids=pwids, exact=exact)
+    os.replace(temp_file.name,
+               os.path.join(cache_dir,
+                            "pairwise_" + uuid.uuid4().hex + ".npz"))
+    return
+
+
+def run_pw_batch(sequences, rows, cols, dna, threshold=None):
+    """Identities of a batch of pairs. If a threshold is given, alignments
+    are stopped as soon as it can no longer be reached and those pairs are
+    given an identity of 0, otherwise run_pw is used for every pair."""
+    pwids = np.zeros(len(rows), dtype=float)
+    if threshold is None:
+        for i, (r, c) in enumerate(zip(rows, cols)):
+            pwids[i] = run_pw(sequences[r], sequences[c], r, c, dna)[2]
+        return pwids
+
+    if dna:
+        equalities = dna_equalities
+        revcomps = [str(Seq(seq).reverse_complement()) for seq in sequences]
+    else:
+        equalities = protein_equalities
+    lengths = [len(seq) for seq in sequences]
+
+    for i, (r, c) in enumerate(zip(rows, cols)):
+        if lengths[r] > lengths[c]:
+            r, c = c, r
+        if lengths[r] == 0:
+            continue
+        length = float(lengths[r])
+        # largest edit distance that still reaches the threshold
+        k = min(int((1.0 - threshold) * length) + 1, int(0.5 * length))
+        while k >= 0 and 1.0 - k / length < threshold:
+            k -= 1
+        if k < 0:
+            continue
+        dist = edlib.align(sequences[r],
+                           sequences[c],
+                           mode="HW",
+                           task='distance',
+                           k=k,
+                           additionalEqualities=equalities)['editDistance']
+        if dna and dist != 0:
+            # the reverse strand only matters if it is a closer match
+            rev_dist = edlib.align(
+                revcomps[r],
+                sequences[c],
+                mode="HW",
+                task='distance',
+                k=k if dist == -1 else dist - 1,
+                additionalEqualities=equalities)['editDistance']
+            if rev_dist != -1:
+                dist = rev_dist
+        if dist != -1:
+            pwids[i] = 1.0 - dist / length
+    return pwids
+
+
 def run_pw(seqA, seqB, n1, n2, dna):
 
     if len(seqA) > len(seqB):
@@ -529,8 +1293,7 @@ def run_pw(seqA, seqB, n1, n2, dna):
                               mode="HW",
                               task='distance',
                               k=0.5 * len(seqA),
-                              additionalEqualities=[('A', 'N'), ('C', 'N'),
-                                                    ('G', 'N'), ('T', 'N')])
+                              additionalEqualities=dna_equalities)
             if aln['editDistance'] == -1:
                 pqid = max(pwid, 0.0)
             else:
@@ -541,20 +1304,7 @@ def run_pw(seqA, seqB, n1, n2, dna):
                           mode="HW",
                           task='distance',
                           k=0.5 * len(seqA),
-                          additionalEqualities=[('*', 'X'), ('A', 'X'),
-                                                ('C', 'X'), ('B', 'X'),
-                                                ('E', 'X'), ('D', 'X'),
-                                                ('G', 'X'), ('F', 'X'),
-                                                ('I', 'X'), ('H', 'X'),
-                                                ('K', 'X'), ('M', 'X'),
-                                                ('L', 'X'), ('N', 'X'),
-                                                ('Q', 'X'), ('P', 'X'),
-                                                ('S', 'X'), ('R', 'X'),
-                                                ('T', 'X'), ('W', 'X'),
-                                                ('V', 'X'), ('Y', 'X'),
-                                                ('X', 'X'), ('Z', 'X'),
-                                                ('D', 'B'), ('N', 'B'),
-                                                ('E', 'Z'), ('Q', 'Z')])
+                          additionalEqualities=protein_equalities)
         if aln['editDistance'] == -1:
             pwid = 0.0
         else:
@@ -6,7 +6,7 @@ from collections import defaultdict, deque, Counter
 from panaroo.cdhit import is_valid
 from itertools import chain, combinations
 import numpy as np
-from scipy.sparse import csr_matrix, csc_matrix
+from scipy.sparse import csr_matrix, csc_matrix, coo_matrix
 from scipy.sparse.csgraph import connected_components, shortest_path
 from scipy.stats import mode
 from tqdm import tqdm
@@ -58,34 +58,112 @@ def mod_bfs_edges(G, source, depth_limit=None):
             queue.popleft()
 
 
-def single_linkage(G, distances_bwtn_centroids, centroid_to_index, neighbours):
+def centroid_adjacency(distances_bwtn_centroids):
+    """Adjacency lists (indptr, indices) of the centroid distance graph. Every
+    stored entry of the matrix is an edge and is included in both
+    directions, as in connected_components(directed=False)."""
+    distances = coo_matrix(distances_bwtn_centroids)
+    n = distances.shape[0]
+    rows = np.concatenate([distances.row, distances.col])
+    cols = np.concatenate([distances.col, distances.row])
+    adjacency = csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)),
+                           shape=(n, n))
+    return adjacency.indptr, adjacency.indices
+
+
+def single_linkage(G, adjacency, centroid_to_index, neighbours):
+    """Groups neighbouring nodes that share a centroid or have centroids that
+    are linked in the distance graph (see centroid_adjacency).
+
+    Clusters and their nodes are returned in the same order as taking the
+    connected components of the neighbourhood's distance sub-matrix and then
+    joining the components of each node's centroids.
+    """
+    indptr, indices = adjacency
     index = []
     neigh_array = []
     for neigh in neighbours:
         for sid in G.nodes[neigh]['centroid']:
             index.append(centroid_to_index[sid])
             neigh_array.append(neigh)
-    index = np.array(index, dtype=int)
-    neigh_array = np.array(neigh_array)
-
-    n_components, labels = connected_components(
-        csgraph=distances_bwtn_centroids[index][:, index],
-        directed=False,
-        return_labels=True)
-    # labels = labels[index]
+    n = len(index)
+
+    # edges between the neighbourhood's centroids
+    local = np.unique(np.array(index, dtype=np.int64))
+    starts = indptr[local]
+    lengths = indptr[local + 1] - starts
+    offsets = np.arange(lengths.sum()) + np.repeat(
+        starts - np.cumsum(lengths) + lengths, lengths)
+    src = np.repeat(local, lengths)
+    dst = indices[offsets]
+    found = np.minimum(np.searchsorted(local, dst), len(local) - 1)
+    keep = local[found] == dst
+
+    # union find over the positions of each centroid in the neighbourhood
+    positions = defaultdict(list)
+    for p, c in enumerate(index):
+        positions[c].append(p)
+    parent = list(range(n))
+
+    def find(p):
+        while parent[p] != p:
+            parent[p] = parent[parent[p]]
+            p = parent[p]
+        return p
+
+    for c, d in zip(src[keep].tolist(), dst[keep].tolist()):
+        root = find(positions[c][0])
+        for p in positions[c] + positions[d]:
+            parent[find(p)] = root
+
+    # number components by their first position
+    component = {}
+    labels = []
+    for p in range(n):
+        labels.append(component.setdefault(find(p), len(component)))
+
+    # join the components of each node, relabelling as connected_components
+    # output would be
+    label_of = list(range(len(component)))
+    label_members = {l: [l] for l in label_of}
+    node_positions = defaultdict(list)
+    for p, neigh in enumerate(neigh_array):
+        node_positions[neigh].append(p)
     for neigh in neighbours:
-        l = list(set(labels[neigh_array == neigh]))
-        if len(l) > 1:
-            for i in l[1:]:
-                labels[labels == i] = l[0]
+        l = list(set([label_of[labels[p]] for p in node_positions[neigh]]))
+        for i in l[1:]:
+            for comp in label_members[i]:
+                label_of[comp] = l[0]
+            label_members[l[0]] += label_members.pop(i)
 
-    clusters = [
-        del_dups(list(neigh_array[labels == i])) for i in np.unique(labels)
-    ]
+    cluster_nodes = defaultdict(list)
+    for p, neigh in enumerate(neigh_array):
+        cluster_nodes[label_of[labels[p]]].append(neigh)
+    clusters = [del_dups(cluster_nodes[l]) for l in sorted(cluster_nodes)]
 
     return (clusters)
 
 
+def symmetric_pair_keys(distances_bwtn_centroids):
+    """Sorted 64 bit keys (i * n + j) of the nonzero entries of a square
+    sparse matrix, with each entry included in both orientations"""
+    n = distances_bwtn_centroids.shape[0]
+    rows, cols = distances_bwtn_centroids.nonzero()
+    rows = rows.astype(np.int64)
+    cols = cols.astype(np.int64)
+    return np.unique(np.concatenate([rows * n + cols, cols * n + rows]))
+
+
+def any_pair_in(pair_keys, n, index_pairs):
+    """Whether any of a list of (i, j) index pairs is in pair_keys"""
+    if len(index_pairs) == 0 or len(pair_keys) == 0:
+        return False
+    query = np.array(index_pairs, dtype=np.int64)
+    query = query[:, 0] * n + query[:, 1]
+    pos = np.minimum(np.searchsorted(pair_keys, query), len(pair_keys) - 1)
+    return bool(np.any(pair_keys[pos] == query))
+
+
 # @profile
 def collapse_families(G,
                       seqid_to_centroid,
@@ -99,7 +177,9 @@ def collapse_families(G,
                       distances_bwtn_centroids=None,
                       centroid_to_index=None,
                       depths = [1, 2, 3],
-                      search_genome_ids = None):
+                      search_genome_ids = None,
+                      pairwise_cache=None,
+                      prefilter="cdhit"):
 
     node_count = max(list(G.nodes())) + 10
 
@@ -109,7 +189,19 @@ def collapse_families(G,
         threshold = [0.99, 0.95, 0.9, 0.8, 0.7, 0.6, 0.5]
 
     # precluster for speed
-    if correct_mistranslations:
+    if prefilter == "kmer" and (correct_mistranslations
+                                or distances_bwtn_centroids is None):
+        # candidate pairs are found from shared k-mers by pwdist_edlib
+        distances_bwtn_centroids, centroid_to_index = pwdist_edlib(
+            G,
+            None,
+            dna_error_threshold if correct_mistranslations else
+            family_threshold,
+            dna=correct_mistranslations,
+            n_cpu=n_cpu,
+            cache_dir=pairwise_cache,
+            prefilter="kmer")
+    elif correct_mistranslations:
         cdhit_clusters = iterative_cdhit(G,
                                          outdir,
                                          thresholds=threshold,
@@ -117,18 +209,30 @@ def collapse_families(G,
                                          quiet=True,
                                          dna=True,
                                          word_length=7,
-                                         accurate=False)
+                                         accurate=False,
+                                         cache_dir=pairwise_cache)
         distances_bwtn_centroids, centroid_to_index = pwdist_edlib(
-            G, cdhit_clusters, dna_error_threshold, dna=True, n_cpu=n_cpu)
+            G,
+            cdhit_clusters,
+            dna_error_threshold,
+            dna=True,
+            n_cpu=n_cpu,
+            cache_dir=pairwise_cache)
     elif distances_bwtn_centroids is None:
         cdhit_clusters = iterative_cdhit(G,
                                          outdir,
                                          thresholds=threshold,
                                          n_cpu=n_cpu,
                                          quiet=True,
-                                         dna=False)
+                                         dna=False,
+                                         cache_dir=pairwise_cache)
         distances_bwtn_centroids, centroid_to_index = pwdist_edlib(
-            G, cdhit_clusters, family_threshold, dna=False, n_cpu=n_cpu)
+            G,
+            cdhit_clusters,
+            family_threshold,
+            dna=False,
+            n_cpu=n_cpu,
+            cache_dir=pairwise_cache)
 
     # keep track of centroids for each sequence. Need this to resolve clashes
     seqid_to_index = {}
@@ -140,9 +244,9 @@ def collapse_families(G,
             else:
                 seqid_to_index[sid] = centroid_to_index[seqid_to_centroid[sid]]
 
-    nonzero_dist = distances_bwtn_centroids.nonzero()
-    nonzero_dist = set([(i, j)
-                        for i, j in zip(nonzero_dist[0], nonzero_dist[1])])
+    ncentroids = distances_bwtn_centroids.shape[0]
+    nonzero_dist = symmetric_pair_keys(distances_bwtn_centroids)
+    adjacency = centroid_adjacency(distances_bwtn_centroids)
 
     node_mem_index = {}
     for n in G.nodes():
@@ -183,8 +287,8 @@ def collapse_families(G,
                 ] + [node]
 
                 # find clusters
-                clusters = single_linkage(G, distances_bwtn_centroids,
-                                          centroid_to_index, neighbours)
+                clusters = single_linkage(G, adjacency, centroid_to_index,
+                                          neighbours)
 
                 for cluster in clusters:
 
@@ -272,20 +376,16 @@ def collapse_families(G,
                                                     break
 
                                         if shouldmerge:
-                                            for imem in mem_inter:
-                                                for sidA in node_mem_index[nA][
-                                                        imem]:
-                                                    for sidB in node_mem_index[
-                                                            nB][imem]:
-                                                        if ((
-                                                                sidA, sidB
-                                                        ) in nonzero_dist) or (
-                                                            (sidB, sidA) in
-                                                                nonzero_dist):
-                                                            shouldmerge = False
-                                                            break
-                                                    if not shouldmerge: break
-                                                if not shouldmerge: break
+                                            # don't merge if the centroids of
+                                            # any shared member are similar
+                                            if any_pair_in(
+                                                    nonzero_dist, ncentroids,
+                                                [(sidA, sidB)
+                                                 for imem in mem_inter
+                                                 for sidA in node_mem_index[nA]
+                                                 [imem] for sidB in
+                                                 node_mem_index[nB][imem]]):
+                                                shouldmerge = False
 
                                         if shouldmerge:
                                             sub_clust.append(nB)
@@ -295,8 +395,8 @@ def collapse_families(G,
                             if len(sub_clust) > 1:
 
                                 clique_clusters = single_linkage(
-                                    G, distances_bwtn_centroids,
-                                    centroid_to_index, sub_clust)
+                                    G, adjacency, centroid_to_index,
+                                    sub_clust)
                                 for clust in clique_clusters:
                                     if len(clust) <= 1: continue
                                     node_count += 1
@@ -8,10 +8,10 @@ from panaroo.cdhit import align_dna_cdhit
 from panaroo.isvalid import del_dups
 from joblib import Parallel, delayed
 import os
-import gffutils as gff
-from io import StringIO
 import edlib
 from .merge_nodes import delete_node, remove_member_from_node
+from .gene_store import open_gene_data, GeneStoreWriter
+from .prokka import read_annotation, annotation_name
 from tqdm import tqdm
 import re
 
@@ -28,20 +28,19 @@ def find_missing(G,
                  pairwise_id_thresh,
                  n_cpu,
                  remove_by_consensus=False,
+                 input_format="auto",
+                 table=11,
                  verbose=True):
 
     # Iterate over each genome file checking to see if any missing accessory genes
     #  can be found.
 
     # generate mapping between internal nodes and gff ids
-    id_to_gff = {}
-    with open(gene_data_file, 'r') as infile:
-        next(infile)
-        for line in infile:
-            line = line.split(",")
-            if line[2] in id_to_gff:
-                raise NameError("Duplicate internal ids!")
-            id_to_gff[line[2]] = line[3]
+    gene_data = open_gene_data(gene_data_file)
+    clustering_ids = list(gene_data.column("clustering_id"))
+    id_to_gff = dict(zip(clustering_ids, gene_data.column("annotation_id")))
+    if len(id_to_gff) < len(clustering_ids):
+        raise NameError("Duplicate internal ids!")
 
     # identify nodes that have been merged at the protein level
     merged_ids = {}
@@ -52,18 +51,16 @@ def find_missing(G,
                 merged_ids[sid] = node
 
     merged_nodes = defaultdict(dict)
-    with open(gene_data_file, 'r') as infile:
-        next(infile)
-        for line in infile:
-            line = line.split(",")
-            if line[2] in merged_ids:
-                mem = int(sid.split("_")[0])
-                if merged_ids[line[2]] in merged_nodes[mem]:
-                    merged_nodes[mem][merged_ids[line[2]]] = G.nodes[
-                        merged_ids[line[2]]]["dna"][G.nodes[merged_ids[
-                            line[2]]]['maxLenId']]
-                else:
-                    merged_nodes[mem][merged_ids[line[2]]] = line[5]
+    for merged_id in merged_ids:
+        if merged_id not in gene_data: continue
+        mem = int(sid.split("_")[0])
+        if merged_ids[merged_id] in merged_nodes[mem]:
+            merged_nodes[mem][merged_ids[merged_id]] = G.nodes[
+                merged_ids[merged_id]]["dna"][G.nodes[merged_ids[merged_id]]
+                                              ['maxLenId']]
+        else:
+            merged_nodes[mem][merged_ids[merged_id]] = gene_data.get(
+                merged_id, "dna_sequence")
 
     # iterate through nodes to identify accessory genes for searching
     # these are nodes missing a member with at least one neighbour that has that member
@@ -100,7 +97,8 @@ def find_missing(G,
                             search_radius=search_radius,
                             prop_match=prop_match,
                             pairwise_id_thresh=pairwise_id_thresh,
-                            merge_id_thresh=merge_id_thresh)
+                            merge_id_thresh=merge_id_thresh,
+                            input_format=input_format)
         for member, gff_handle in tqdm(enumerate(gff_file_handles),
                                        disable=(not verbose))))
 
@@ -110,8 +108,8 @@ def find_missing(G,
     hits_trans_dict = {}
     for member, hits in enumerate(all_hits):
         hits_trans_dict[member] = Parallel(n_jobs=n_cpu)(
-            delayed(translate_to_match)(hit[1], G.nodes[hit[0]]["protein"][0])
-            for hit in hits)
+            delayed(translate_to_match)(hit[1], G.nodes[hit[0]]["protein"][0],
+                                        table) for hit in hits)
 
     # remove nodes that conflict (overlap)
     nodes_by_size = sorted([(G.nodes[node]['size'], node)
@@ -170,10 +168,13 @@ def find_missing(G,
     if verbose:
         print("Updating output...")
 
+    # release the memory mapped gene data before appending to it
+    del gene_data
+
     n_found = 0
     with open(dna_seq_file, 'a') as dna_out:
         with open(prot_seq_file, 'a') as prot_out:
-            with open(gene_data_file, 'a') as data_out:
+            with GeneStoreWriter(gene_data_file, mode='a') as data_out:
                 for member, hits in enumerate(all_hits):
                     i = -1
                     for node, dna_hit in hits:
@@ -193,14 +194,13 @@ def find_missing(G,
                         prot_out.write(">" + str(member) + "_refound_" +
                                        str(n_found) + "\n" + hit_protein +
                                        "\n")
-                        data_out.write(",".join([
-                            os.path.splitext(
-                                os.path.basename(
-                                    gff_file_handles[member]))[0], "",
+                        gene_row = [
+                            annotation_name(gff_file_handles[member]), "",
                             str(member) + "_refound_" + str(n_found),
                             str(member) + "_refound_" +
                             str(n_found), hit_protein, dna_hit, "", ""
-                        ]) + "\n")
+                        ]
+                        data_out.append(gene_row)
                         G.nodes[node]['seqIDs'] |= set(
                             [str(member) + "_refound_" + str(n_found)])
                         n_found += 1
@@ -219,43 +219,29 @@ def search_gff(node_search_dict,
                prop_match=0.2,
                pairwise_id_thresh=0.95,
                merge_id_thresh=0.7,
-               n_cpu=1):
-
-    gff_handle = open(gff_handle_name, 'r')
+               n_cpu=1,
+               input_format="auto"):
 
     # sort sets to fix order
     conflicts = sorted(conflicts)
     for node in node_search_dict:
         node_search_dict[node] = sorted(node_search_dict[node])
 
-    split = gff_handle.read().replace(',','').split("##FASTA\n")
     node_locs = {}
 
-    if len(split) != 2:
-        raise NameError("File does not appear to be in GFF3 format!")
-
-    # load fasta
-    contigs = {}
-    max_seq_len = 0
-    with StringIO(split[1]) as temp_fasta:
-        for record in SeqIO.parse(temp_fasta, 'fasta'):
-            contigs[record.id] = np.array(list(str(record.seq)))
-            max_seq_len = max(max_seq_len, len(contigs[record.id]))
-
-    # load gff annotation
-    parsed_gff = gff.create_db("\n".join(
-        [l for l in split[0].splitlines() if '##sequence-region' not in l]),
-                               dbfn=":memory:",
-                               force=True,
-                               keep_order=True,
-                               from_string=True)
+    # load the genome and the location of each annotated gene
+    contigs, genes = read_annotation(gff_handle_name, input_format)
+    max_seq_len = max([len(seq) for seq in contigs.values()] + [0])
+    gene_locs = {}
+    for scaffold_id, start, stop, entry_id, _, _, _ in genes:
+        gene_locs[entry_id] = (scaffold_id, start, stop)
 
     # mask regions that already have genes and convert back to string
     seen = set()
     for node, geneid in conflicts:
-        gene = parsed_gff[geneid]
-        start = min(gene.start, gene.end)
-        end = max(gene.start, gene.end)
+        gene = gene_locs[geneid]
+        start = min(gene[1], gene[2])
+        end = max(gene[1], gene[2])
 
         if node in merged_nodes:
             db_seq = contigs[gene[0]][max(0, (start -
@@ -278,27 +264,24 @@ def search_gff(node_search_dict,
             node_locs[node] = [gene[0], [start - 1, end]]
 
     for node, geneid in conflicts:
-        gene = parsed_gff[geneid]
-        start = min(gene.start, gene.end)
-        end = max(gene.start, gene.end)
+        gene = gene_locs[geneid]
+        start = min(gene[1], gene[2])
+        end = max(gene[1], gene[2])
         # contigs[gene[0]][(start - 1):end] = "X"
 
         if (gene[0], start - 1, end) in seen:
             raise NameError("Duplicate entry!!!")
         seen.add((gene[0], start - 1, end))
 
-    for sid in contigs:
-        contigs[sid] = "".join(list(contigs[sid]))
-
     # search for matches
     hits = []
     for node in node_search_dict:
         best_hit = ""
         best_loc = None
         for search in node_search_dict[node]:
-            gene = parsed_gff[search[1]]
-            start = min(gene.start, gene.end)
-            end = max(gene.start, gene.end)
+            gene = gene_locs[search[1]]
+            start = min(gene[1], gene[2])
+            end = max(gene[1], gene[2])
             db_seq = contigs[gene[0]][max(0, (start -
                                               search_radius)):(end +
                                                                search_radius)]
@@ -320,8 +303,6 @@ def search_gff(node_search_dict,
         if (best_loc is not None) and (best_hit != ""):
             node_locs[node] = best_loc
 
-    gff_handle.close()
-
     return [hits, node_locs, max_seq_len]
 
 
@@ -443,7 +424,7 @@ def search_dna(db_seq, search_sequence, prop_match, pairwise_id_thresh,
     return seq, loc
 
 
-def translate_to_match(hit, target_prot):
+def translate_to_match(hit, target_prot, table=11):
 
     if hit == "": return ""
 
@@ -451,8 +432,8 @@ def translate_to_match(hit, target_prot):
     dna_seqs = [hit, reverse_complement(hit)]
 
     proteins = [
-        translate(s[i:].ljust(len(s[i:]) + (3 - len(s[i:]) % 3), 'N'))
-        for i in range(3) for s in dna_seqs
+        translate(s[i:].ljust(len(s[i:]) + (3 - len(s[i:]) % 3), 'N'),
+                  table=table) for i in range(3) for s in dna_seqs
     ]
 
     search_set = set(
@@ -0,0 +1,400 @@
+import os
+import mmap
+import numpy as np
+
+GENE_DATA_COLUMNS = [
+    "gff_file", "scaffold_name", "clustering_id", "annotation_id",
+    "prot_sequence", "dna_sequence", "gene_name", "description"
+]
+
+GENE_DATA_HEADER = (",".join(GENE_DATA_COLUMNS) + "\n").encode('utf-8')
+
+# start offset of each field of a row in gene_data.csv followed by the end
+# offset of the row
+ROW_INDEX_FILE = "rows.idx"
+
+# (genome, contig, position) of each gene written during pre-processing
+GENE_ORDER_FILE = "gene_order.idx"
+
+# whether the protein of each row has an internal stop codon, as one byte
+STOPS_FILE = "stops.idx"
+
+# number of rows, size in bytes and modification time of the table when it
+# was indexed, and the number of rows in the gene order index
+META_FILE = "meta.idx"
+
+
+def gene_store_dir(gene_data_file):
+    """Location of the index files that accompany a gene_data.csv"""
+    return os.path.splitext(gene_data_file)[0] + "_store"
+
+
+def index_rows(data, offset=0):
+    """Locates the fields of the newline terminated rows in a block of
+    gene_data.csv.
+
+    Returns:
+        index (numpy.ndarray)
+            Array of shape (n_rows, len(GENE_DATA_COLUMNS) + 1) giving the
+            start offset of each field followed by the end offset of the row
+    """
+    data = np.frombuffer(data, dtype=np.uint8) if isinstance(
+        data, bytes) else data
+    n_fields = len(GENE_DATA_COLUMNS)
+    ends = np.flatnonzero(data == ord("\n")) + 1
+    commas = np.flatnonzero(data == ord(","))
+    if (len(commas) != len(ends) * (n_fields - 1)) or np.any(
+            np.searchsorted(ends, commas, side='right') != np.repeat(
+                np.arange(len(ends)), n_fields - 1)):
+        raise ValueError("Each row of gene_data.csv must have " +
+                         str(n_fields) + " comma separated fields")
+    index = np.empty((len(ends), n_fields + 1), dtype=np.int64)
+    index[:, 0] = 0
+    index[1:, 0] = ends[:-1]
+    index[:, 1:n_fields] = commas.reshape(-1, n_fields - 1) + 1
+    index[:, n_fields] = ends
+    return index + offset
+
+
+def find_internal_stops(data, index, chunk_size=1 << 26):
+    """Whether the protein of each row has a stop codon before its last few
+    residues, as tested by '*' in prot_sequence[1:-3].
+
+    index gives the field offsets of the rows within data (see index_rows).
+    """
+    data = np.frombuffer(data, dtype=np.uint8)
+    c = GENE_DATA_COLUMNS.index("prot_sequence")
+    starts = index[:, c]
+    ends = index[:, c + 1] - 1
+    stops = np.zeros(len(index), dtype=bool)
+    if len(index) == 0:
+        return stops
+    # stop codons are rare, so find all of them and keep those that fall
+    # inside a protein
+    for chunk in range(int(index[0, 0]), int(index[-1, -1]), chunk_size):
+        stars = chunk + np.flatnonzero(
+            data[chunk:min(chunk + chunk_size, index[-1, -1])] == ord("*"))
+        rows = np.searchsorted(starts, stars, side='right') - 1
+        inside = (rows >= 0) & (stars > starts[rows]) & (stars <
+                                                          ends[rows] - 3)
+        stops[rows[inside]] = True
+    return stops
+
+
+def read_meta(store_dir):
+    meta_file = os.path.join(store_dir, META_FILE)
+    if not os.path.isfile(meta_file) or os.path.getsize(meta_file) != 32:
+        return None
+    return np.fromfile(meta_file, dtype='<i8')
+
+
+class GeneStoreWriter:
+    """Writes gene_data.csv along with the offsets of the fields of each row
+    as little endian int64 in ROW_INDEX_FILE and whether each protein has an
+    internal stop codon in STOPS_FILE, so values can later be read without
+    parsing the whole table. Opening with mode='a' appends to an existing
+    table. The position of each gene may optionally be recorded in
+    GENE_ORDER_FILE.
+
+    The size and modification time of the table are recorded in META_FILE on
+    closing, so that readers can tell whether the index is still valid.
+    """
+    def __init__(self, gene_data_file, mode='w'):
+        if mode not in ('w', 'a'):
+            raise ValueError("mode must be one of 'w' or 'a'")
+        self.gene_data_file = gene_data_file
+        self.store_dir = gene_store_dir(gene_data_file)
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.order_handle = None
+        self.pending = []
+        index_file = os.path.join(self.store_dir, ROW_INDEX_FILE)
+        stops_file = os.path.join(self.store_dir, STOPS_FILE)
+        order_file = os.path.join(self.store_dir, GENE_ORDER_FILE)
+        meta_file = os.path.join(self.store_dir, META_FILE)
+
+        if mode == 'a' and os.path.isfile(gene_data_file):
+            store = GeneStore.from_csv(gene_data_file)
+            self.n_rows = len(store)
+            self.n_order = 0 if store.order is None else len(store.order)
+            self.order_mode = 'ab'
+            if not store.indexed:
+                # index tables written without one or changed since
+                store.index.astype('<i8').tofile(index_file)
+            if store.stops is None:
+                store.internal_stops().tofile(stops_file)
+            if store.order is None and os.path.isfile(order_file):
+                os.remove(order_file)
+            del store
+            self.offset = os.path.getsize(gene_data_file)
+            self.data_handle = open(gene_data_file, 'ab')
+            self.index_handle = open(index_file, 'ab')
+            self.stops_handle = open(stops_file, 'ab')
+        else:
+            self.n_rows = 0
+            self.n_order = 0
+            self.order_mode = 'wb'
+            self.data_handle = open(gene_data_file, 'wb')
+            self.index_handle = open(index_file, 'wb')
+            self.stops_handle = open(stops_file, 'wb')
+            self.data_handle.write(GENE_DATA_HEADER)
+            self.offset = len(GENE_DATA_HEADER)
+        # the index is only trusted again once the table has been closed
+        if os.path.isfile(meta_file):
+            os.remove(meta_file)
+
+    def append_block(self, block, gene_order=None):
+        """Appends pre-formatted rows of gene_data.csv, given as UTF-8 bytes
+        with each row terminated by a newline.
+
+        gene_order is an optional (n, 3) integer array of the genome, contig
+        and position within the contig of each gene.
+        """
+        self.flush()
+        if len(block) == 0:
+            return
+        if gene_order is not None and self.n_order != self.n_rows:
+            raise ValueError("The gene order can only be recorded for " +
+                             "rows that follow other ordered rows")
+        index = index_rows(block)
+        self.data_handle.write(block)
+        (index + self.offset).astype('<i8').tofile(self.index_handle)
+        find_internal_stops(block, index).tofile(self.stops_handle)
+        self.offset += len(block)
+        self.n_rows += len(index)
+        if gene_order is not None:
+            if self.order_handle is None:
+                self.order_handle = open(
+                    os.path.join(self.store_dir, GENE_ORDER_FILE),
+                    self.order_mode)
+            gene_order = np.asarray(gene_order).astype('<i8')
+            gene_order.tofile(self.order_handle)
+            self.n_order += len(gene_order)
+        return
+
+    def append_rows(self, rows):
+        self.flush()
+        self.append_block("".join(",".join(row) + "\n"
+                                  for row in rows).encode('utf-8'))
+        return
+
+    def append(self, row):
+        # single rows are buffered so they can be indexed together
+        self.pending.append(row)
+        if len(self.pending) >= 10000:
+            self.flush()
+        return
+
+    def flush(self):
+        if len(self.pending) > 0:
+            rows = self.pending
+            self.pending = []
+            self.append_rows(rows)
+        return
+
+    def close(self):
+        self.flush()
+        self.data_handle.close()
+        self.index_handle.close()
+        self.stops_handle.close()
+        if self.order_handle is not None:
+            self.order_handle.close()
+        stat = os.stat(self.gene_data_file)
+        np.array([self.n_rows, stat.st_size, stat.st_mtime_ns, self.n_order],
+                 dtype='<i8').tofile(os.path.join(self.store_dir, META_FILE))
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class GeneStore:
+    """Read access to the rows of a memory mapped gene_data.csv (see
+    open_gene_data).
+
+    Values are sliced from the table using the field offsets in index, so
+    sequences can be looked up by clustering id without reading the whole
+    table into memory.
+    """
+    def __init__(self, data, index, order=None, stops=None, indexed=False):
+        self.data = data
+        self.index = index
+        self.order = order
+        self.stops = stops
+        self.indexed = indexed
+        self.n_rows = len(index)
+        self._sorted_ids = None
+        self._sorted_rows = None
+
+    @classmethod
+    def from_csv(cls, gene_data_file):
+        with open(gene_data_file, 'rb') as infile:
+            if os.path.getsize(gene_data_file) > 0:
+                data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = b""
+        if data[:len(GENE_DATA_HEADER)] != GENE_DATA_HEADER:
+            raise ValueError(gene_data_file +
+                             " does not start with the gene_data.csv header")
+
+        # only use the index if the table is unchanged since it was written
+        store_dir = gene_store_dir(gene_data_file)
+        n_columns = len(GENE_DATA_COLUMNS) + 1
+        stat = os.stat(gene_data_file)
+        meta = read_meta(store_dir)
+        index_file = os.path.join(store_dir, ROW_INDEX_FILE)
+        stops_file = os.path.join(store_dir, STOPS_FILE)
+        order_file = os.path.join(store_dir, GENE_ORDER_FILE)
+        index = None
+        order = None
+        stops = None
+        if (meta is not None and meta[1] == stat.st_size
+                and meta[2] == stat.st_mtime_ns
+                and os.path.isfile(index_file) and
+                os.path.getsize(index_file) == meta[0] * n_columns * 8):
+            index = np.fromfile(index_file,
+                                dtype='<i8').reshape(-1, n_columns)
+            if len(index) > 0 and (index[0, 0] != len(GENE_DATA_HEADER)
+                                   or index[-1, -1] != stat.st_size):
+                index = None
+            else:
+                if os.path.isfile(stops_file) and os.path.getsize(
+                        stops_file) == meta[0]:
+                    stops = np.fromfile(stops_file, dtype=bool)
+                if meta[3] > 0 and os.path.isfile(order_file) and (
+                        os.path.getsize(order_file) == meta[3] * 3 * 8):
+                    order = np.fromfile(order_file,
+                                        dtype='<i8').reshape(-1, 3)
+        indexed = index is not None
+        if not indexed:
+            index = index_rows(
+                np.frombuffer(data, dtype=np.uint8)[len(GENE_DATA_HEADER):],
+                len(GENE_DATA_HEADER))
+        return cls(data, index, order, stops, indexed)
+
+    def __len__(self):
+        return self.n_rows
+
+    def _offsets(self, column):
+        c = GENE_DATA_COLUMNS.index(column)
+        return self.index[:, c], self.index[:, c + 1] - 1
+
+    def row(self, row):
+        return self.data[self.index[row, 0]:self.index[row, -1] -
+                         1].decode('utf-8').split(",")
+
+    def value(self, row, column):
+        c = GENE_DATA_COLUMNS.index(column)
+        return self.data[self.index[row, c]:self.index[row, c + 1] -
+                         1].decode('utf-8')
+
+    def _gather(self, starts, ends, chunk_size=1 << 22):
+        """Yields the bytes from start to end, inclusive, of each row in
+        chunks of around chunk_size bytes, along with the first and last row
+        of the chunk and the end of each row within it."""
+        data = np.frombuffer(self.data, dtype=np.uint8)
+        lengths = np.maximum(ends - starts + 1, 0)
+        cumulative = np.cumsum(lengths)
+        first = 0
+        while first < len(starts):
+            done = cumulative[first - 1] if first > 0 else 0
+            last = max(
+                first + 1,
+                int(np.searchsorted(cumulative, done + chunk_size, 'right')))
+            chunk_ends = cumulative[first:last] - done
+            positions = np.arange(chunk_ends[-1], dtype=np.int64) + np.repeat(
+                starts[first:last] - (chunk_ends - lengths[first:last]),
+                lengths[first:last])
+            yield first, last, data[positions], chunk_ends
+            first = last
+
+    def column(self, column):
+        """Iterates over the values of a column in row order"""
+        # each value is followed by a separator, so the values of a chunk of
+        # rows can be decoded together
+        for first, last, values, chunk_ends in self._gather(
+                *self._offsets(column)):
+            values[chunk_ends - 1] = ord("\n")
+            yield from values.tobytes().decode('utf-8').split("\n")[:-1]
+
+    def columns(self, *columns):
+        """Iterates over tuples of values from several columns"""
+        return zip(*[self.column(c) for c in columns])
+
+    def lengths(self, column):
+        """Length in bytes of the values of a column"""
+        starts, ends = self._offsets(column)
+        return ends - starts
+
+    def column_array(self, column):
+        """Values of a column as a numpy bytes array. Intended for short
+        columns such as the ids, as each value is padded to the longest."""
+        starts, ends = self._offsets(column)
+        lengths = ends - starts
+        width = max(int(lengths.max()) if len(lengths) > 0 else 0, 1)
+        positions = np.arange(width, dtype=np.int64)
+        inside = positions[None, :] < lengths[:, None]
+        values = np.frombuffer(self.data, dtype=np.uint8)[np.where(
+            inside, starts[:, None] + positions[None, :], 0)]
+        values[~inside] = 0
+        return np.ascontiguousarray(values).view('S' + str(width)).ravel()
+
+    def internal_stops(self):
+        """Whether each protein has a stop codon before its last few
+        residues, as tested by '*' in prot_sequence[1:-3]"""
+        if self.stops is None:
+            self.stops = find_internal_stops(self.data, self.index)
+        return self.stops
+
+    def gene_order(self):
+        """Returns the (genome, contig, position) of the genes written during
+        pre-processing as an (n, 3) int64 array, in row order.
+
+        Tables without a gene order index fall back to parsing the clustering
+        ids, which requires them to be of the form genome_contig_position.
+        """
+        if self.order is None:
+            self.order = np.array(
+                [cid.split("_") for cid in self.column("clustering_id")],
+                dtype=np.int64).reshape(-1, 3)
+        return self.order
+
+    def row_index(self, clustering_id):
+        if self._sorted_ids is None:
+            ids = self.column_array("clustering_id")
+            rows = np.argsort(ids, kind='stable')
+            ids = ids[rows]
+            if np.any(ids[1:] == ids[:-1]):
+                raise NameError("Duplicate internal ids!")
+            self._sorted_ids = ids
+            self._sorted_rows = rows
+        key = clustering_id.encode('utf-8')
+        i = np.searchsorted(self._sorted_ids, key)
+        if i == len(self._sorted_ids) or self._sorted_ids[i] != key:
+            raise KeyError(clustering_id)
+        return int(self._sorted_rows[i])
+
+    def __contains__(self, clustering_id):
+        try:
+            self.row_index(clustering_id)
+        except KeyError:
+            return False
+        return True
+
+    def get(self, clustering_id, column):
+        return self.value(self.row_index(clustering_id), column)
+
+    def to_csv(self, gene_data_file):
+        with open(gene_data_file, 'wb') as outfile:
+            outfile.write(GENE_DATA_HEADER)
+            outfile.write(self.data[len(GENE_DATA_HEADER):])
+        return
+
+
+def open_gene_data(gene_data_file):
+    """Memory maps a gene_data.csv file, using the index written alongside
+    it if the table is unchanged since and otherwise locating the fields of
+    each row with a single scan."""
+    return GeneStore.from_csv(gene_data_file)
@@ -15,6 +15,7 @@ from Bio.Align.Applications import MafftCommandline
 from Bio.Align.Applications import ClustalOmegaCommandline
 import Bio.Application
 
+
 def check_aligner_install(aligner):
     """Checks for the presence of the specified aligned in $PATH
 
@@ -1,228 +1,131 @@
-from Bio import SeqIO
-from collections import Counter, defaultdict
+from collections import defaultdict
+from itertools import islice
 import networkx as nx
-from panaroo.clean_network import collapse_paralogs
 import numpy as np
-from scipy.sparse import csc_matrix, lil_matrix
 from intbitset import intbitset
+from panaroo.gene_store import open_gene_data
+from panaroo.cdhit import read_cdhit_clusters
 
 
-def generate_network(cluster_file, data_file, prot_seq_file, all_dna=False):
+def group_indices(inverse, n_groups):
+    """Returns the positions belonging to each group as slices of one array.
+
+    Group k holds order[bounds[k]:bounds[k + 1]], in their original order.
+    """
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.zeros(n_groups + 1, dtype=np.int64)
+    np.cumsum(np.bincount(inverse, minlength=n_groups), out=bounds[1:])
+    return order, bounds
+
+
+def generate_network(cluster_file, data_file, all_dna=False):
 
     # associate sequences with their clusters
-    seq_to_cluster = {}
-    seqid_to_centroid = {}
+    ids, labels, is_rep = read_cdhit_clusters(cluster_file)
+    seq_to_cluster = dict(zip(ids, labels.tolist()))
     cluster_centroids = {}
-    cluster_members = defaultdict(list)
-    with open(cluster_file, 'r') as infile:
-        for line in infile:
-            if line[0] == ">":
-                cluster = int(line.strip().split()[-1])
-            else:
-                seq = line.split(">")[1].split("...")[0]
-                seq_to_cluster[seq] = cluster
-                cluster_members[cluster].append(seq.split("_")[0])
-                if line.strip().split()[-1] == "*":
-                    cluster_centroids[cluster] = seq
-
-    # determine paralogs if required
-    paralogs = set()
-    for clust in cluster_members:
-        genomes = [s.split("_")[0] for s in cluster_members[clust]]
-        if len(genomes) != len(set(genomes)):
-            paralogs.add(clust)
-
-    # Load meta data such as sequence and annotation
+    for seq, cluster, rep in zip(ids, labels.tolist(), is_rep):
+        if rep:
+            cluster_centroids[cluster] = seq
+    n_clusters = len(np.unique(labels))
+
+    # clusters with more than one gene from the same genome are paralogs
+    n_labels = int(labels.max(initial=-1)) + 1
+    clstr_genomes = np.array([int(s.split("_")[0]) for s in ids],
+                             dtype=np.int64)
+    distinct = np.unique(np.stack((labels, clstr_genomes)), axis=1)
+    paralogs = (np.bincount(labels, minlength=n_labels) >
+                np.bincount(distinct[0], minlength=n_labels))
+
+    # Load meta data such as sequence and annotation for each centroid
     cluster_centroid_data = {}
-    centroid_ids = set(cluster_centroids.values())
-    with open(data_file, 'r') as infile:
-        next(infile)  # skip header
-        for line in infile:
-            line = line.strip().split(",")
-            if line[2] in centroid_ids:
-                # this is a cluster centroid so keep it
-                cluster_centroid_data[seq_to_cluster[line[2]]] = {
-                    'prot_sequence': line[4],
-                    'dna_sequence': line[5],
-                    'annotation': line[6],
-                    'description': line[7],
-                }
-
-    # create a dictionary of indexes for paralog context
-    centroid_index = {}
-    for i, centroid in enumerate(cluster_centroids.values()):
-        centroid_index[centroid] = i
-    n_centroids = len(centroid_index.keys())
-
-    # load headers which contain adjacency information
-    seq_ids = []
-    for rec in SeqIO.parse(prot_seq_file, "fasta"):
-        seq_ids.append(str(rec.id))
-
-    # build graph using adjacency information and optionally split paralogs
-    G = nx.Graph()
+    gene_data = open_gene_data(data_file)
+    for cluster, centroid in cluster_centroids.items():
+        row = gene_data.row_index(centroid)
+        cluster_centroid_data[cluster] = (
+            gene_data.value(row, 'prot_sequence'),
+            gene_data.value(row, 'dna_sequence'),
+            gene_data.value(row, 'gene_name'),
+            gene_data.value(row, 'description').rstrip(),
+        )
+
+    # the gene order index written during pre-processing holds the
+    # adjacency information, its rows match those of the gene data
+    gene_order = gene_data.gene_order()
+    n_seqs = len(gene_order)
+    seq_ids = list(islice(gene_data.column('clustering_id'), n_seqs))
+    seq_cluster = np.fromiter((seq_to_cluster[id] for id in seq_ids),
+                              dtype=np.int64,
+                              count=n_seqs)
+    genome = np.asarray(gene_order[:, 0], dtype=np.int64)
+    contig_start = gene_order[:, 2] == 0
+    seqid_to_centroid = {
+        id: cluster_centroids[c]
+        for id, c in zip(seq_ids, seq_cluster.tolist())
+    }
+
+    # every paralogous gene gets its own node, numbered after the clusters
+    is_paralog = paralogs[seq_cluster]
+    seq_node = np.where(is_paralog, n_clusters + np.cumsum(is_paralog),
+                        seq_cluster)
     centroid_context = defaultdict(list)
-    n_nodes = len(cluster_members)
-    temp_nodes = []
-    prev = None
-
-    for i, id in enumerate(seq_ids):
-        current_cluster = seq_to_cluster[id]
-        seqid_to_centroid[id] = cluster_centroids[current_cluster]
-        loc = id.split("_")
-        genome_id = int(loc[0])
-        if loc[-1] == "0":
-            # we're at the start of a contig
-            if prev is not None: G.nodes[prev]['hasEnd'] = True
-            prev = current_cluster
-            if G.has_node(prev) and (prev not in paralogs):
-                G.nodes[prev]['size'] += 1
-                G.nodes[prev]['members'].add(genome_id)
-                G.nodes[prev]['seqIDs'].add(id)
-                G.nodes[prev]['hasEnd'] = True
-                G.nodes[current_cluster]['lengths'].append(
-                    len(cluster_centroid_data[prev]['dna_sequence']))
-                if all_dna:
-                    G.nodes[prev]['dna'] += [
-                        cluster_centroid_data[prev]['dna_sequence']
-                    ]
-            else:
-                if prev in paralogs:
-                    # create a new paralog
-                    n_nodes += 1
-                    prev = n_nodes
-                    temp_nodes.append(prev)
-                    centroid_context[
-                        cluster_centroids[current_cluster]].append(
-                            [prev, genome_id])
-                # add non paralog node
-                G.add_node(
-                    prev,
-                    size=1,
-                    centroid=[cluster_centroids[current_cluster]],
-                    maxLenId=0,
-                    members=intbitset([genome_id]),
-                    seqIDs=set([id]),
-                    hasEnd=True,
-                    protein=[
-                        cluster_centroid_data[current_cluster]['prot_sequence']
-                    ],
-                    dna=[
-                        cluster_centroid_data[current_cluster]['dna_sequence']
-                    ],
-                    annotation=cluster_centroid_data[current_cluster]
-                    ['annotation'],
-                    description=cluster_centroid_data[current_cluster]
-                    ['description'],
-                    lengths=[
-                        len(cluster_centroid_data[current_cluster]
-                            ['dna_sequence'])
-                    ],
-                    longCentroidID=(len(cluster_centroid_data[current_cluster]
-                                        ['dna_sequence']),
-                                    cluster_centroids[current_cluster]),
-                    paralog=(current_cluster in paralogs),
-                    mergedDNA=False)
-        else:
-            is_paralog = current_cluster in paralogs
-            if is_paralog:
-                # create a new paralog
-                n_nodes += 1
-                neighbour = n_nodes
-                temp_nodes.append(neighbour)
-                centroid_context[cluster_centroids[current_cluster]].append(
-                    [neighbour, genome_id])
-                G.add_node(
-                    neighbour,
-                    size=1,
-                    centroid=[cluster_centroids[current_cluster]],
-                    maxLenId=0,
-                    members=intbitset([genome_id]),
-                    seqIDs=set([id]),
-                    hasEnd=False,
-                    protein=[
-                        cluster_centroid_data[current_cluster]['prot_sequence']
-                    ],
-                    dna=[
-                        cluster_centroid_data[current_cluster]['dna_sequence']
-                    ],
-                    annotation=cluster_centroid_data[current_cluster]
-                    ['annotation'],
-                    description=cluster_centroid_data[current_cluster]
-                    ['description'],
-                    lengths=[
-                        len(cluster_centroid_data[current_cluster]
-                            ['dna_sequence'])
-                    ],
-                    longCentroidID=(len(cluster_centroid_data[current_cluster]
-                                        ['dna_sequence']),
-                                    cluster_centroids[current_cluster]),
-                    paralog=True,
-                    mergedDNA=False)
-                # add edge between nodes
-                G.add_edge(prev,
-                           neighbour,
-                           size=1,
-                           members=intbitset([genome_id]))
-                prev = neighbour
-            else:
-                if not G.has_node(current_cluster):
-                    # we need to add the gene in
-                    G.add_node(
-                        current_cluster,
-                        size=1,
-                        centroid=[cluster_centroids[current_cluster]],
-                        maxLenId=0,
-                        members=intbitset([genome_id]),
-                        seqIDs=set([id]),
-                        hasEnd=False,
-                        protein=[
-                            cluster_centroid_data[current_cluster]
-                            ['prot_sequence']
-                        ],
-                        dna=[
-                            cluster_centroid_data[current_cluster]
-                            ['dna_sequence']
-                        ],
-                        annotation=cluster_centroid_data[current_cluster]
-                        ['annotation'],
-                        description=cluster_centroid_data[current_cluster]
-                        ['description'],
-                        lengths=[
-                            len(cluster_centroid_data[current_cluster]
-                                ['dna_sequence'])
-                        ],
-                        longCentroidID=(len(
-                            cluster_centroid_data[current_cluster]
-                            ['dna_sequence']),
-                                        cluster_centroids[current_cluster]),
-                        paralog=is_paralog,
-                        mergedDNA=False)
-                    # add edge between nodes
-                    G.add_edge(prev,
-                               current_cluster,
-                               size=1,
-                               members=intbitset([genome_id]))
-                else:
-                    G.nodes[current_cluster]['size'] += 1
-                    G.nodes[current_cluster]['members'].add(genome_id)
-                    G.nodes[current_cluster]['seqIDs'].add(id)
-                    G.nodes[current_cluster]['lengths'].append(
-                        len(cluster_centroid_data[current_cluster]
-                            ['dna_sequence']))
-                    if all_dna:
-                        G.nodes[current_cluster]['dna'] += [
-                            cluster_centroid_data[current_cluster]
-                            ['dna_sequence']
-                        ]
-                    if G.has_edge(prev, current_cluster):
-                        G[prev][current_cluster]['size'] += 1
-                        G[prev][current_cluster]['members'].add(genome_id)
-                    else:
-                        G.add_edge(prev,
-                                   current_cluster,
-                                   size=1,
-                                   members=intbitset([genome_id]))
-                prev = current_cluster
+    for i in np.flatnonzero(is_paralog).tolist():
+        centroid_context[cluster_centroids[int(seq_cluster[i])]].append(
+            [int(seq_node[i]), int(genome[i])])
+
+    # genes starting a contig or preceding the start of the next one are ends
+    at_end = contig_start.copy()
+    at_end[:-1] |= contig_start[1:]
+
+    # group genes by node, keeping nodes in order of first appearance
+    nodes, first, inverse = np.unique(seq_node,
+                                      return_index=True,
+                                      return_inverse=True)
+    node_genes, gene_bounds = group_indices(inverse, len(nodes))
+    has_end = np.bincount(inverse, weights=at_end,
+                          minlength=len(nodes)) > 0
+
+    # consecutive genes on a contig are joined by an edge
+    links = np.flatnonzero(~contig_start[1:]) + 1
+    u = seq_node[links - 1]
+    v = seq_node[links]
+    stride = int(seq_node.max(initial=0)) + 1
+    keys = np.minimum(u, v) * stride + np.maximum(u, v)
+    _, edge_first, edge_inverse, edge_size = np.unique(keys,
+                                                       return_index=True,
+                                                       return_inverse=True,
+                                                       return_counts=True)
+    link_order, link_bounds = group_indices(edge_inverse, len(edge_first))
+
+    # build the graph once, in the order nodes and edges were first seen
+    G = nx.Graph()
+    for k in np.argsort(first, kind='stable').tolist():
+        genes = node_genes[gene_bounds[k]:gene_bounds[k + 1]]
+        cluster = int(seq_cluster[genes[0]])
+        prot, dna, annotation, description = cluster_centroid_data[cluster]
+        size = len(genes)
+        G.add_node(int(nodes[k]),
+                   size=size,
+                   centroid=[cluster_centroids[cluster]],
+                   maxLenId=0,
+                   members=intbitset(genome[genes].tolist()),
+                   seqIDs=set(seq_ids[i] for i in genes.tolist()),
+                   hasEnd=bool(has_end[k]),
+                   protein=[prot],
+                   dna=[dna] * (size if all_dna else 1),
+                   annotation=annotation,
+                   description=description,
+                   lengths=[len(dna)] * size,
+                   longCentroidID=(len(dna), cluster_centroids[cluster]),
+                   paralog=bool(paralogs[cluster]),
+                   mergedDNA=False)
+
+    for k in np.argsort(edge_first, kind='stable').tolist():
+        link = edge_first[k]
+        members = links[link_order[link_bounds[k]:link_bounds[k + 1]]]
+        G.add_edge(int(u[link]),
+                   int(v[link]),
+                   size=int(edge_size[k]),
+                   members=intbitset(genome[members].tolist()))
 
     return G, centroid_context, seqid_to_centroid
@@ -330,4 +330,4 @@ def generate_summary_stats(output_dir):
                   "Total genes\t(0% <= strains <= 100%)\t" + str(total_genes))
         outfile.write(output)
 
-    return True
\ No newline at end of file
+    return True
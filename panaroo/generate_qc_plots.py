@@ -13,6 +13,7 @@ from plotly import tools
 
 from .isvalid import *
 from .__init__ import __version__
+from .prokka import open_compressed, annotation_name
 
 
 def get_mash_dist(input_gffs, outdir, n_cpu=1, quiet=True):
@@ -55,7 +56,7 @@ def get_mash_dist(input_gffs, outdir, n_cpu=1, quiet=True):
 
     # get simplified file names
     file_names = [
-        os.path.splitext(os.path.basename(gff))[0] for gff in input_gffs
+        annotation_name(gff) for gff in input_gffs
     ]
 
     # clean up
@@ -130,13 +131,13 @@ def plot_ngenes(input_gffs, outdir):
 
     # get simplified file names
     file_names = [
-        os.path.splitext(os.path.basename(gff))[0] for gff in input_gffs
+        annotation_name(gff) for gff in input_gffs
     ]
 
     # count genes
     ngenes = np.zeros(len(input_gffs))
     for i, gff_file in enumerate(input_gffs):
-        with open(gff_file, 'r') as gff:
+        with open_compressed(gff_file) as gff:
             for line in gff:
                 if "##FASTA" in line: break
                 if "##" == line[:2]: continue
@@ -187,13 +188,13 @@ def plot_ncontigs(input_gffs, outdir):
 
     # get simplified file names
     file_names = [
-        os.path.splitext(os.path.basename(gff))[0] for gff in input_gffs
+        annotation_name(gff) for gff in input_gffs
     ]
 
     # count genes
     ncontigs = np.zeros(len(input_gffs))
     for i, gff_file in enumerate(input_gffs):
-        with open(gff_file, 'r') as gff:
+        with open_compressed(gff_file) as gff:
             in_fasta = False
             for line in gff:
                 if in_fasta and (line[0] == ">"):
@@ -270,7 +271,7 @@ def run_mash_screen(gff, mash_ref, outdir):
 
 def get_mash_contam(input_gffs, mash_ref, n_cpu, outdir):
     file_names = [
-        os.path.splitext(os.path.basename(gff))[0] for gff in input_gffs
+        annotation_name(gff) for gff in input_gffs
     ]
 
     genome_hits = Parallel(n_jobs=n_cpu)(
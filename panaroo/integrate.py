@@ -44,6 +44,32 @@ def get_options(
                          help="input gff file of new genome to be integrated",
                          type=str)
 
+    io_opts.add_argument(
+        "--pairwise-cache",
+        dest="pairwise_cache",
+        help=("directory in which to cache pairwise identities between " +
+              "centroid sequences and the cd-hit clusters used to find them. " +
+              "Pairs already compared in previous runs are not aligned " +
+              "again. The cd-hit clusters are only reused through this " +
+              "cache and are recomputed in every run without it"),
+        type=str,
+        default=None)
+
+    io_opts.add_argument(
+        "--input-format",
+        dest="input_format",
+        help="format of the input GFF3 file (default=auto)",
+        choices=['auto', 'prokka', 'bakta', 'prodigal', 'refseq'],
+        default='auto')
+
+    io_opts.add_argument(
+        "--translation-table",
+        dest="table",
+        help=("NCBI translation table used to translate the annotated " +
+              "genes (default=11)"),
+        type=int,
+        default=11)
+
     io_opts.add_argument("-o",
                          "--out_dir",
                          dest="output_dir",
@@ -83,6 +109,25 @@ def get_options(
                           default=0.95,
                           type=float)
 
+    matching.add_argument(
+        "--prefilter",
+        dest="prefilter",
+        help=("method used to find candidate pairs of centroids before " +
+              "aligning them. 'cdhit' clusters the centroids with cd-hit " +
+              "at decreasing thresholds while 'kmer' compares shared " +
+              "k-mers without calling cd-hit (default=cdhit)"),
+        choices=['cdhit', 'kmer'],
+        default='cdhit')
+
+    matching.add_argument(
+        "--incremental",
+        dest="incremental",
+        help=("add the genes of the new genome to the gene clusters saved " +
+              "in the input directory using cd-hit-2d instead of " +
+              "clustering the genes of the pre-existing graph again"),
+        action='store_true',
+        default=False)
+
     matching.add_argument("--merge_paralogs",
                           dest="merge_paralogs",
                           help="don't split paralogs",
@@ -251,7 +296,9 @@ def main():
                          output_dir=temp_dir,
                          filter_seqs=args.filter_invalid,
                          quiet=args.quiet,
-                         n_cpu=args.n_cpu)
+                         n_cpu=args.n_cpu,
+                         input_format=args.input_format,
+                         table=args.table)
 
     cd_hit_out = temp_dir + "combined_protein_cdhit_out.txt"
 
@@ -265,7 +312,6 @@ def main():
     single_gml, centroid_contexts_single, seqid_to_centroid_single = generate_network(
         cluster_file=cd_hit_out + ".clstr",
         data_file=temp_dir + "gene_data.csv",
-        prot_seq_file=temp_dir + "combined_protein_CDS.fasta",
         all_dna=args.all_seq_in_graph)
 
     if not args.quiet: print("Reformatting network")
@@ -289,7 +335,10 @@ def main():
                  merge_single=True,
                  depths=[1],
                  n_cpu=args.n_cpu,
-                 quiet=args.quiet)
+                 quiet=args.quiet,
+                 pairwise_cache=args.pairwise_cache,
+                 prefilter=args.prefilter,
+                 incremental=args.incremental)
 
     G = nx.read_gml(args.output_dir + "final_graph.gml")
 
@@ -14,7 +14,8 @@ from intbitset import intbitset
 
 from .isvalid import *
 from .__init__ import __version__
-from .cdhit import run_cdhit
+from .cdhit import run_cdhit, run_cdhit_2d, read_cdhit_cluster_lines, read_cdhit_cluster_lists, write_cdhit_clusters
+from .gene_store import GENE_DATA_COLUMNS, GeneStoreWriter, open_gene_data
 from .generate_output import *
 from .clean_network import *
 from .merge_nodes import merge_node_cluster, gen_edge_iterables, gen_node_iterables, iter_del_dups, del_dups
@@ -93,65 +94,136 @@ def load_graphs(graph_files, n_cpu=1):
     return graphs, isolate_names, id_mapping
 
 
+def saved_clustering(directory):
+    """The cd-hit clusters saved by an earlier run in directory, if any"""
+    clstr_file = directory + "combined_protein_cdhit_out.txt.clstr"
+    if os.path.isfile(clstr_file):
+        return clstr_file
+    return None
+
+
+def load_saved_clusters(clstr_file, id_mapping):
+    """Reads saved cd-hit clusters, renaming the sequences that are still in
+    the graph and placing the representative of each cluster first. If the
+    representative has been filtered, the longest remaining member is used
+    instead, as cd-hit would have chosen."""
+    clusters = []
+    for members in read_cdhit_cluster_lines(clstr_file):
+        cluster = []
+        rep = 0
+        rep_length = -1
+        for sid, line in members:
+            if sid not in id_mapping: continue  #its been filtered
+            if line.endswith("*"):
+                length = math.inf
+            else:
+                length = int(line.split("\t")[1].split(",")[0][:-2])
+            if length > rep_length:
+                rep = len(cluster)
+                rep_length = length
+            cluster.append(id_mapping[sid])
+        if len(cluster) == 0: continue
+        clusters.append([cluster[rep]] + cluster[:rep] + cluster[rep + 1:])
+    return clusters
+
+
 def cluster_centroids(graphs,
                       outdir,
                       directories,
                       id_mapping,
                       len_dif_percent=0.95,
                       identity_threshold=0.98,
-                      n_cpu=1):
+                      n_cpu=1,
+                      incremental=False):
 
     # create the files we will need
-    temp_input_file = tempfile.NamedTemporaryFile(delete=False, dir=outdir)
-    temp_input_file.close()
-    temp_output_file = tempfile.NamedTemporaryFile(delete=False, dir=outdir)
-    temp_output_file.close()
+    temp_dir = tempfile.TemporaryDirectory(dir=outdir)
+    input_file = os.path.join(temp_dir.name, "input.fasta")
+    output_file = os.path.join(temp_dir.name, "output.fasta")
+
+    # if requested, keep the largest clustering saved by an earlier run and
+    # only cluster the remaining sequences
+    clusters = []
+    base = None
+    if incremental:
+        saved = [(i, saved_clustering(d)) for i, d in enumerate(directories)]
+        saved = [(i, clstr_file) for i, clstr_file in saved
+                 if clstr_file is not None]
+        if len(saved) > 0:
+            base, clstr_file = max(saved,
+                                   key=lambda x: os.path.getsize(x[1]))
+            clusters = load_saved_clusters(clstr_file, id_mapping[base])
+    clustered = set(itertools.chain.from_iterable(clusters))
+    rep_seqs = {cluster[0]: None for cluster in clusters}
 
     # create input for cdhit
     orig_ids = {}
     ids_len_stop = {}
-    with open(temp_input_file.name, 'w') as outfile:
+    with open(input_file, 'w') as outfile:
         for i, d in enumerate(directories):
-            with open(d + "gene_data.csv", 'r') as infile:
-                next(infile)
-                for line in infile:
-                    line = line.split(",")
-                    if line[2] not in id_mapping[i]:
-                        continue  #its been filtered
-                    orig_ids[id_mapping[i][line[2]]] = line[3]
-                    ids_len_stop[id_mapping[i][line[2]]] = (len(
-                        line[4]), "*" in line[4][1:-3])
-                    if "refound" in line[2]: continue
-                    outfile.write(">" + id_mapping[i][line[2]] + "\n" +
-                                  line[4] + "\n")
-
-    # Run cd-hit
-    run_cdhit(temp_input_file.name,
-              temp_output_file.name,
-              id=identity_threshold,
-              s=len_dif_percent,
-              accurate=True,
-              min_length=5,
-              n_cpu=n_cpu)
-
-    # Process output
-    clusters = []
-    with open(temp_output_file.name + ".clstr", 'r') as infile:
-        c = []
-        for line in infile:
-            if line[0] == ">":
-                clusters.append(c)
-                c = []
-            else:
-                centroid = line.split(">")[1].split("...")[0]
-                c.append(centroid)
-        clusters.append(c)
-    clusters = clusters[1:]
+            gene_data = open_gene_data(d + "gene_data.csv")
+            for row, (cid, annotation_id, prot_len, stop) in enumerate(
+                    zip(gene_data.column("clustering_id"),
+                        gene_data.column("annotation_id"),
+                        gene_data.lengths("prot_sequence").tolist(),
+                        gene_data.internal_stops().tolist())):
+                if cid not in id_mapping[i]:
+                    continue  #its been filtered
+                orig_ids[id_mapping[i][cid]] = annotation_id
+                ids_len_stop[id_mapping[i][cid]] = (prot_len, stop)
+                if "refound" in cid: continue
+                if id_mapping[i][cid] in clustered:
+                    if id_mapping[i][cid] in rep_seqs:
+                        rep_seqs[id_mapping[i][cid]] = gene_data.value(
+                            row, "prot_sequence")
+                    continue
+                outfile.write(">" + id_mapping[i][cid] + "\n" +
+                              gene_data.value(row, "prot_sequence") + "\n")
+
+    if base is not None:
+        # add new sequences to the saved clusters they match
+        db_file = os.path.join(temp_dir.name, "saved_centroids.fasta")
+        novel_file = os.path.join(temp_dir.name, "novel.fasta")
+        with open(db_file, 'w') as outfile:
+            for rep, prot in rep_seqs.items():
+                outfile.write(">" + rep + "\n" + prot + "\n")
+
+        run_cdhit_2d(db_file,
+                     input_file,
+                     novel_file,
+                     id=identity_threshold,
+                     s=len_dif_percent,
+                     s2=len_dif_percent,
+                     accurate=True,
+                     min_length=5,
+                     n_cpu=n_cpu)
+
+        rep_to_cluster = {cluster[0]: cluster for cluster in clusters}
+        for members in read_cdhit_cluster_lists(novel_file + ".clstr"):
+            reps = [sid for sid in members if sid in rep_to_cluster]
+            if len(reps) == 0: continue
+            rep_to_cluster[reps[0]] += [
+                sid for sid in members if sid not in rep_to_cluster
+            ]
+
+        # only the unmatched sequences are clustered again
+        input_file = novel_file
+
+    if os.path.getsize(input_file) > 0:
+        # Run cd-hit
+        run_cdhit(input_file,
+                  output_file,
+                  id=identity_threshold,
+                  s=len_dif_percent,
+                  accurate=True,
+                  min_length=5,
+                  n_cpu=n_cpu)
+
+        # Process output
+        clusters += read_cdhit_cluster_lists(output_file + ".clstr")
 
     # remove temporary files
-    os.remove(temp_input_file.name)
-    os.remove(temp_output_file.name)
-    os.remove(temp_output_file.name + ".clstr")
+    temp_dir.cleanup()
 
     # rename centroids
     seqid_to_centroid = {}
@@ -163,14 +235,13 @@ def cluster_centroids(graphs,
 
     centroid_to_seqs = {}
     for i, d in enumerate(directories):
-        with open(d + "gene_data.csv", 'r') as infile:
-            next(infile)
-            for line in infile:
-                line = line.split(",")
-                if line[2] not in id_mapping[i]: continue  #its been filtered
-                if id_mapping[i][line[2]] in all_centroids:
-                    centroid_to_seqs[id_mapping[i][line[2]]] = (line[4],
-                                                                line[5])
+        gene_data = open_gene_data(d + "gene_data.csv")
+        for row, cid in enumerate(gene_data.column("clustering_id")):
+            if cid not in id_mapping[i]: continue  #its been filtered
+            if id_mapping[i][cid] in all_centroids:
+                centroid_to_seqs[id_mapping[i][cid]] = (
+                    gene_data.value(row, "prot_sequence"),
+                    gene_data.value(row, "dna_sequence"))
 
     for G in graphs:
         for node in G.nodes():
@@ -256,7 +327,10 @@ def merge_graphs(directories,
                  merge_single=False,
                  depths=[1,2,3],
                  n_cpu=1,
-                 quiet=False):
+                 quiet=False,
+                 pairwise_cache=None,
+                 prefilter="cdhit",
+                 incremental=False):
 
     print(
         "Merging graphs is still under active development and may change frequently!"
@@ -279,7 +353,8 @@ def merge_graphs(directories,
         id_mapping=id_mapping,
         len_dif_percent=len_dif_percent,
         identity_threshold=pid,
-        n_cpu=n_cpu)
+        n_cpu=n_cpu,
+        incremental=incremental)
 
     # perform initial merge
     if not quiet: print("Performing inital merge...")
@@ -299,7 +374,9 @@ def merge_graphs(directories,
         n_cpu=n_cpu,
         quiet=quiet,
         depths=depths,
-        search_genome_ids=search_genome_ids)[0]
+        search_genome_ids=search_genome_ids,
+        pairwise_cache=pairwise_cache,
+        prefilter=prefilter)[0]
 
     if not quiet:
         print("Number of nodes in merged graph: ", G.number_of_nodes())
@@ -315,7 +392,9 @@ def merge_graphs(directories,
         n_cpu=n_cpu,
         quiet=quiet,
         depths=depths,
-        search_genome_ids=search_genome_ids)[0]
+        search_genome_ids=search_genome_ids,
+        pairwise_cache=pairwise_cache,
+        prefilter=prefilter)[0]
 
     if not quiet:
         print("Number of nodes in merged graph: ", G.number_of_nodes())
@@ -341,14 +420,15 @@ def merge_graphs(directories,
     orig_ids = {}
     ids_len_stop = {}
     for i, d in enumerate(directories):
-        with open(d + "gene_data.csv", 'r') as infile:
-            next(infile)
-            for line in infile:
-                line = line.split(",")
-                if line[2] not in id_mapping[i]: continue  #its been filtered
-                orig_ids[id_mapping[i][line[2]]] = line[3]
-                ids_len_stop[id_mapping[i][line[2]]] = (len(line[4]),
-                                                        "*" in line[4][1:-3])
+        gene_data = open_gene_data(d + "gene_data.csv")
+        for cid, annotation_id, prot_len, stop in zip(
+                gene_data.column("clustering_id"),
+                gene_data.column("annotation_id"),
+                gene_data.lengths("prot_sequence").tolist(),
+                gene_data.internal_stops().tolist()):
+            if cid not in id_mapping[i]: continue  #its been filtered
+            orig_ids[id_mapping[i][cid]] = annotation_id
+            ids_len_stop[id_mapping[i][cid]] = (prot_len, stop)
 
     G = generate_roary_gene_presence_absence(G,
                                              mems_to_isolates=mems_to_isolates,
@@ -393,21 +473,33 @@ def merge_graphs(directories,
 
     nx.write_gml(G, output_dir + "final_graph.gml")
 
-    # write out merged gene_data and combined_DNA_CDS files
-    with open(output_dir + "gene_data.csv", 'w') as outdata, \
-    open(output_dir + "combined_DNA_CDS.fasta", 'w') as outdna:
+    # write out merged gene_data and combined_DNA_CDS files along with the
+    # clustering of the merged genes so later merges can add to it
+    seq_clusters = defaultdict(list)
+    for sid, centroid in seqid_to_centroid.items():
+        seq_clusters[centroid].append(sid)
+    with GeneStoreWriter(output_dir + "gene_data.csv") as outdata, \
+    open(output_dir + "combined_DNA_CDS.fasta", 'w') as outdna, \
+    open(output_dir + "combined_protein_cdhit_out.txt", 'w') as outreps:
         for i, d in enumerate(directories):
-            with open(d + "gene_data.csv", 'r') as infile:
-                header = next(infile)
-                if i == 0: outdata.write(header)
-                for line in infile:
-                    line = line.strip().split(",")
-                    if line[2] not in id_mapping[i]:
-                        continue  #its been filtered
-                    line[2] = id_mapping[i][line[2]]
-                    outdata.write(",".join(line) + "\n")
-                    outdna.write(">" + line[2] + "\n")
-                    outdna.write(line[5] + "\n")
+            gene_data = open_gene_data(d + "gene_data.csv")
+            for line in gene_data.columns(*GENE_DATA_COLUMNS):
+                line = list(line)
+                line[-1] = line[-1].rstrip()
+                if line[2] not in id_mapping[i]:
+                    continue  #its been filtered
+                line[2] = id_mapping[i][line[2]]
+                outdata.append(line)
+                outdna.write(">" + line[2] + "\n")
+                outdna.write(line[5] + "\n")
+                if line[2] in seq_clusters:
+                    outreps.write(">" + line[2] + "\n" + line[4] + "\n")
+    write_cdhit_clusters(
+        [[centroid] + [sid for sid in sids if sid != centroid]
+         for centroid, sids in seq_clusters.items()],
+        {sid: ids_len_stop[sid][0]
+         for sid in seqid_to_centroid},
+        output_dir + "combined_protein_cdhit_out.txt.clstr")
 
     # #Write out core/pan-genome alignments
     if aln == "pan":
@@ -446,6 +538,17 @@ def get_options():
                          help="location of a new output directory",
                          type=lambda x: is_valid_folder(parser, x))
 
+    io_opts.add_argument(
+        "--pairwise-cache",
+        dest="pairwise_cache",
+        help=("directory in which to cache pairwise identities between " +
+              "centroid sequences and the cd-hit clusters used to find them. " +
+              "Pairs already compared in previous runs are not aligned " +
+              "again. The cd-hit clusters are only reused through this " +
+              "cache and are recomputed in every run without it"),
+        type=str,
+        default=None)
+
     matching = parser.add_argument_group('Matching')
 
     matching.add_argument("-c",
@@ -469,6 +572,26 @@ def get_options():
                           default=0.95,
                           type=float)
 
+    matching.add_argument(
+        "--prefilter",
+        dest="prefilter",
+        help=("method used to find candidate pairs of centroids before " +
+              "aligning them. 'cdhit' clusters the centroids with cd-hit " +
+              "at decreasing thresholds while 'kmer' compares shared " +
+              "k-mers without calling cd-hit (default=cdhit)"),
+        choices=['cdhit', 'kmer'],
+        default='cdhit')
+
+    matching.add_argument(
+        "--incremental",
+        dest="incremental",
+        help=("keep the largest gene clustering saved in the input " +
+              "directories and only cluster the remaining genes, adding " +
+              "them to the saved clusters they match where possible. The " +
+              "earlier runs should have used the same identity threshold"),
+        action='store_true',
+        default=False)
+
     matching.add_argument("--merge_paralogs",
                           dest="merge_paralogs",
                           help="don't split paralogs",
@@ -567,7 +690,10 @@ def main():
                  alr=args.alr,
                  core=args.core,
                  n_cpu=args.n_cpu,
-                 quiet=args.quiet)
+                 quiet=args.quiet,
+                 pairwise_cache=args.pairwise_cache,
+                 prefilter=args.prefilter,
+                 incremental=args.incremental)
 
     return
 
@@ -1,56 +1,122 @@
 #Takes .gff output from prokka and outputs combined gene/protien sequences from each isolate
 
 import os
-from collections import OrderedDict
+import sys
+import gzip
+import hashlib
+import pickle
+import tempfile
+import functools
+from collections import defaultdict
 import gffutils as gff
 from Bio import SeqIO
-from Bio.Seq import Seq
+from Bio.Seq import Seq, reverse_complement
+from Bio.Data import CodonTable
 from Bio.SeqRecord import SeqRecord
 from io import StringIO
+from urllib.parse import unquote
 import numpy as np
 from joblib import Parallel, delayed
 from tqdm import tqdm
 
-translation_table = np.array([[[b'K', b'N', b'K', b'N', b'X'],
-                               [b'T', b'T', b'T', b'T', b'T'],
-                               [b'R', b'S', b'R', b'S', b'X'],
-                               [b'I', b'I', b'M', b'I', b'X'],
-                               [b'X', b'X', b'X', b'X', b'X']],
-                              [[b'Q', b'H', b'Q', b'H', b'X'],
-                               [b'P', b'P', b'P', b'P', b'P'],
-                               [b'R', b'R', b'R', b'R', b'R'],
-                               [b'L', b'L', b'L', b'L', b'L'],
-                               [b'X', b'X', b'X', b'X', b'X']],
-                              [[b'E', b'D', b'E', b'D', b'X'],
-                               [b'A', b'A', b'A', b'A', b'A'],
-                               [b'G', b'G', b'G', b'G', b'G'],
-                               [b'V', b'V', b'V', b'V', b'V'],
-                               [b'X', b'X', b'X', b'X', b'X']],
-                              [[b'*', b'Y', b'*', b'Y', b'X'],
-                               [b'S', b'S', b'S', b'S', b'S'],
-                               [b'*', b'C', b'W', b'C', b'X'],
-                               [b'L', b'F', b'L', b'F', b'X'],
-                               [b'X', b'X', b'X', b'X', b'X']],
-                              [[b'X', b'X', b'X', b'X', b'X'],
-                               [b'X', b'X', b'X', b'X', b'X'],
-                               [b'X', b'X', b'X', b'X', b'X'],
-                               [b'X', b'X', b'X', b'X', b'X'],
-                               [b'X', b'X', b'X', b'X', b'X']]])
-
-reduce_array = np.full(200, 4)
-reduce_array[[65, 97]] = 0
-reduce_array[[67, 99]] = 1
-reduce_array[[71, 103]] = 2
-reduce_array[[84, 116]] = 3
-
-
-def translate(seq):
-
-    indices = reduce_array[np.fromstring(seq, dtype=np.int8)]
-
-    return translation_table[
-        indices[np.arange(0, len(seq), 3)], indices[np.arange(1, len(seq), 3)],
-        indices[np.arange(2, len(seq), 3)]].tostring().decode('ascii')
+from .gene_store import GeneStoreWriter
+
+# bump if the pre-processing output changes to invalidate cached genomes
+PREPROCESS_CACHE_VERSION = "3"
+
+# IUPAC nucleotide codes, any other character is treated as unknown
+NUCLEOTIDE_CODES = "ACGTRYSWKMBDHVN"
+nucleotide_array = np.full(256, len(NUCLEOTIDE_CODES))
+for i, code in enumerate(NUCLEOTIDE_CODES):
+    nucleotide_array[[ord(code), ord(code.lower())]] = i
+
+
+def open_compressed(file_name):
+    """Opens a text file for reading, transparently decompressing it if it is
+    gzip (or bgzip) compressed."""
+    with open(file_name, 'rb') as infile:
+        magic = infile.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(file_name, 'rt')
+    return open(file_name, 'r')
+
+
+def annotation_name(file_name):
+    """Genome name of an annotation file, ignoring any .gz extension"""
+    name = os.path.basename(file_name)
+    if name.endswith(".gz"):
+        name = name[:-3]
+    return os.path.splitext(name)[0]
+
+
+@functools.lru_cache(maxsize=None)
+def codon_lookup(table=11):
+    """Amino acid of every codon of IUPAC nucleotide codes, as given by
+    Bio.Seq.translate for the NCBI translation table. Codons containing
+    other characters translate to X."""
+    if table not in CodonTable.ambiguous_dna_by_id:
+        raise ValueError("Unknown translation table: " + str(table))
+    n_codes = len(NUCLEOTIDE_CODES) + 1
+    lookup = np.full((n_codes, n_codes, n_codes), b'X', dtype='S1')
+    for i, a in enumerate(NUCLEOTIDE_CODES):
+        for j, b in enumerate(NUCLEOTIDE_CODES):
+            for k, c in enumerate(NUCLEOTIDE_CODES):
+                try:
+                    lookup[i, j, k] = str(Seq(a + b + c).translate(table=table))
+                except CodonTable.TranslationError:
+                    pass
+    return lookup
+
+
+def translate_batch(sequences, table=11):
+    """Translates many coding sequences using a single codon table lookup.
+
+    Args:
+        sequences (list)
+            DNA sequences. Trailing partial codons are ignored.
+        table (int)
+            NCBI translation table
+
+    Returns:
+        proteins (list)
+            Translated sequences including any stop codons
+        internal_stop (numpy.ndarray)
+            True if a sequence has a stop codon before its final codon
+        terminal_stop (numpy.ndarray)
+            True if the final codon of a sequence is a stop codon
+    """
+    n_codons = np.array([len(s) // 3 for s in sequences], dtype=np.int64)
+    seq_starts = np.zeros(len(sequences), dtype=np.int64)
+    if len(sequences) > 1:
+        seq_starts[1:] = np.cumsum([len(s) for s in sequences[:-1]])
+    codon_ends = np.cumsum(n_codons)
+    codon_starts = codon_ends - n_codons
+
+    # position of the first base of every codon in the combined buffer
+    codon_pos = np.repeat(seq_starts - 3 * codon_starts, n_codons) + 3 * np.arange(
+        codon_ends[-1] if len(sequences) > 0 else 0, dtype=np.int64)
+
+    indices = nucleotide_array[np.frombuffer(
+        "".join(sequences).encode('ascii'), dtype=np.uint8)]
+    amino_acids = codon_lookup(table)[indices[codon_pos],
+                                      indices[codon_pos + 1],
+                                      indices[codon_pos + 2]]
+    translated = amino_acids.tobytes().decode('ascii')
+    proteins = [
+        translated[start:end] for start, end in zip(codon_starts, codon_ends)
+    ]
+
+    # count stops in each sequence using a cumulative sum
+    is_stop = amino_acids == b'*'
+    stop_count = np.zeros(len(is_stop) + 1, dtype=np.int64)
+    stop_count[1:] = np.cumsum(is_stop)
+    terminal_stop = np.zeros(len(sequences), dtype=bool)
+    has_codons = n_codons > 0
+    terminal_stop[has_codons] = is_stop[codon_ends[has_codons] - 1]
+    internal_stop = (stop_count[codon_ends] - stop_count[codon_starts] -
+                     terminal_stop) > 0
+
+    return proteins, internal_stop, terminal_stop
 
 
 #Clean other "##" starting lines from gff file, as it confuses parsers
@@ -66,25 +132,283 @@ def clean_gff_string(gff_string):
     return cleaned_gff
 
 
-def get_gene_sequences(gff_file_name, file_number, filter_seqs):
-    #Get name and separate the prokka GFF into separate GFF and FASTA files
-    if ',' in gff_file_name:
+class GFFParseError(ValueError):
+    """Raised when the streaming parser can not handle a GFF3 file and the
+    gffutils based parser should be used instead."""
+    pass
+
+
+def parse_gff_attributes(attribute_string, unescape=False):
+    attributes = {}
+    for keyval in attribute_string.split(';'):
+        if keyval == '':
+            continue
+        keyval = keyval.split('=', 1)
+        if (len(keyval) == 1) or (keyval[1] == ''):
+            # keys without a value are kept with an empty list as in gffutils
+            attributes.setdefault(keyval[0], [])
+            continue
+        if '%' in keyval[1]:
+            if not unescape:
+                # leave values that need unescaping to gffutils
+                raise GFFParseError("Unsupported GFF3 attribute: " +
+                                    keyval[1])
+            keyval[1] = unquote(keyval[1]).replace(',', '')
+        attributes.setdefault(keyval[0], []).append(keyval[1])
+    return attributes
+
+
+def extract_gene_sequences(contigs, features):
+    """Extracts the DNA sequence of each feature from a scaffold id index.
+
+    Features are grouped by scaffold so that each scaffold is looked up and
+    reverse complemented at most once, rather than once per gene.
+
+    Args:
+        contigs (dict)
+            Scaffold id to DNA sequence
+        features (list)
+            (scaffold_id, start, stop, strand) tuples with 1-based inclusive
+            coordinates
+
+    Returns:
+        gene_sequences (list)
+            DNA sequence of each feature in input order, or None if its
+            scaffold is not present
+    """
+    gene_sequences = [None] * len(features)
+
+    scaffold_features = defaultdict(list)
+    for i, feature in enumerate(features):
+        scaffold_features[feature[0]].append(i)
+
+    for scaffold_id, feature_indices in scaffold_features.items():
+        if scaffold_id not in contigs:
+            continue
+        contig = contigs[scaffold_id]
+        contig_len = len(contig)
+        contig_rc = None
+        for i in feature_indices:
+            start, stop, strand = features[i][1:]
+            if strand != "-":
+                gene_sequences[i] = contig[(start - 1):stop]
+            elif (start < 1) or (stop > contig_len) or (start > stop):
+                # coordinates outside the scaffold so slice as before
+                gene_sequences[i] = reverse_complement(
+                    contig[(start - 1):stop])
+            else:
+                if contig_rc is None:
+                    contig_rc = reverse_complement(contig)
+                gene_sequences[i] = contig_rc[(contig_len -
+                                               stop):(contig_len - start + 1)]
+
+    return gene_sequences
+
+
+# conventions of the supported annotation formats. Percent encoded attribute
+# values are decoded for formats that use them, and formats that reuse an ID
+# for each part of a CDS (as in RefSeq) have the repeats made unique.
+INPUT_FORMATS = {
+    "prokka": {
+        "unescape": False,
+        "unique_ids": False
+    },
+    "bakta": {
+        "unescape": True,
+        "unique_ids": False
+    },
+    "prodigal": {
+        "unescape": False,
+        "unique_ids": False
+    },
+    "refseq": {
+        "unescape": True,
+        "unique_ids": True
+    },
+}
+
+FASTA_EXTENSIONS = [".fna", ".fasta", ".fa", ".fas", ".fsa"]
+
+
+def detect_input_format(gff_file_name):
+    """Guesses the tool that produced a GFF3 file from its header comments.
+    Files without a recognised header are treated as Prokka output."""
+    with open_compressed(gff_file_name) as gff_file:
+        for line in gff_file:
+            if line.strip() == '' or line.startswith('##gff-version'):
+                continue
+            if line[0] != '#':
+                break
+            if 'Bakta' in line:
+                return "bakta"
+            if line.startswith('#!processor NCBI') or line.startswith(
+                    '#!annotation-source'):
+                return "refseq"
+            if line.startswith('# Sequence Data:') or line.startswith(
+                    '# Model Data:'):
+                return "prodigal"
+    return "prokka"
+
+
+def find_genome_fasta(gff_file_name):
+    """Locates the genome sequence of an annotation without a ##FASTA
+    section, ie. a file next to it with the same name and a FASTA extension
+    (optionally gzip compressed)."""
+    prefix = gff_file_name
+    if prefix.endswith(".gz"):
+        prefix = prefix[:-3]
+    prefix = os.path.splitext(prefix)[0]
+    for extension in FASTA_EXTENSIONS:
+        for suffix in ["", ".gz"]:
+            if os.path.isfile(prefix + extension + suffix):
+                return prefix + extension + suffix
+    return None
+
+
+def load_genome_fasta(gff_file_name):
+    fasta_file_name = find_genome_fasta(gff_file_name)
+    if fasta_file_name is None:
         print("Problem reading GFF3 file: ", gff_file_name)
-        raise RuntimeError("Error reading prokka input!")
+        raise RuntimeError(
+            "GFF3 file has no ##FASTA section and no genome FASTA file was " +
+            "found alongside it: " + gff_file_name)
+    contigs = {}
+    with open_compressed(fasta_file_name) as fasta_file:
+        for record in SeqIO.parse(fasta_file, 'fasta'):
+            if record.id not in contigs:
+                contigs[record.id] = str(record.seq).replace(',', '')
+    return contigs
+
+
+def stream_gff(gff_file_name, input_format="prokka"):
+    """Parses a GFF3 file in a single pass without building a gffutils
+    database. The genome is read from an embedded ##FASTA section or, for
+    formats other than Prokka, from a FASTA file alongside the annotation
+    (see find_genome_fasta).
+
+    Args:
+        gff_file_name (str)
+            Location of the GFF3 file
+        input_format (str)
+            One of INPUT_FORMATS
 
-    gff_file = open(gff_file_name, 'r')
-    sequence_dictionary = OrderedDict()
+    Returns:
+        contigs (dict)
+            Scaffold id to DNA sequence
+        genes (list)
+            (scaffold_id, start, stop, entry_id, gene_name, description,
+            dna_sequence) for each CDS in the order it appears in the
+            annotation
+
+    Raises:
+        GFFParseError
+            If the annotation uses features the streaming parser does not
+            support. The file should then be read with gffutils.
+    """
+    unescape = INPUT_FORMATS[input_format]["unescape"]
+    unique_ids = INPUT_FORMATS[input_format]["unique_ids"]
+    cds_features = []
+    feature_ids = set()
+    contigs = {}
+    seen_fasta = False
+    contig_id = None
+    contig_seq = []
+
+    with open_compressed(gff_file_name) as gff_file:
+        for line in gff_file:
+            line = line.replace(',', '').rstrip('\n')
+            if seen_fasta:
+                if line.startswith('##FASTA'):
+                    print("Problem reading GFF3 file: ", gff_file_name)
+                    raise RuntimeError("Error reading prokka input!")
+                if line.startswith('>'):
+                    if contig_id is not None:
+                        contigs.setdefault(contig_id, "".join(contig_seq))
+                    contig_id = line[1:].split(None, 1)[0]
+                    contig_seq = []
+                elif contig_id is not None:
+                    contig_seq.append(line.replace(' ', '').replace('\r', ''))
+                continue
+            if line.startswith('##FASTA'):
+                seen_fasta = True
+                continue
+            if (line.strip() == '') or (line[0] == '#'):
+                continue
+
+            fields = line.rstrip('\r').split('\t')
+            if len(fields) != 9:
+                raise GFFParseError("Unexpected number of GFF3 columns")
+            if unique_ids and ("CDS" not in fields[2]):
+                # only the IDs of CDS features are used
+                continue
+            attributes = parse_gff_attributes(fields[8], unescape)
+            if len(attributes.get('ID', [])) != 1:
+                raise GFFParseError("Missing or repeated ID attribute")
+            if unique_ids:
+                # number the parts of a CDS that share an ID
+                c = 1
+                while attributes['ID'][0] in feature_ids:
+                    attributes['ID'][0] += "." + str(c)
+                    c += 1
+            elif attributes['ID'][0] in feature_ids:
+                raise GFFParseError("Duplicate feature ID")
+            feature_ids.add(attributes['ID'][0])
+            if "CDS" not in fields[2]:
+                continue
+
+            cds_features.append((fields[0], int(fields[3]), int(fields[4]),
+                                 fields[6], attributes))
+
+    if contig_id is not None:
+        contigs.setdefault(contig_id, "".join(contig_seq))
+
+    if not seen_fasta:
+        if input_format == "prokka":
+            print("Problem reading GFF3 file: ", gff_file_name)
+            raise RuntimeError("Error reading prokka input!")
+        contigs = load_genome_fasta(gff_file_name)
+
+    gene_sequences = extract_gene_sequences(
+        contigs, [(f[0], f[1], f[2], f[3]) for f in cds_features])
+
+    genes = []
+    for (scaffold_id, start, stop, strand,
+         attributes), gene_sequence in zip(cds_features, gene_sequences):
+        if gene_sequence is None:
+            continue
+        gene_name = attributes.get("gene", [""])[0]
+        if gene_name == "":
+            gene_name = attributes.get("name", [""])[0]
+        gene_description = ";".join(attributes.get("product", []))
+
+        genes.append((scaffold_id, start, stop, attributes['ID'][0],
+                      gene_name, gene_description, gene_sequence))
+
+    return contigs, genes
+
+
+def gffutils_gff(gff_file_name, input_format="prokka"):
+    """Parses a GFF3 file using an in memory gffutils database. Slower than
+    stream_gff but copes with a wider range of inputs. Returns the same
+    contigs and genes as stream_gff."""
 
     #Split file and parse
-    lines = gff_file.read().replace(',', '')
+    with open_compressed(gff_file_name) as gff_file:
+        lines = gff_file.read().replace(',', '')
     split = lines.split('##FASTA')
 
-    if len(split) != 2:
-        print("Problem reading GFF3 file: ", gff_file.name)
+    if (len(split) == 1) and (input_format != "prokka"):
+        contigs = load_genome_fasta(gff_file_name)
+    elif len(split) != 2:
+        print("Problem reading GFF3 file: ", gff_file_name)
         raise RuntimeError("Error reading prokka input!")
-
-    with StringIO(split[1]) as temp_fasta:
-        sequences = list(SeqIO.parse(temp_fasta, 'fasta'))
+    else:
+        # index scaffolds by id, keeping the first if an id is repeated
+        contigs = {}
+        with StringIO(split[1]) as temp_fasta:
+            for record in SeqIO.parse(temp_fasta, 'fasta'):
+                if record.id not in contigs:
+                    contigs[record.id] = str(record.seq)
 
     parsed_gff = gff.create_db(clean_gff_string(split[0]),
                                dbfn=":memory:",
@@ -92,142 +416,430 @@ def get_gene_sequences(gff_file_name, file_number, filter_seqs):
                                keep_order=True,
                                from_string=True)
 
+    entries = [
+        entry for entry in parsed_gff.all_features(featuretype=())
+        if "CDS" in entry.featuretype
+    ]
+    gene_sequences = extract_gene_sequences(
+        contigs, [(entry.seqid, entry.start, entry.stop, entry.strand)
+                  for entry in entries])
+
+    genes = []
+    for entry, gene_sequence in zip(entries, gene_sequences):
+        if gene_sequence is None:
+            continue
+        try:
+            gene_name = entry.attributes["gene"][0]
+        except KeyError:
+            gene_name = ""
+        if gene_name == "":
+            try:
+                gene_name = entry.attributes["name"][0]
+            except KeyError:
+                gene_name = ""
+
+        try:
+            gene_description = ";".join(entry.attributes["product"])
+            gene_description = gene_description.replace(",", "")
+        except KeyError:
+            gene_description = ""
+
+        genes.append((entry.seqid, entry.start, entry.stop, entry.id,
+                      gene_name, gene_description, gene_sequence))
+
+    return contigs, genes
+
+
+def read_annotation(gff_file_name, input_format="auto"):
+    """Reads the genome and CDS annotations of a GFF3 file, using the fast
+    streaming parser and falling back to gffutils for odd inputs.
+
+    Returns:
+        contigs (dict)
+            Scaffold id to DNA sequence
+        genes (list)
+            (scaffold_id, start, stop, entry_id, gene_name, description,
+            dna_sequence) for each CDS
+    """
+    if input_format == "auto":
+        input_format = detect_input_format(gff_file_name)
+    if input_format not in INPUT_FORMATS:
+        raise ValueError("Unknown input format: " + input_format)
+    try:
+        return stream_gff(gff_file_name, input_format)
+    except GFFParseError:
+        return gffutils_gff(gff_file_name, input_format)
+
+
+def check_annotation(gff_file_name, filter_seqs=False, input_format="auto"):
+    """Checks the structure of an input annotation without extracting any
+    sequences, so that problems can be reported before pre-processing.
+
+    Returns:
+        errors (list)
+            Problems that would stop pre-processing
+        warnings (list)
+            Problems that would not, such as CDS on missing scaffolds
+        n_contigs (int)
+            Number of scaffolds in the genome
+        n_cds (int)
+            Number of CDS annotations
+    """
+    errors = []
+    warnings = []
+    if ',' in gff_file_name:
+        errors.append("file name contains a comma")
+    if not os.path.isfile(gff_file_name):
+        errors.append("file not found")
+        return errors, warnings, 0, 0
+
+    try:
+        if input_format == "auto":
+            input_format = detect_input_format(gff_file_name)
+        unique_ids = INPUT_FORMATS[input_format]["unique_ids"]
+
+        feature_ids = set()
+        duplicate_ids = set()
+        cds_features = []
+        contigs = set()
+        n_fasta = 0
+        bad_lines = []
+        no_id_lines = []
+        with open_compressed(gff_file_name) as gff_file:
+            for line_no, line in enumerate(gff_file, 1):
+                if n_fasta > 0:
+                    if line.startswith('>'):
+                        contigs.add(line[1:].split(None, 1)[0])
+                    elif line.startswith('##FASTA'):
+                        n_fasta += 1
+                    continue
+                if line.startswith('##FASTA'):
+                    n_fasta += 1
+                    continue
+                if (line.strip() == '') or (line[0] == '#'):
+                    continue
+                fields = line.rstrip('\r\n').split('\t')
+                if len(fields) != 9:
+                    bad_lines.append(line_no)
+                    continue
+                if unique_ids and ("CDS" not in fields[2]):
+                    continue
+                ids = parse_gff_attributes(fields[8], True).get('ID', [])
+                if len(ids) == 1:
+                    if (ids[0] in feature_ids) and not unique_ids:
+                        duplicate_ids.add(ids[0])
+                    feature_ids.add(ids[0])
+                if "CDS" in fields[2]:
+                    if len(ids) != 1:
+                        no_id_lines.append(line_no)
+                    cds_features.append(
+                        (fields[0], int(fields[3]), int(fields[4])))
+    except (OSError, EOFError, UnicodeDecodeError, ValueError) as e:
+        errors.append("could not be read (" + str(e) + ")")
+        return errors, warnings, 0, 0
+
+    if len(bad_lines) > 0:
+        errors.append("lines without 9 tab separated columns: " +
+                      ", ".join(str(l) for l in bad_lines[:5]) +
+                      (" ..." if len(bad_lines) > 5 else ""))
+    if len(no_id_lines) > 0:
+        # gffutils gives these automatic IDs (CDS_1, CDS_2, ...)
+        warnings.append("CDS without a single ID, these will be given " +
+                        "automatic IDs: lines " +
+                        ", ".join(str(l) for l in no_id_lines[:5]) +
+                        (" ..." if len(no_id_lines) > 5 else ""))
+    if len(duplicate_ids) > 0:
+        errors.append("duplicate feature IDs: " +
+                      ", ".join(sorted(duplicate_ids)[:5]) +
+                      (" ..." if len(duplicate_ids) > 5 else ""))
+    if n_fasta > 1:
+        errors.append("more than one ##FASTA section")
+    elif n_fasta == 0:
+        if input_format == "prokka":
+            errors.append("no ##FASTA section")
+        elif find_genome_fasta(gff_file_name) is None:
+            errors.append("no ##FASTA section and no genome FASTA file " +
+                          "alongside it")
+        else:
+            with open_compressed(find_genome_fasta(gff_file_name)) as infile:
+                for line in infile:
+                    if line.startswith('>'):
+                        contigs.add(line[1:].split(None, 1)[0])
+
+    if len(cds_features) == 0:
+        warnings.append("no CDS annotations")
+    missing = set(f[0] for f in cds_features if f[0] not in contigs)
+    if (len(missing) > 0) and (len(contigs) > 0):
+        warnings.append("CDS on scaffolds missing from the genome, these " +
+                        "will be ignored: " + ", ".join(sorted(missing)[:5]))
+    n_bad_length = sum((stop - start + 1) % 3 != 0
+                       for _, start, stop in cds_features)
+    if (n_bad_length > 0) and not filter_seqs:
+        errors.append(
+            str(n_bad_length) + " CDS with a length that is not a " +
+            "multiple of 3 (use --remove-invalid-genes to ignore these)")
+
+    return errors, warnings, len(contigs), len(cds_features)
+
+
+def validate_inputs(gff_list,
+                    filter_seqs=False,
+                    input_format="auto",
+                    n_cpu=1,
+                    quiet=False):
+    """Checks all input annotations in parallel and reports every problem
+    found at once.
+
+    Returns:
+        valid (bool)
+            False if any input would stop pre-processing
+    """
+    results = Parallel(n_jobs=n_cpu)(
+        delayed(check_annotation)(gff, filter_seqs, input_format)
+        for gff in gff_list)
+
+    n_invalid = 0
+    for gff, (errors, warnings, n_contigs, n_cds) in zip(gff_list, results):
+        for error in errors:
+            sys.stderr.write("Error in " + gff + ": " + error + "\n")
+        if not quiet:
+            for warning in warnings:
+                sys.stderr.write("Warning in " + gff + ": " + warning + "\n")
+        if len(errors) > 0:
+            n_invalid += 1
+
+    if not quiet:
+        print("checked", len(gff_list), "input files:",
+              sum(r[2] for r in results), "contigs,",
+              sum(r[3] for r in results), "CDS,", n_invalid, "invalid")
+
+    return n_invalid == 0
+
+
+def get_gene_sequences(gff_file_name,
+                       file_number,
+                       filter_seqs,
+                       cache_dir=None,
+                       input_format="auto",
+                       table=11):
+    """Reads the genes of one genome and formats its share of the combined
+    output files. Run in the worker processes so only compact byte blocks are
+    sent back to the parent (see format_genome_block)."""
+    #Get name and separate the prokka GFF into separate GFF and FASTA files
+    if ',' in gff_file_name:
+        print("Problem reading GFF3 file: ", gff_file_name)
+        raise RuntimeError("Error reading prokka input!")
+
+    if input_format == "auto":
+        input_format = detect_input_format(gff_file_name)
+
+    if cache_dir is None:
+        gene_records = read_gene_sequences(gff_file_name, filter_seqs,
+                                           input_format, table)
+    else:
+        # look for a previous run on a file with identical contents
+        cache_file = os.path.join(
+            cache_dir,
+            preprocess_cache_key(gff_file_name, filter_seqs, input_format,
+                                 table) + ".pkl")
+        gene_records = load_cached_genes(cache_file)
+        if gene_records is None:
+            gene_records = read_gene_sequences(gff_file_name, filter_seqs,
+                                               input_format, table)
+            save_cached_genes(cache_file, gene_records)
+
+    return format_genome_block(gene_records, file_number,
+                               annotation_name(gff_file_name))
+
+
+def preprocess_cache_key(gff_file_name,
+                         filter_seqs,
+                         input_format="prokka",
+                         table=11):
+    """Hash of the GFF contents and any options that change its parsing"""
+    key = hashlib.sha256()
+    key.update(PREPROCESS_CACHE_VERSION.encode())
+    key.update(b"filter" if filter_seqs else b"keep")
+    key.update(input_format.encode())
+    key.update(b"table" + str(table).encode())
+    input_files = [gff_file_name]
+    if input_format != "prokka":
+        # the genome may be read from a separate FASTA file
+        fasta_file_name = find_genome_fasta(gff_file_name)
+        if fasta_file_name is not None:
+            input_files.append(fasta_file_name)
+    for file_name in input_files:
+        with open(file_name, 'rb') as infile:
+            for chunk in iter(lambda: infile.read(1 << 20), b""):
+                key.update(chunk)
+    return key.hexdigest()
+
+
+def load_cached_genes(cache_file):
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with open(cache_file, 'rb') as infile:
+            gene_records = pickle.load(infile)
+    except Exception:
+        # treat incomplete or corrupt entries as a cache miss, truncated
+        # pickles can fail with a range of errors
+        return None
+    if not isinstance(gene_records, list):
+        return None
+    return gene_records
+
+
+def save_cached_genes(cache_file, gene_records):
+    # write to a temporary file first so that concurrent runs never see a
+    # partially written entry
+    temp_file = tempfile.NamedTemporaryFile(delete=False,
+                                            dir=os.path.dirname(cache_file))
+    with temp_file:
+        pickle.dump(gene_records, temp_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_file.name, cache_file)
+    return
+
+
+def read_gene_sequences(gff_file_name,
+                        filter_seqs,
+                        input_format="auto",
+                        table=11):
+    """Reads the coding sequences of a genome.
+
+    Returns:
+        gene_records (list)
+            (local_id, scaffold_id, entry_id, dna_sequence, protein,
+            gene_name, description) for each gene, ordered by scaffold and
+            position. The local id is the clustering id without the genome
+            number.
+    """
+    contigs, gene_entries = read_annotation(gff_file_name, input_format)
+
+    # translate every gene of the genome at once, this is also used to
+    # check for premature stop codons
+    proteins, internal_stops, terminal_stops = translate_batch(
+        [entry[6] for entry in gene_entries], table)
+
     #Get genes per scaffold
     scaffold_genes = {}
-    for entry in parsed_gff.all_features(featuretype=()):
-        if "CDS" not in entry.featuretype:
-            continue
-        scaffold_id = None
-        for sequence_index in range(len(sequences)):
-            scaffold_id = sequences[sequence_index].id
-            if scaffold_id == entry.seqid:
-                gene_sequence = sequences[sequence_index].seq[(entry.start -
-                                                               1):entry.stop]
-                if entry.strand == "-":
-                    gene_sequence = gene_sequence.reverse_complement()
-                try:
-                    gene_name = entry.attributes["gene"][0]
-                except KeyError:
-                    gene_name = ""
-                if gene_name == "":
-                    try:
-                        gene_name = entry.attributes["name"][0]
-                    except KeyError:
-                        gene_name = ""
+    for (scaffold_id, start, stop, entry_id, gene_name, gene_description,
+         gene_sequence), protein, internal_stop, terminal_stop in zip(
+             gene_entries, proteins, internal_stops, terminal_stops):
 
-                try:
-                    gene_description = ";".join(entry.attributes["product"])
-                    gene_description = gene_description.replace(",", "")
-                except KeyError:
-                    gene_description = ""
-
-                #clean entries if requested
-                if ((len(gene_sequence) % 3 > 0) or
-                    (len(gene_sequence) < 34)) or ("*" in str(
-                        gene_sequence.translate())[:-1]):
-                    print('invalid gene! file - id: ', gff_file_name, ' - ',
-                          entry.id)
-                    if filter_seqs: continue
-
-                gene_record = (entry.start,
-                               SeqRecord(gene_sequence,
-                                         id=entry.id,
-                                         description=gene_description,
-                                         name=gene_name,
-                                         annotations={"scaffold":
-                                                      scaffold_id}))
-                scaffold_genes[scaffold_id] = scaffold_genes.get(
-                    scaffold_id, [])
-                scaffold_genes[scaffold_id].append(gene_record)
+        #clean entries if requested
+        if ((len(gene_sequence) % 3 > 0) or
+            (len(gene_sequence) < 34)) or internal_stop:
+            print('invalid gene! file - id: ', gff_file_name, ' - ',
+                  entry_id)
+            if filter_seqs: continue
+
+        if (len(gene_sequence) % 3) != 0:
+            raise ValueError(
+                "Coding sequence not divisible by 3, is it complete?!")
+        if terminal_stop:
+            protein = protein[0:-1]
+
+        if internal_stop:
+            print(
+                SeqRecord(Seq(gene_sequence),
+                          id=entry_id,
+                          description=gene_description,
+                          name=gene_name,
+                          annotations={"scaffold": scaffold_id}))
+            print(protein)
+        scaffold_genes[scaffold_id] = scaffold_genes.get(scaffold_id, [])
+        scaffold_genes[scaffold_id].append(
+            (start, entry_id, gene_sequence, protein, gene_name,
+             gene_description))
     for scaffold in scaffold_genes:
         scaffold_genes[scaffold] = sorted(scaffold_genes[scaffold],
                                           key=lambda x: x[0])
+
+    gene_records = []
     scaff_count = -1
     for scaffold in scaffold_genes:
         scaff_count += 1
-        for gene_index in range(len(scaffold_genes[scaffold])):
-            clustering_id = str(file_number) + '_' + str(
-                scaff_count) + '_' + str(gene_index)
-            sequence_dictionary[clustering_id] = scaffold_genes[scaffold][
-                gene_index][1]
+        for gene_index, (start, entry_id, gene_sequence, protein, gene_name,
+                         gene_description) in enumerate(
+                             scaffold_genes[scaffold]):
+            gene_records.append(
+                (str(scaff_count) + '_' + str(gene_index), scaffold, entry_id,
+                 gene_sequence, protein, gene_name, gene_description))
 
-    gff_file.close()
+    return gene_records
 
-    return sequence_dictionary, translate_sequences(sequence_dictionary)
 
+def format_fasta(seq_id, sequence, wrap=60):
+    # matches the output of Bio.SeqIO.write
+    lines = [">" + seq_id + "\n"]
+    for i in range(0, len(sequence), wrap):
+        lines.append(sequence[i:i + wrap] + "\n")
+    return "".join(lines)
 
-#Translate sequences and return a second dic of protien sequences
-def translate_sequences(sequence_dic):
-    protein_list = []
-    for strain_id in sequence_dic:
-        sequence_record = sequence_dic[strain_id]
-        if (len(sequence_record.seq) % 3) != 0:
-            raise ValueError(
-                "Coding sequence not divisible by 3, is it complete?!")
-        protien_sequence = translate(str(sequence_record.seq))
-        if protien_sequence[-1] == "*":
-            protien_sequence = protien_sequence[0:-1]
-        if "*" in protien_sequence:
-            print(sequence_record)
-            print(protien_sequence)
-            # raise ValueError("Premature stop codon in a gene!")
-        protein_record = SeqRecord(Seq(protien_sequence),
-                                   id=strain_id,
-                                   description=strain_id)
-        protein_list.append(protein_record)
-    return protein_list
-
-
-def output_files(dna_dictionary, protien_list, prot_handle, dna_handle,
-                 csv_handle, gff_filename):
-    #Simple output for protien list
-    SeqIO.write(protien_list, prot_handle, 'fasta')
-    #Correct DNA ids to CD-Hit acceptable ids, and output
-    clustering_id_records = []
-    for clusteringid in dna_dictionary:
-        clean_record = SeqRecord(dna_dictionary[clusteringid].seq,
-                                 id=clusteringid,
-                                 description=clusteringid)
-        clustering_id_records.append(clean_record)
-    SeqIO.write(clustering_id_records, dna_handle, 'fasta')
-    gff_name = os.path.splitext(os.path.basename(gff_filename))[0]
-
-    #Combine everything to a csv and output it
-    for protien in protien_list:
-        clustering_id = protien.id
-        relevant_seqrecord = dna_dictionary[clustering_id]
-        out_list = [
-            gff_name, relevant_seqrecord.annotations["scaffold"],
-            clustering_id, relevant_seqrecord.id,
-            str(protien.seq),
-            str(relevant_seqrecord.seq),
-            str(relevant_seqrecord.name),
-            str(relevant_seqrecord.description)
+
+def format_genome_block(gene_records, file_number, gff_name):
+    """Formats the genes of a genome as they appear in the combined output
+    files.
+
+    Returns:
+        protein_block (bytes)
+            Entries of combined_protein_CDS.fasta
+        dna_block (bytes)
+            Entries of combined_DNA_CDS.fasta
+        csv_block (bytes)
+            Rows of gene_data.csv
+        gene_order (numpy.ndarray)
+            (genome, contig, position) of each gene
+    """
+    protein_block = []
+    dna_block = []
+    csv_block = []
+    gene_order = np.empty((len(gene_records), 3), dtype=np.int64)
+    gene_order[:, 0] = file_number
+    for i, (local_id, scaffold_id, entry_id, gene_sequence, protein,
+            gene_name, gene_description) in enumerate(gene_records):
+        gene_order[i, 1:] = local_id.split("_")
+        clustering_id = str(file_number) + '_' + local_id
+        protein_block.append(format_fasta(clustering_id, protein))
+        dna_block.append(format_fasta(clustering_id, gene_sequence))
+        row = [
+            gff_name, scaffold_id, clustering_id, entry_id, protein,
+            gene_sequence, gene_name, gene_description
         ]
-        outline = ",".join(out_list)
-        csv_handle.write(outline + '\n')
-    return None
+        csv_block.append(",".join(row) + "\n")
+
+    return ("".join(protein_block).encode('utf-8'),
+            "".join(dna_block).encode('utf-8'),
+            "".join(csv_block).encode('utf-8'), gene_order)
 
 
-def process_prokka_input(gff_list, output_dir, filter_seqs, quiet, n_cpu):
+def process_prokka_input(gff_list,
+                         output_dir,
+                         filter_seqs,
+                         quiet,
+                         n_cpu,
+                         cache_dir=None,
+                         input_format="auto",
+                         table=11):
     try:
-        protienHandle = open(output_dir + "combined_protein_CDS.fasta", 'w+')
-        DNAhandle = open(output_dir + "combined_DNA_CDS.fasta", 'w+')
-        csvHandle = open(output_dir + "gene_data.csv", 'w+')
-        csvHandle.write(
-            "gff_file,scaffold_name,clustering_id,annotation_id,prot_sequence,dna_sequence,gene_name,description\n"
-        )
-        job_list = list(enumerate(gff_list))
-        job_list = [
-            job_list[i:i + n_cpu] for i in range(0, len(job_list), n_cpu)
-        ]
-        for job in tqdm(job_list, disable=quiet):
-            gene_sequence_list = Parallel(n_jobs=n_cpu)(
-                delayed(get_gene_sequences)(gff, gff_no, filter_seqs)
-                for gff_no, gff in job)
-            for i, gene_seq in enumerate(gene_sequence_list):
-                output_files(gene_seq[0], gene_seq[1], protienHandle,
-                             DNAhandle, csvHandle, job[i][1])
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        protienHandle = open(output_dir + "combined_protein_CDS.fasta", 'wb')
+        DNAhandle = open(output_dir + "combined_DNA_CDS.fasta", 'wb')
+        csvHandle = GeneStoreWriter(output_dir + "gene_data.csv")
+        # a single pool works through all genomes, results are returned in
+        # input order as soon as they (and those before them) are ready.
+        # Each worker returns pre-formatted blocks that are written as is.
+        genome_blocks = Parallel(n_jobs=n_cpu, return_as="generator")(
+            delayed(get_gene_sequences)(gff, gff_no, filter_seqs, cache_dir,
+                                        input_format, table)
+            for gff_no, gff in enumerate(gff_list))
+        for protein_block, dna_block, csv_block, gene_order in tqdm(
+                genome_blocks, total=len(gff_list), disable=quiet):
+            protienHandle.write(protein_block)
+            DNAhandle.write(dna_block)
+            csvHandle.append_block(csv_block, gene_order)
         protienHandle.close()
         DNAhandle.close()
         csvHandle.close()
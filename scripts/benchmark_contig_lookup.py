@@ -0,0 +1,101 @@
+import os
+import sys
+import argparse
+import random
+import timeit
+from Bio.Seq import Seq
+
+# run from a source checkout without installing panaroo
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+
+from panaroo.prokka import extract_gene_sequences
+
+
+def simulate_fragmented_assembly(n_contigs, genes_per_contig, gene_length,
+                                 seed):
+    rng = random.Random(seed)
+    contigs = {}
+    features = []
+    for c in range(n_contigs):
+        contig_id = "contig_" + str(c)
+        contig_len = genes_per_contig * (gene_length + 100) + 100
+        contigs[contig_id] = "".join(
+            rng.choice("ACGT") for i in range(contig_len))
+        for g in range(genes_per_contig):
+            start = 100 + g * (gene_length + 100) + 1
+            features.append((contig_id, start, start + gene_length - 1,
+                             rng.choice(["+", "-"])))
+    # annotation files are not always ordered by contig
+    rng.shuffle(features)
+    return contigs, features
+
+
+def linear_scan(sequences, features):
+    # the previous approach: scan every contig for each CDS
+    gene_sequences = []
+    for scaffold, start, stop, strand in features:
+        for sequence_index in range(len(sequences)):
+            if sequences[sequence_index][0] == scaffold:
+                gene_sequence = sequences[sequence_index][1][(start -
+                                                              1):stop]
+                if strand == "-":
+                    gene_sequence = gene_sequence.reverse_complement()
+                gene_sequences.append(str(gene_sequence))
+                break
+    return gene_sequences
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=
+        'Benchmarks gene extraction from highly fragmented assemblies.')
+    parser.add_argument('--contigs',
+                        dest='n_contigs',
+                        type=int,
+                        default=800,
+                        help='number of contigs (default=800)')
+    parser.add_argument('--genes',
+                        dest='genes_per_contig',
+                        type=int,
+                        default=5,
+                        help='number of genes per contig (default=5)')
+    parser.add_argument('--length',
+                        dest='gene_length',
+                        type=int,
+                        default=900,
+                        help='gene length (default=900)')
+    parser.add_argument('--repeats',
+                        dest='repeats',
+                        type=int,
+                        default=3,
+                        help='number of timing repeats (default=3)')
+    args = parser.parse_args()
+
+    contigs, features = simulate_fragmented_assembly(args.n_contigs,
+                                                     args.genes_per_contig,
+                                                     args.gene_length, 0)
+    sequences = [(cid, Seq(seq)) for cid, seq in contigs.items()]
+
+    assert linear_scan(sequences, features) == extract_gene_sequences(
+        contigs, features)
+
+    t_scan = min(
+        timeit.repeat(lambda: linear_scan(sequences, features),
+                      number=1,
+                      repeat=args.repeats))
+    t_index = min(
+        timeit.repeat(lambda: extract_gene_sequences(contigs, features),
+                      number=1,
+                      repeat=args.repeats))
+
+    print("contigs: %d, genes: %d" % (len(contigs), len(features)))
+    print("linear scan:   %.4fs" % t_scan)
+    print("indexed:       %.4fs" % t_index)
+    print("speedup:       %.1fx" % (t_scan / t_index))
+
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import os
+import sys
+import argparse
+import random
+import tempfile
+import timeit
+
+# run from a source checkout without installing panaroo
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+
+from panaroo.gene_store import GeneStoreWriter, open_gene_data
+
+
+def simulate_gene_data(gene_data_file, n_genomes, genes_per_genome, seed):
+    rng = random.Random(seed)
+    with GeneStoreWriter(gene_data_file) as outfile:
+        for g in range(n_genomes):
+            rows = []
+            for i in range(genes_per_genome):
+                prot = "M" + "".join(
+                    rng.choices("ACDEFGHIKLMNPQRSTVWY",
+                                k=rng.randint(50, 500)))
+                if rng.random() < 0.9:
+                    prot += "*"
+                rows.append([
+                    "genome" + str(g), "contig" + str(i // 1000),
+                    "%d_%d_%d" % (g, i // 1000, i % 1000),
+                    "GENOME%d_%05d" % (g, i), prot,
+                    "".join(rng.choices("ACGT", k=3 * len(prot))),
+                    "gene" + str(i), "hypothetical protein"
+                ])
+            outfile.append_rows(rows)
+    return
+
+
+def split_rows(gene_data_file):
+    # the previous approach: split every row of the table
+    orig_ids = {}
+    ids_len_stop = {}
+    with open(gene_data_file, 'r') as infile:
+        next(infile)
+        for line in infile:
+            line = line.split(",")
+            orig_ids[line[2]] = line[3]
+            ids_len_stop[line[2]] = (len(line[4]), "*" in line[4][1:-3])
+    return orig_ids, ids_len_stop
+
+
+def indexed_columns(gene_data_file):
+    gene_data = open_gene_data(gene_data_file)
+    clustering_ids = list(gene_data.column("clustering_id"))
+    orig_ids = dict(zip(clustering_ids, gene_data.column("annotation_id")))
+    ids_len_stop = dict(
+        zip(
+            clustering_ids,
+            zip(gene_data.lengths("prot_sequence").tolist(),
+                gene_data.internal_stops().tolist())))
+    return orig_ids, ids_len_stop
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=
+        'Benchmarks reading the annotation ids and protein summaries from '
+        'gene_data.csv.')
+    parser.add_argument('--genomes',
+                        dest='n_genomes',
+                        type=int,
+                        default=100,
+                        help='number of genomes (default=100)')
+    parser.add_argument('--genes',
+                        dest='genes_per_genome',
+                        type=int,
+                        default=3000,
+                        help='number of genes per genome (default=3000)')
+    parser.add_argument('--repeats',
+                        dest='repeats',
+                        type=int,
+                        default=3,
+                        help='number of timing repeats (default=3)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        gene_data_file = os.path.join(tmpdir, "gene_data.csv")
+        simulate_gene_data(gene_data_file, args.n_genomes,
+                           args.genes_per_genome, 0)
+
+        assert split_rows(gene_data_file) == indexed_columns(gene_data_file)
+
+        t_split = min(
+            timeit.repeat(lambda: split_rows(gene_data_file),
+                          number=1,
+                          repeat=args.repeats))
+        t_index = min(
+            timeit.repeat(lambda: indexed_columns(gene_data_file),
+                          number=1,
+                          repeat=args.repeats))
+        t_lookup = min(
+            timeit.repeat(
+                lambda: open_gene_data(gene_data_file).row_index("0_0_0"),
+                number=1,
+                repeat=args.repeats))
+
+    print("rows: %d" % (args.n_genomes * args.genes_per_genome))
+    print("split rows:    %.4fs" % t_split)
+    print("indexed:       %.4fs" % t_index)
+    print("speedup:       %.1fx" % (t_split / t_index))
+    print("first lookup:  %.4fs" % t_lookup)
+
+    return
+
+
+if __name__ == '__main__':
+    main()
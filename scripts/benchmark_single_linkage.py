@@ -0,0 +1,144 @@
+import os
+import sys
+import argparse
+import random
+import timeit
+import numpy as np
+import networkx as nx
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+# run from a source checkout without installing panaroo
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+
+from panaroo.clean_network import single_linkage, centroid_adjacency
+from panaroo.isvalid import del_dups
+
+
+def simulate_neighbourhoods(n_centroids, n_nodes, n_links, n_neighbourhoods,
+                            neighbourhood_size, seed):
+    rng = random.Random(seed)
+    # links between similar centroids, including some on the diagonal
+    rows = [rng.randrange(n_centroids) for i in range(n_links)]
+    cols = [
+        min(n_centroids - 1, max(0, r + rng.randint(-20, 20))) for r in rows
+    ]
+    distances = csr_matrix((np.ones(n_links), (rows, cols)),
+                           shape=(n_centroids, n_centroids))
+
+    # nodes with one or more centroids, some shared between nodes as is the
+    # case for split paralogs
+    G = nx.Graph()
+    centroid_to_index = {str(i): i for i in range(n_centroids)}
+    for n in range(n_nodes):
+        G.add_node(n,
+                   centroid=[
+                       str(rng.randrange(n_centroids))
+                       for i in range(rng.choice([1, 1, 1, 2, 3]))
+                   ])
+
+    neighbourhoods = [
+        rng.sample(range(n_nodes), neighbourhood_size)
+        for i in range(n_neighbourhoods)
+    ]
+    return G, distances, centroid_to_index, neighbourhoods
+
+
+def sparse_single_linkage(G, distances_bwtn_centroids, centroid_to_index,
+                          neighbours):
+    # the previous approach: connected components of the sliced sub-matrix
+    index = []
+    neigh_array = []
+    for neigh in neighbours:
+        for sid in G.nodes[neigh]['centroid']:
+            index.append(centroid_to_index[sid])
+            neigh_array.append(neigh)
+    index = np.array(index, dtype=int)
+    neigh_array = np.array(neigh_array)
+
+    n_components, labels = connected_components(
+        csgraph=distances_bwtn_centroids[index][:, index],
+        directed=False,
+        return_labels=True)
+    for neigh in neighbours:
+        l = list(set(labels[neigh_array == neigh]))
+        if len(l) > 1:
+            for i in l[1:]:
+                labels[labels == i] = l[0]
+
+    clusters = [
+        del_dups(list(neigh_array[labels == i])) for i in np.unique(labels)
+    ]
+
+    return (clusters)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=
+        'Benchmarks the single linkage clustering of node neighbourhoods.')
+    parser.add_argument('--centroids',
+                        dest='n_centroids',
+                        type=int,
+                        default=20000,
+                        help='number of centroids (default=20000)')
+    parser.add_argument('--links',
+                        dest='n_links',
+                        type=int,
+                        default=60000,
+                        help='number of linked centroid pairs (default=60000)')
+    parser.add_argument('--neighbourhoods',
+                        dest='n_neighbourhoods',
+                        type=int,
+                        default=2000,
+                        help='number of neighbourhoods (default=2000)')
+    parser.add_argument('--size',
+                        dest='neighbourhood_size',
+                        type=int,
+                        default=30,
+                        help='nodes per neighbourhood (default=30)')
+    parser.add_argument('--repeats',
+                        dest='repeats',
+                        type=int,
+                        default=3,
+                        help='number of timing repeats (default=3)')
+    args = parser.parse_args()
+
+    G, distances, centroid_to_index, neighbourhoods = simulate_neighbourhoods(
+        args.n_centroids, args.n_centroids // 2, args.n_links,
+        args.n_neighbourhoods, args.neighbourhood_size, 0)
+    adjacency = centroid_adjacency(distances)
+
+    for neighbours in neighbourhoods:
+        assert sparse_single_linkage(G, distances, centroid_to_index,
+                                     neighbours) == single_linkage(
+                                         G, adjacency, centroid_to_index,
+                                         neighbours)
+
+    t_sparse = min(
+        timeit.repeat(lambda: [
+            sparse_single_linkage(G, distances, centroid_to_index, n)
+            for n in neighbourhoods
+        ],
+                      number=1,
+                      repeat=args.repeats))
+    t_union = min(
+        timeit.repeat(lambda: [
+            single_linkage(G, adjacency, centroid_to_index, n)
+            for n in neighbourhoods
+        ],
+                      number=1,
+                      repeat=args.repeats))
+
+    print("centroids: %d, neighbourhoods: %d" %
+          (args.n_centroids, len(neighbourhoods)))
+    print("sub-matrix:    %.4fs" % t_sparse)
+    print("union find:    %.4fs" % t_union)
+    print("speedup:       %.1fx" % (t_sparse / t_union))
+
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -37,7 +37,7 @@ setup(
     long_description_content_type="text/markdown",
     url="https://github.com/gtonkinhill/panaroo",
     install_requires=[
-        'networkx', 'gffutils', 'BioPython', 'joblib', 'tqdm', 'edlib',
+        'networkx', 'gffutils', 'BioPython', 'joblib>=1.3.0', 'tqdm', 'edlib',
         'scipy', 'numpy', 'matplotlib', 'sklearn', 'plotly', 'dendropy',
         'intbitset'
     ],
@@ -0,0 +1,179 @@
+# test if cd-hit cluster files are read correctly
+import os
+import re
+import itertools
+import sys
+import tempfile
+import subprocess
+
+import pytest
+
+from panaroo.cdhit import read_cdhit_clusters, read_cdhit_cluster_lists
+from panaroo.cdhit import write_unique_sequences, expand_duplicates
+from panaroo.cdhit import run_clustering_cmd, run_cdhit_sharded
+
+# stands in for cd-hit, clustering proteins by their first three residues
+# with the longest as the representative
+FAKE_CDHIT = """
+import sys
+args = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+seqs = {}
+with open(args["-i"]) as infile:
+    for line in infile:
+        if line[0] == ">":
+            sid = line[1:].strip()
+            seqs[sid] = ""
+        else:
+            seqs[sid] += line.strip()
+clusters = {}
+for sid, seq in seqs.items():
+    clusters.setdefault(seq[:3], []).append(sid)
+with open(args["-o"], "w") as out, open(args["-o"] + ".clstr", "w") as clstr:
+    for c, members in enumerate(clusters.values()):
+        members.sort(key=lambda sid: -len(seqs[sid]))
+        out.write(">" + members[0] + "\\n" + seqs[members[0]] + "\\n")
+        clstr.write(">Cluster " + str(c) + "\\n")
+        for i, sid in enumerate(members):
+            clstr.write(str(i) + "\\t" + str(len(seqs[sid])) + "aa, >" + sid +
+                        ("... *" if i == 0 else "... at 99.00%") + "\\n")
+"""
+
+
+def test_read_cdhit_clusters():
+
+    with tempfile.NamedTemporaryFile('w', suffix=".clstr") as clstr:
+        clstr.write(">Cluster 0\n"
+                    "0\t300aa, >0_0_1... at 98.33%\n"
+                    "1\t305aa, >1_0_1... *\n"
+                    ">Cluster 1\n"
+                    "0\t120aa, >0_1_0... *\n"
+                    ">Cluster 2\n"
+                    "0\t88aa, >1_0_3... *\n"
+                    "1\t88aa, >0_2_5... at 100.00%\n")
+        clstr.flush()
+
+        ids, labels, is_rep = read_cdhit_clusters(clstr.name)
+        assert ids == ["0_0_1", "1_0_1", "0_1_0", "1_0_3", "0_2_5"]
+        assert list(labels) == [0, 0, 1, 2, 2]
+        assert list(is_rep) == [False, True, True, True, False]
+
+        assert read_cdhit_cluster_lists(clstr.name) == [["0_0_1", "1_0_1"],
+                                                        ["0_1_0"],
+                                                        ["1_0_3", "0_2_5"]]
+
+    return
+
+
+def test_unique_sequences():
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with open(tmpdir + "/in.fasta", 'w') as outfile:
+            outfile.write(">0_0_0\nMKV\nLLA\n>0_0_1\nMKT\n>1_0_0\nMKVLLA\n"
+                          ">2_0_0\nMKVLLA\n>2_0_1\nMKT\n")
+        duplicates = write_unique_sequences(tmpdir + "/in.fasta",
+                                            tmpdir + "/unique.fasta")
+        with open(tmpdir + "/unique.fasta", 'r') as infile:
+            assert infile.read() == ">0_0_0\nMKV\nLLA\n>0_0_1\nMKT\n"
+        assert duplicates == {"0_0_0": ["1_0_0", "2_0_0"], "0_0_1": ["2_0_1"]}
+
+        # copies are added to the cluster of their first copy
+        with open(tmpdir + "/out.clstr", 'w') as outfile:
+            outfile.write(">Cluster 0\n0\t6aa, >0_0_0... *\n"
+                          ">Cluster 1\n0\t3aa, >0_0_1... *\n")
+        expand_duplicates(tmpdir + "/out.clstr", duplicates)
+        assert read_cdhit_cluster_lists(tmpdir + "/out.clstr") == [[
+            "0_0_0", "1_0_0", "2_0_0"
+        ], ["0_0_1", "2_0_1"]]
+        assert list(read_cdhit_clusters(tmpdir + "/out.clstr")[2]) == [
+            True, False, False, True, False
+        ]
+        assert sorted(os.listdir(tmpdir)) == ["in.fasta", "out.clstr",
+                                              "unique.fasta"]
+
+    return
+
+
+def test_run_clustering_cmd(capsys):
+
+    def peak_memory(cmd):
+        run_clustering_cmd(cmd)
+        out = capsys.readouterr().out
+        return float(re.search(r"peak memory ([0-9.]+) MB", out).group(1))
+
+    with pytest.raises(subprocess.CalledProcessError):
+        run_clustering_cmd([sys.executable, "-c", "exit(3)"])
+
+    # the peak memory of each command is reported on its own, without the
+    # memory the child inherits from this process
+    if not os.path.isfile("/proc/%d/status" % os.getpid()):
+        pytest.skip("peak memory is only reported where /proc is available")
+    parent = b'x' * (400 * 1024 * 1024)
+    large = peak_memory([
+        sys.executable, "-c",
+        "import time; x = b'x' * (300 * 1024 * 1024); time.sleep(0.5)"
+    ])
+    small = peak_memory(
+        [sys.executable, "-c", "import time; time.sleep(0.5)"])
+    del parent
+    assert large > 300
+    assert small < 100
+
+    return
+
+
+def test_run_cdhit_sharded(monkeypatch):
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with open(os.path.join(tmpdir, "cd-hit"), 'w') as outfile:
+            outfile.write("#!" + sys.executable + "\n" + FAKE_CDHIT)
+        os.chmod(os.path.join(tmpdir, "cd-hit"), 0o755)
+        monkeypatch.setenv("PATH", tmpdir + os.pathsep + os.environ["PATH"])
+
+        # three families spread over six genomes and a gene found in one
+        families = {}
+        with open(os.path.join(tmpdir, "in.fasta"), 'w') as outfile:
+            for genome in range(6):
+                for gene, prefix in enumerate(["MKA", "MGG", "MTT"]):
+                    sid = str(genome) + "_0_" + str(gene)
+                    families[sid] = prefix
+                    outfile.write(">" + sid + "\n" + prefix +
+                                  "L" * (10 + genome * gene) + "\n")
+            families["5_0_3"] = "MWW"
+            outfile.write(">5_0_3\nMWWLLLLLLLL\n")
+
+        run_cdhit_sharded(os.path.join(tmpdir, "in.fasta"),
+                          os.path.join(tmpdir, "out.fasta"),
+                          tmpdir,
+                          shard_size=2,
+                          n_cpu=2,
+                          quiet=True)
+
+        ids, labels, is_rep = read_cdhit_clusters(
+            os.path.join(tmpdir, "out.fasta.clstr"))
+
+        # every sequence is in exactly one cluster, with one representative
+        # per cluster
+        assert sorted(ids) == sorted(families)
+        for c in set(labels.tolist()):
+            assert is_rep[labels == c].sum() == 1
+        assert sorted(
+            sorted(families[sid] for sid in cluster)
+            for cluster in read_cdhit_cluster_lists(
+                os.path.join(tmpdir, "out.fasta.clstr"))) == [
+                    ["MGG"] * 6, ["MKA"] * 6, ["MTT"] * 6, ["MWW"]
+                ]
+
+        # the representatives are the longest of each family and are written
+        # to the output
+        with open(os.path.join(tmpdir, "out.fasta")) as infile:
+            reps = [line[1:].strip() for line in infile if line[0] == ">"]
+        assert sorted(reps) == sorted(
+            itertools.compress(ids, is_rep.tolist()))
+        assert sorted(reps) == ["0_0_0", "5_0_1", "5_0_2", "5_0_3"]
+
+        # only the output files are left behind
+        assert sorted(os.listdir(tmpdir)) == [
+            "cd-hit", "in.fasta", "out.fasta", "out.fasta.clstr"
+        ]
+
+    return
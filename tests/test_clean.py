@@ -23,4 +23,46 @@ def test_clean(datafolder):
         assert pa.shape == (5782, 4)
         assert (pa.shape[0] * (pa.shape[1] - 1)) == np.sum(pa[:, 1:])
 
-    return
\ No newline at end of file
+    return
+
+
+def test_symmetric_pair_keys():
+
+    from scipy.sparse import random as sparse_random
+    from panaroo.clean_network import symmetric_pair_keys, any_pair_in
+
+    n = 50
+    distances = sparse_random(n, n, density=0.05, format='csr', random_state=0)
+    nonzero = set(zip(*distances.nonzero()))
+    keys = symmetric_pair_keys(distances)
+
+    for i in range(n):
+        for j in range(n):
+            expected = ((i, j) in nonzero) or ((j, i) in nonzero)
+            assert any_pair_in(keys, n, [(i, j)]) == expected
+
+    pairs = [(i, j) for i in range(5) for j in range(5, 10)]
+    assert any_pair_in(keys, n, pairs) == any(
+        ((i, j) in nonzero) or ((j, i) in nonzero) for i, j in pairs)
+    assert not any_pair_in(keys, n, [])
+
+    return
+
+
+def test_single_linkage():
+
+    import networkx as nx
+    from scipy.sparse import csr_matrix
+    from panaroo.clean_network import single_linkage, centroid_adjacency
+
+    centroid_to_index = {"a": 0, "b": 1, "c": 2, "d": 3, "e": 4}
+    distances = csr_matrix(([1, 1], ([0, 4], [2, 4])), shape=(5, 5))
+    G = nx.Graph()
+    for node, centroids in enumerate([["a"], ["b"], ["c", "d"], ["e"]]):
+        G.add_node(node, centroid=centroids)
+
+    clusters = single_linkage(G, centroid_adjacency(distances),
+                              centroid_to_index, [3, 0, 1, 2])
+    assert clusters == [[3], [0, 2], [1]]
+
+    return
@@ -0,0 +1,122 @@
+# test if the indexed gene store agrees with gene_data.csv
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from panaroo.prokka import process_prokka_input
+from panaroo.gene_store import GeneStoreWriter, GENE_DATA_COLUMNS, gene_store_dir, open_gene_data
+
+
+def read_csv(gene_data_file):
+    with open(gene_data_file, 'r') as infile:
+        next(infile)  # skip header
+        return [line.rstrip('\n').split(",") for line in infile]
+
+
+def test_gene_store(datafolder):
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        output_dir = os.path.join(tmpdirname, "")
+        process_prokka_input([datafolder + "aa1.gff"],
+                             output_dir,
+                             filter_seqs=False,
+                             quiet=True,
+                             n_cpu=1)
+
+        rows = read_csv(output_dir + "gene_data.csv")
+        store = open_gene_data(output_dir + "gene_data.csv")
+
+        assert len(store) > 0
+        assert len(store) == len(rows)
+        assert store.indexed
+        for c, column in enumerate(GENE_DATA_COLUMNS):
+            assert list(store.column(column)) == [r[c] for r in rows]
+            assert [store.value(i, column)
+                    for i in range(len(rows))] == [r[c] for r in rows]
+        assert list(store.column_array("clustering_id")) == [
+            r[2].encode() for r in rows
+        ]
+        assert store.lengths("prot_sequence").tolist() == [
+            len(r[4]) for r in rows
+        ]
+        assert store.internal_stops().tolist() == [
+            "*" in r[4][1:-3] for r in rows
+        ]
+
+        # without the index files rows are found by scanning the csv
+        shutil.rmtree(gene_store_dir(output_dir + "gene_data.csv"))
+        scanned = open_gene_data(output_dir + "gene_data.csv")
+        assert not scanned.indexed
+        assert scanned.internal_stops().tolist() == [
+            "*" in r[4][1:-3] for r in rows
+        ]
+        assert list(scanned.columns(*GENE_DATA_COLUMNS)) == [
+            tuple(r) for r in rows
+        ]
+
+        # the gene order index matches the clustering ids
+        assert store.gene_order().tolist() == scanned.gene_order().tolist()
+        assert store.gene_order()[0].tolist() == [0, 0, 0]
+
+        cid = rows[-1][2]
+        assert cid in store
+        assert "missing" not in store
+        assert store.row_index(cid) == len(rows) - 1
+        assert store.get(cid, "dna_sequence") == rows[-1][5]
+
+        # appending re-indexes a table written without an index
+        with GeneStoreWriter(output_dir + "gene_data.csv", mode='a') as out:
+            out.append(
+                ["aa1", "", "0_refound_0", "0_refound_0", "M", "ATG", "", ""])
+        appended = open_gene_data(output_dir + "gene_data.csv")
+        assert len(appended) == len(rows) + 1
+        assert appended.get("0_refound_0", "dna_sequence") == "ATG"
+        assert appended.get(cid, "dna_sequence") == rows[-1][5]
+        assert appended.indexed
+
+        # the index is not used once the table has been changed, even if
+        # its size stays the same
+        with open(output_dir + "gene_data.csv", 'r+b') as outfile:
+            outfile.seek(outfile.read().rindex(b"ATG"))
+            outfile.write(b"C")
+        modified = os.stat(output_dir + "gene_data.csv").st_mtime_ns
+        os.utime(output_dir + "gene_data.csv",
+                 ns=(modified + 10**9, modified + 10**9))
+        changed = open_gene_data(output_dir + "gene_data.csv")
+        assert not changed.indexed
+        assert changed.get("0_refound_0", "dna_sequence") == "CTG"
+
+        store.to_csv(output_dir + "copy.csv")
+        assert read_csv(output_dir + "copy.csv") == rows
+
+        with GeneStoreWriter(output_dir + "dup.csv") as out:
+            out.append_rows([rows[0], rows[0]])
+        with pytest.raises(NameError):
+            open_gene_data(output_dir + "dup.csv").row_index(rows[0][2])
+
+        # the gene order is kept when rows without one are appended
+        block = "".join(",".join(r) + "\n" for r in rows[:3]).encode()
+        with GeneStoreWriter(output_dir + "order.csv") as out:
+            out.append_block(block, [[0, 0, 0], [0, 0, 1], [0, 0, 2]])
+        with GeneStoreWriter(output_dir + "order.csv", mode='a') as out:
+            out.append(rows[3])
+            with pytest.raises(ValueError):
+                out.append_block(block, [[1, 0, 0], [1, 0, 1], [1, 0, 2]])
+        ordered = open_gene_data(output_dir + "order.csv")
+        assert ordered.indexed
+        assert len(ordered) == 4
+        assert ordered.gene_order().tolist() == [[0, 0, 0], [0, 0, 1],
+                                                 [0, 0, 2]]
+
+        # rows must have a value for each column
+        with pytest.raises(ValueError):
+            with GeneStoreWriter(output_dir + "bad.csv") as out:
+                out.append_rows([rows[0][:-1]])
+        with open(output_dir + "bad.csv", 'w') as outfile:
+            outfile.write("a,b\n")
+        with pytest.raises(ValueError):
+            open_gene_data(output_dir + "bad.csv")
+
+    return
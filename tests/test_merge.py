@@ -57,3 +57,177 @@ def test_merge(datafolder):
         assert np.sum(pa[:,1:])==373
 
     return
+
+
+def test_saved_clusters():
+
+    from panaroo.cdhit import write_cdhit_clusters
+    from panaroo.merge_graphs import load_saved_clusters
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        clstr_file = tmpdir + "/combined_protein_cdhit_out.txt.clstr"
+        write_cdhit_clusters([["0_0_1", "1_0_1", "1_0_2"], ["0_0_2"]], {
+            "0_0_1": 100,
+            "1_0_1": 99,
+            "1_0_2": 100,
+            "0_0_2": 50
+        }, clstr_file)
+
+        # ids are renamed and genes that were filtered are dropped
+        id_mapping = {"0_0_1": "2_0_1", "1_0_2": "3_0_2", "0_0_2": "2_0_2"}
+        assert load_saved_clusters(clstr_file,
+                                   id_mapping) == [["2_0_1", "3_0_2"],
+                                                   ["2_0_2"]]
+
+        # if the representative was filtered the longest remaining member
+        # takes its place
+        write_cdhit_clusters([["0_0_1", "1_0_1", "1_0_2", "1_0_3"]], {
+            "0_0_1": 100,
+            "1_0_1": 90,
+            "1_0_2": 99,
+            "1_0_3": 95
+        }, clstr_file)
+        id_mapping = {"1_0_1": "3_0_1", "1_0_2": "3_0_2", "1_0_3": "3_0_3"}
+        assert load_saved_clusters(clstr_file,
+                                   id_mapping) == [["3_0_2", "3_0_1", "3_0_3"]]
+
+    return
+
+
+# stand in for cd-hit and cd-hit-2d, grouping proteins by their first three
+# residues with the longest of each group as its representative
+FAKE_CDHIT = """
+import os
+import sys
+args = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+
+def read_fasta(fasta_file):
+    seqs = {}
+    with open(fasta_file) as infile:
+        for line in infile:
+            if line[0] == ">":
+                sid = line[1:].strip()
+                seqs[sid] = ""
+            else:
+                seqs[sid] += line.strip()
+    return seqs
+
+# record which sequences each run was given
+seqs = read_fasta(args["-i2"] if "-i2" in args else args["-i"])
+with open(os.path.join(os.path.dirname(sys.argv[0]), "calls.txt"), "a") as log:
+    log.write(os.path.basename(sys.argv[0]) + " " + " ".join(seqs) + "\\n")
+
+clusters = {}
+if "-i2" in args:
+    # sequences matching a database sequence join its cluster
+    for sid, seq in read_fasta(args["-i"]).items():
+        clusters[seq[:3]] = [sid]
+    novel = {}
+    for sid, seq in seqs.items():
+        if seq[:3] in clusters:
+            clusters[seq[:3]].append(sid)
+        else:
+            novel[sid] = seq
+    with open(args["-o"], "w") as out:
+        for sid, seq in novel.items():
+            out.write(">" + sid + "\\n" + seq + "\\n")
+else:
+    for sid, seq in seqs.items():
+        clusters.setdefault(seq[:3], []).append(sid)
+    for members in clusters.values():
+        members.sort(key=lambda sid: -len(seqs[sid]))
+    with open(args["-o"], "w") as out:
+        for members in clusters.values():
+            out.write(">" + members[0] + "\\n" + seqs[members[0]] + "\\n")
+with open(args["-o"] + ".clstr", "w") as clstr:
+    for c, members in enumerate(clusters.values()):
+        clstr.write(">Cluster " + str(c) + "\\n")
+        for i, sid in enumerate(members):
+            clstr.write(str(i) + "\\t" + str(len(seqs.get(sid, ""))) +
+                        "aa, >" + sid + ("... *" if i == 0 else "... at 99.00%")
+                        + "\\n")
+"""
+
+
+def test_cluster_centroids_incremental(monkeypatch):
+
+    import networkx as nx
+    from panaroo.cdhit import write_cdhit_clusters
+    from panaroo.gene_store import GeneStoreWriter
+    from panaroo.merge_graphs import cluster_centroids
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bindir = os.path.join(tmpdir, "bin")
+        os.mkdir(bindir)
+        for name in ["cd-hit", "cd-hit-2d"]:
+            with open(os.path.join(bindir, name), 'w') as outfile:
+                outfile.write("#!" + sys.executable + "\n" + FAKE_CDHIT)
+            os.chmod(os.path.join(bindir, name), 0o755)
+        monkeypatch.setenv("PATH", bindir + os.pathsep + os.environ["PATH"])
+
+        # two earlier runs, the first of which saved its clustering
+        genes = [{
+            "0_0_0": "MKALLLLLLL",
+            "0_0_1": "MKALLLLL",
+            "0_0_2": "MGGLLLLLL"
+        }, {
+            "0_0_0": "MKALLLLLL",
+            "0_0_1": "MTTLLLLLL"
+        }]
+        directories = []
+        for i, prots in enumerate(genes):
+            d = os.path.join(tmpdir, "run" + str(i), "")
+            os.mkdir(d)
+            with GeneStoreWriter(d + "gene_data.csv") as out:
+                out.append_rows([[
+                    "genome" + str(i), "ctg", cid, "ann_" + cid, prot,
+                    "ATG" * len(prot), "", ""
+                ] for cid, prot in prots.items()])
+            directories.append(d)
+        write_cdhit_clusters([["0_0_0", "0_0_1"], ["0_0_2"]], {
+            sid: len(prot)
+            for sid, prot in genes[0].items()
+        }, directories[0] + "combined_protein_cdhit_out.txt.clstr")
+
+        id_mapping = [{cid: str(i) + cid[1:]
+                       for cid in prots} for i, prots in enumerate(genes)]
+
+        def run(incremental):
+            graphs = []
+            node = 0
+            for i, prots in enumerate(genes):
+                G = nx.Graph()
+                for cid in prots:
+                    G.add_node(node, seqIDs=[id_mapping[i][cid]])
+                    node += 1
+                graphs.append(G)
+            outdir = os.path.join(tmpdir, "out" + str(incremental), "")
+            os.mkdir(outdir)
+            clusters, seqid_to_centroid, orig_ids, _ = cluster_centroids(
+                graphs,
+                outdir,
+                directories,
+                id_mapping,
+                incremental=incremental)
+            # the temporary files are removed
+            assert os.listdir(outdir) == []
+            return sorted(sorted(c) for c in clusters), seqid_to_centroid
+
+        full = run(False)
+        with open(os.path.join(bindir, "calls.txt")) as infile:
+            assert infile.read().split() == [
+                "cd-hit", "0_0_0", "0_0_1", "0_0_2", "1_0_0", "1_0_1"
+            ]
+        os.remove(os.path.join(bindir, "calls.txt"))
+
+        # with the saved clustering only the new genes are compared to its
+        # representatives and only the unmatched gene is clustered again
+        assert run(True) == full
+        with open(os.path.join(bindir, "calls.txt")) as infile:
+            assert infile.read().split() == [
+                "cd-hit-2d", "1_0_0", "1_0_1", "cd-hit", "1_0_1"
+            ]
+        assert full[0] == [[0, 1, 3], [2], [4]]
+        assert full[1]["1_0_0"] == "0_0_0"
+
+    return
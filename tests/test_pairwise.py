@@ -0,0 +1,231 @@
+# test if the batched pairwise engine agrees with single alignments
+import random
+import tempfile
+import itertools
+import numpy as np
+
+from panaroo.cdhit import pairwise_identities, run_pw
+from panaroo.cdhit import load_pairwise_cache, lookup_pairwise_cache
+from panaroo.cdhit import pairwise_cache_keys, kmer_candidate_pairs
+from panaroo.cdhit import hierarchy_clusters
+from panaroo import cdhit
+from Bio.Seq import Seq
+
+
+def test_pairwise_identities():
+
+    rng = random.Random(0)
+    sequences = []
+    for i in range(20):
+        seq = "".join(rng.choice("ACGT") for j in range(rng.randint(50, 400)))
+        sequences.append(seq)
+        # add a close relative of each sequence
+        seq = list(seq)
+        seq[rng.randrange(len(seq))] = "N"
+        sequences.append("".join(seq))
+
+    pairs = list(itertools.combinations(range(len(sequences)), 2))
+    rows = np.array([p[0] for p in pairs])
+    cols = np.array([p[1] for p in pairs])
+
+    for dna in [True, False]:
+        expected = [
+            run_pw(sequences[r], sequences[c], r, c, dna)[2]
+            for r, c in pairs
+        ]
+        for n_cpu in [1, 2]:
+            pwids = pairwise_identities(sequences,
+                                        rows,
+                                        cols,
+                                        dna=dna,
+                                        n_cpu=n_cpu)
+            assert list(pwids) == expected
+
+    assert len(pairwise_identities(sequences, rows[:0], cols[:0])) == 0
+
+    return
+
+
+def test_pairwise_identities_threshold():
+
+    rng = random.Random(2)
+    sequences = []
+    for i in range(15):
+        seq = "".join(rng.choice("ACGT") for j in range(rng.randint(50, 300)))
+        sequences.append(seq)
+        # add relatives at a range of identities, some on the other strand
+        for n in [1, 3, 10]:
+            seq = list(seq)
+            for j in range(n):
+                seq[rng.randrange(len(seq))] = rng.choice("ACGTN")
+            seq = "".join(seq)
+            if rng.random() < 0.5:
+                seq = str(Seq(seq).reverse_complement())
+            sequences.append(seq)
+
+    pairs = list(itertools.combinations(range(len(sequences)), 2))
+    rows = np.array([p[0] for p in pairs])
+    cols = np.array([p[1] for p in pairs])
+
+    for dna in [True, False]:
+        expected = pairwise_identities(sequences, rows, cols, dna=dna)
+        for threshold in [0.98, 0.95, 0.7, 0.3]:
+            pwids = pairwise_identities(sequences,
+                                        rows,
+                                        cols,
+                                        dna=dna,
+                                        threshold=threshold)
+            # identities reaching the threshold are exact
+            keep = expected >= threshold
+            assert np.array_equal(pwids >= threshold, keep)
+            assert np.array_equal(pwids[keep], expected[keep])
+
+    return
+
+
+def test_pairwise_cache():
+
+    rng = random.Random(1)
+    sequences = [
+        "".join(rng.choice("ACDEFGHIKLMNPQRSTVWY") for j in range(100))
+        for i in range(10)
+    ]
+    pairs = list(itertools.combinations(range(len(sequences)), 2))
+    rows = np.array([p[0] for p in pairs])
+    cols = np.array([p[1] for p in pairs])
+    expected = pairwise_identities(sequences, rows, cols)
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        # fill the cache with half of the pairs then look up all of them
+        half = len(pairs) // 2
+        pairwise_identities(sequences,
+                            rows[:half],
+                            cols[:half],
+                            cache_dir=tmpdirname)
+        pwids = pairwise_identities(sequences,
+                                    rows,
+                                    cols,
+                                    cache_dir=tmpdirname)
+        assert list(pwids) == list(expected)
+
+        keys, cached, exact = load_pairwise_cache(tmpdirname)
+        assert len(keys) == len(pairs)
+        assert np.all(exact)
+
+        # DNA comparisons of the same sequences are cached separately
+        found = lookup_pairwise_cache(
+            keys, cached, exact,
+            pairwise_cache_keys(sequences, rows, cols, True))[1]
+        assert not np.any(found)
+
+    return
+
+
+def test_pairwise_cache_threshold(monkeypatch):
+
+    rng = random.Random(3)
+    sequences = []
+    for i in range(10):
+        seq = "".join(rng.choice("ACGT") for j in range(200))
+        sequences.append(seq)
+        for n in [1, 5, 40]:
+            seq = list(seq)
+            for j in range(n):
+                seq[rng.randrange(len(seq))] = rng.choice("ACGT")
+            sequences.append("".join(seq))
+    pairs = list(itertools.combinations(range(len(sequences)), 2))
+    rows = np.array([p[0] for p in pairs])
+    cols = np.array([p[1] for p in pairs])
+    expected = {
+        t: pairwise_identities(sequences, rows, cols, dna=True, threshold=t)
+        for t in [0.98, 0.95, 0.7, None]
+    }
+
+    # count the pairs that are aligned
+    aligned = []
+    run_pw_batch = cdhit.run_pw_batch
+
+    def counting_run_pw_batch(sequences, rows, cols, *args):
+        aligned.append(len(rows))
+        return run_pw_batch(sequences, rows, cols, *args)
+
+    monkeypatch.setattr(cdhit, "run_pw_batch", counting_run_pw_batch)
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+
+        def run(threshold):
+            del aligned[:]
+            pwids = pairwise_identities(sequences,
+                                        rows,
+                                        cols,
+                                        dna=True,
+                                        cache_dir=tmpdirname,
+                                        threshold=threshold)
+            if threshold is None:
+                assert np.array_equal(pwids, expected[None])
+            else:
+                keep = expected[threshold] >= threshold
+                assert np.array_equal(pwids >= threshold, keep)
+                assert np.array_equal(pwids[keep], expected[threshold][keep])
+            return sum(aligned)
+
+        assert run(0.95) == len(pairs)
+        below = np.sum(expected[0.95] < 0.95)
+        assert 0 < below < len(pairs)
+
+        # pairs below the threshold are not aligned again for the same or a
+        # higher threshold
+        assert run(0.95) == 0
+        assert run(0.98) == 0
+
+        # but are for a lower threshold or when exact identities are needed
+        assert run(0.7) == below
+        assert run(0.7) == 0
+        assert run(None) == np.sum(expected[0.7] < 0.7)
+        assert run(None) == 0
+
+    return
+
+
+def test_kmer_candidate_pairs():
+
+    rng = random.Random(2)
+    for dna, alphabet, threshold in [(True, "ACGT", 0.98),
+                                     (False, "ACDEFGHIKLMNPQRSTVWY", 0.7)]:
+        sequences = []
+        for i in range(30):
+            seq = "".join(rng.choice(alphabet) for j in range(300))
+            sequences.append(seq)
+            # a close relative, on the other strand for DNA
+            seq = list(seq)
+            seq[rng.randrange(len(seq))] = alphabet[0]
+            seq = "".join(seq)
+            if dna:
+                seq = str(Seq(seq).reverse_complement())
+            sequences.append(seq)
+
+        rows, cols = kmer_candidate_pairs(sequences, threshold, dna=dna)
+        pairs = set(zip(rows, cols))
+        assert np.all(rows < cols)
+        for i in range(0, len(sequences), 2):
+            assert (i, i + 1) in pairs
+        assert len(pairs) < 2 * len(sequences)
+
+    return
+
+
+def test_hierarchy_clusters():
+
+    ids = ["a", "b", "c", "d", "e", "f"]
+    # each level merges clusters of the level before, "f" is dropped by
+    # cd-hit in the second round
+    labels = np.array([[0, 1, 0, 2, 3, 4], [0, 1, 0, 1, 2, -1],
+                       [0, 1, 0, 1, 0, -1]])
+
+    assert hierarchy_clusters(ids, labels, level=0) == [["a", "c"], ["b"],
+                                                        ["d"], ["e"], ["f"]]
+    assert hierarchy_clusters(ids, labels, level=1) == [["a", "c"],
+                                                        ["b", "d"], ["e"],
+                                                        ["f"]]
+    assert hierarchy_clusters(ids, labels) == [["a", "c", "e"], ["b", "d"],
+                                               ["f"]]
@@ -0,0 +1,356 @@
+# test if the streaming GFF3 parser agrees with the gffutils based parser
+import os
+import gzip
+import tempfile
+
+from panaroo.prokka import stream_gff, gffutils_gff, read_annotation
+from panaroo.prokka import annotation_name, detect_input_format
+from panaroo.prokka import check_annotation, validate_inputs
+from panaroo.prokka import translate_batch
+from panaroo.prokka import get_gene_sequences, preprocess_cache_key
+from panaroo.prokka import format_genome_block, extract_gene_sequences
+from panaroo.prokka import process_prokka_input
+
+
+def test_stream_gff(datafolder):
+
+    for gff in ["aa1.gff", "paralog.gff"]:
+        streamed = stream_gff(datafolder + gff)
+        parsed = gffutils_gff(datafolder + gff)
+
+        assert len(streamed[1]) > 0
+        assert streamed == parsed
+
+    return
+
+
+def test_stream_gzip_gff(datafolder):
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        gz_file = os.path.join(tmpdirname, "aa1.gff.gz")
+        with open(datafolder + "aa1.gff", 'rb') as infile, \
+        gzip.open(gz_file, 'wb') as outfile:
+            outfile.write(infile.read())
+
+        assert annotation_name(gz_file) == "aa1"
+        assert stream_gff(gz_file) == stream_gff(datafolder + "aa1.gff")
+
+    return
+
+
+def test_separate_fasta(datafolder):
+
+    # split a Prokka file into a Prodigal style annotation and genome FASTA
+    with open(datafolder + "aa1.gff", 'r') as infile:
+        annotation, genome = infile.read().split("##FASTA\n")
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        gff_file = os.path.join(tmpdirname, "aa1.gff")
+        with open(gff_file, 'w') as outfile:
+            outfile.write("##gff-version  3\n")
+            outfile.write("# Sequence Data: seqnum=1;seqlen=100;seqhdr=1\n")
+            outfile.write(annotation)
+        with open(os.path.join(tmpdirname, "aa1.fna"), 'w') as outfile:
+            outfile.write(genome)
+
+        assert detect_input_format(gff_file) == "prodigal"
+        assert read_annotation(gff_file) == stream_gff(datafolder +
+                                                       "aa1.gff")
+
+    return
+
+
+GENOME = ">ctg1\n" + "ATG" + "AAA" * 11 + "TAA" + "ATG" + "GGC" * 11 + "TGA\n"
+
+
+def test_bakta_attributes():
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        gff_file = os.path.join(tmpdirname, "bakta.gff3")
+        with open(gff_file, 'w') as outfile:
+            outfile.write("##gff-version 3\n")
+            outfile.write("# Annotated with Bakta\n")
+            outfile.write("\t".join([
+                "ctg1", "Bakta", "CDS", "1", "39", ".", "+", "0",
+                "ID=BAKTA_00005;gene=dnaN;product=DNA polymerase III%2C " +
+                "beta subunit%3B sliding clamp%3Dyes"
+            ]) + "\n")
+            outfile.write("##FASTA\n" + GENOME)
+
+        assert detect_input_format(gff_file) == "bakta"
+        contigs, genes = read_annotation(gff_file)
+        assert genes == [("ctg1", 1, 39, "BAKTA_00005", "dnaN",
+                          "DNA polymerase III beta subunit; sliding clamp=yes",
+                          GENOME.split("\n")[1][:39])]
+
+    return
+
+
+def test_refseq_ids():
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        gff_file = os.path.join(tmpdirname, "refseq.gff")
+        with open(gff_file, 'w') as outfile:
+            outfile.write("##gff-version 3\n")
+            outfile.write("#!processor NCBI annotwriter\n")
+            for feature, start, stop, attributes in [
+                ("gene", 1, 78, "ID=gene-A;Name=prfB"),
+                ("CDS", 1, 39, "ID=cds-WP_1;Parent=gene-A;gene=prfB"),
+                ("CDS", 40, 78, "ID=cds-WP_1;Parent=gene-A;gene=prfB"),
+                ("CDS", 1, 39, "ID=cds-WP_2;gene=dnaA"),
+            ]:
+                outfile.write("\t".join([
+                    "ctg1", "RefSeq", feature,
+                    str(start),
+                    str(stop), ".", "+", "0", attributes
+                ]) + "\n")
+        with open(os.path.join(tmpdirname, "refseq.fna"), 'w') as outfile:
+            outfile.write(GENOME)
+
+        assert detect_input_format(gff_file) == "refseq"
+        contigs, genes = read_annotation(gff_file)
+        # the parts of a CDS sharing an ID are numbered as in
+        # scripts/convert_refseq_to_prokka_gff.py
+        assert [(g[1], g[3], g[4]) for g in genes] == [
+            (1, "cds-WP_1", "prfB"), (40, "cds-WP_1.1", "prfB"),
+            (1, "cds-WP_2", "dnaA")
+        ]
+
+    return
+
+
+def test_check_annotation(datafolder):
+
+    errors, warnings, n_contigs, n_cds = check_annotation(datafolder +
+                                                          "aa1.gff")
+    assert errors == []
+    assert n_contigs > 0
+    assert n_cds > 0
+
+    with open(datafolder + "aa1.gff", 'r') as infile:
+        annotation = infile.read().split("##FASTA\n")[0]
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        gff_file = os.path.join(tmpdirname, "aa1.gff")
+        with open(gff_file, 'w') as outfile:
+            outfile.write(annotation)
+
+        errors, warnings, n_contigs, n_cds = check_annotation(gff_file)
+        assert "no ##FASTA section" in errors
+        assert not validate_inputs([datafolder + "aa1.gff", gff_file],
+                                   quiet=True)
+
+        # CDS without an ID are read with an automatic ID by gffutils
+        no_id_file = os.path.join(tmpdirname, "no_id.gff")
+        with open(datafolder + "aa1.gff", 'r') as infile, \
+        open(no_id_file, 'w') as outfile:
+            outfile.write(infile.read().replace("ID=GEN1_00001;", "", 1))
+        errors, warnings, n_contigs, n_cds = check_annotation(no_id_file)
+        assert errors == []
+        assert "automatic IDs: lines 7" in warnings[0]
+        assert read_annotation(no_id_file)[1][0][3] == "CDS_1"
+
+    return
+
+
+def test_translate_batch():
+
+    from Bio.Seq import Seq
+
+    sequences = [
+        "ATGAAAGGGTAA",  # terminal stop
+        "ATGTAGAAACCC",  # internal stop
+        "ATGTAAAAATGA",  # internal and terminal stop
+        "ATGNNNAARYTAGCN",  # ambiguity codes
+        "ATGTARCCC",  # ambiguous stop
+        "ATGAAAGG",  # trailing partial codon
+        "ATGTGAAAA",  # stop only in the standard table
+        "atgaaataa",
+        ""
+    ]
+
+    for table in [11, 4]:
+        proteins, internal_stop, terminal_stop = translate_batch(
+            sequences, table)
+        for seq, prot, internal, terminal in zip(sequences, proteins,
+                                                 internal_stop,
+                                                 terminal_stop):
+            expected = str(Seq(seq[:3 * (len(seq) // 3)]).translate(table))
+            assert prot == expected
+            assert terminal == expected.endswith("*")
+            assert internal == ("*" in expected[:-1])
+
+    proteins, internal_stop, terminal_stop = translate_batch(sequences)
+    assert proteins[3] == "MXKLA"
+    assert proteins[6] == "M*K"
+    assert translate_batch(sequences, 4)[0][6] == "MWK"
+
+    proteins, internal_stop, terminal_stop = translate_batch([])
+    assert proteins == []
+    assert len(internal_stop) == 0 and len(terminal_stop) == 0
+
+    return
+
+
+def test_extract_gene_sequences():
+
+    from Bio.Seq import reverse_complement
+
+    contigs = {"ctg1": "ATGCCCGGGTTTAAACCCGGGTAG", "ctg2": "ATGAAACCCTGA"}
+    features = [
+        ("ctg1", 1, 9, "+"),
+        ("ctg1", 4, 12, "-"),
+        ("ctg2", 1, 12, "-"),
+        # running past the end of the contig, or starting before it
+        ("ctg1", 19, 30, "+"),
+        ("ctg1", 19, 30, "-"),
+        ("ctg2", 0, 6, "-"),
+        # on a scaffold that is not in the genome
+        ("ctg3", 1, 9, "+"),
+    ]
+
+    # slicing each feature from its scaffold, as done before
+    expected = []
+    for scaffold, start, stop, strand in features[:-1]:
+        seq = contigs[scaffold][(start - 1):stop]
+        expected.append(reverse_complement(seq) if strand == "-" else seq)
+
+    assert extract_gene_sequences(contigs, features) == expected + [None]
+
+    return
+
+
+def test_process_prokka_input_n_cpu(datafolder):
+
+    # genomes are written in input order whatever the number of workers
+    gff_list = [datafolder + gff for gff in ["aa2.gff", "aa1.gff", "aa3.gff"]]
+    outputs = []
+    for n_cpu in [1, 2]:
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            output_dir = os.path.join(tmpdirname, "")
+            process_prokka_input(gff_list,
+                                 output_dir,
+                                 filter_seqs=False,
+                                 quiet=True,
+                                 n_cpu=n_cpu)
+            output = []
+            for name in [
+                    "combined_protein_CDS.fasta", "combined_DNA_CDS.fasta",
+                    "gene_data.csv"
+            ]:
+                with open(output_dir + name, 'r') as infile:
+                    output.append(infile.read())
+            outputs.append(output)
+
+    assert outputs[0] == outputs[1]
+    rows = outputs[0][2].splitlines()[1:]
+    assert [row.split(",")[0] for row in rows
+            ] == sorted([row.split(",")[0] for row in rows],
+                        key=["aa2", "aa1", "aa3"].index)
+    assert rows[0].split(",")[2] == "0_0_0"
+
+    return
+
+
+def test_format_genome_block():
+
+    from io import StringIO
+    from Bio import SeqIO
+    from Bio.Seq import Seq
+    from Bio.SeqRecord import SeqRecord
+
+    # genes shorter and longer than the 60 character FASTA line width
+    gene_records = [
+        ("0_0", "ctg1", "GEN_00001", "ATGAAATAA", "MK", "dnaA",
+         "replication initiator"),
+        ("0_1", "ctg1", "GEN_00002", "ATG" + "GCA" * 199 + "TGA",
+         "M" + "A" * 199, "", "hypothetical protein"),
+        ("1_0", "ctg2", "GEN_00003", "ATG" + "C" * 177, "M" + "P" * 59, "",
+         ""),
+    ]
+    protein_block, dna_block, csv_block, gene_order = format_genome_block(
+        gene_records, 3, "genome")
+
+    # the output of the SeqIO and csv writers used before
+    proteins = StringIO()
+    dna = StringIO()
+    csv = StringIO()
+    for local_id, scaffold, entry_id, seq, prot, name, desc in gene_records:
+        clustering_id = "3_" + local_id
+        SeqIO.write(
+            SeqRecord(Seq(prot), id=clustering_id,
+                      description=clustering_id), proteins, 'fasta')
+        SeqIO.write(
+            SeqRecord(Seq(seq), id=clustering_id, description=clustering_id),
+            dna, 'fasta')
+        csv.write(",".join([
+            "genome", scaffold, clustering_id, entry_id, prot, seq, name, desc
+        ]) + '\n')
+
+    assert protein_block == proteins.getvalue().encode('utf-8')
+    assert dna_block == dna.getvalue().encode('utf-8')
+    assert csv_block == csv.getvalue().encode('utf-8')
+    assert gene_order.tolist() == [[3, 0, 0], [3, 0, 1], [3, 1, 0]]
+
+    return
+
+
+def test_preprocess_cache(datafolder, monkeypatch):
+
+    import panaroo.prokka
+
+    def blocks_equal(a, b):
+        protein_a, dna_a, csv_a, order_a = a
+        protein_b, dna_b, csv_b, order_b = b
+        return (protein_a == protein_b and dna_a == dna_b and csv_a == csv_b
+                and (order_a == order_b).all())
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        cache_dir = os.path.join(tmpdirname, "cache")
+        os.makedirs(cache_dir)
+        gff_file = os.path.join(tmpdirname, "aa1.gff")
+        with open(datafolder + "aa1.gff", 'r') as infile, \
+        open(gff_file, 'w') as outfile:
+            outfile.write(infile.read())
+
+        uncached = get_gene_sequences(gff_file, 0, False)
+        first = get_gene_sequences(gff_file, 0, False, cache_dir)
+        assert blocks_equal(uncached, first)
+        cache_files = os.listdir(cache_dir)
+        assert len(cache_files) == 1
+        cache_file = os.path.join(cache_dir, cache_files[0])
+
+        # the key depends on the options that change parsing
+        key = preprocess_cache_key(gff_file, False, "prokka")
+        assert cache_files[0] == key + ".pkl"
+        assert key != preprocess_cache_key(gff_file, True, "prokka")
+        assert key != preprocess_cache_key(gff_file, False, "prokka", table=4)
+        assert key != preprocess_cache_key(gff_file, False, "bakta")
+
+        # a hit does not parse the file again
+        def fail(*args):
+            raise AssertionError("cache miss")
+
+        with monkeypatch.context() as m:
+            m.setattr(panaroo.prokka, "read_gene_sequences", fail)
+            assert blocks_equal(
+                first, get_gene_sequences(gff_file, 0, False, cache_dir))
+
+        # truncated or corrupt entries are parsed again and replaced
+        with open(cache_file, 'rb') as infile:
+            entry = infile.read()
+        for corrupt in [entry[:len(entry) // 2], b"not a pickle"]:
+            with open(cache_file, 'wb') as outfile:
+                outfile.write(corrupt)
+            assert blocks_equal(
+                first, get_gene_sequences(gff_file, 0, False, cache_dir))
+            assert panaroo.prokka.load_cached_genes(cache_file) is not None
+
+        # changing the contents of the file gives a miss
+        with open(gff_file, 'a') as outfile:
+            outfile.write("\n")
+        assert preprocess_cache_key(gff_file, False, "prokka") != key
+        get_gene_sequences(gff_file, 0, False, cache_dir)
+        assert len(os.listdir(cache_dir)) == 2
+
+    return